@@ -1,12 +1,85 @@
 """
 Attendance tracking logic.
 """
-from datetime import datetime, date
+import threading
+from datetime import datetime, date, timezone
 from typing import Optional
-from database import get_db, User, AttendanceRecord, Fine, Settings
-from utils import get_phnom_penh_now, get_phnom_penh_date, is_before_deadline, is_attendance_window_open
-from config import DEFAULT_FINE_AMOUNT
+from database import (
+    get_db, User, AttendanceRecord, Fine, Settings,
+    get_daily_close, claim_daily_close, complete_daily_close, release_daily_close
+)
+from utils import (
+    get_phnom_penh_now,
+    get_phnom_penh_date,
+    is_before_deadline,
+    is_attendance_window_open,
+    format_user_name
+)
+from config import DEFAULT_FINE_AMOUNT, TIMEZONE
 from reports import get_fine_amount
+from live_status import live_tally
+from metrics import CHECKINS
+from tracing import span, annotate
+from bitmaps import mark_day, mark_days
+
+ALREADY_RECORDED_MESSAGE = "You have already recorded your attendance for today."
+WINDOW_CLOSED_MESSAGE = "Attendance window is closed. Please send '1' between 09:00 and 10:00 AM."
+
+
+class CheckinCache:
+    """
+    In-process set of telegram_ids that have checked in today.
+    Lets duplicate '1' messages be answered without touching the database.
+    The set is cleared automatically when the Phnom Penh date changes.
+    """
+    
+    def __init__(self):
+        self._date: Optional[date] = None
+        self._telegram_ids = set()
+        self._lock = threading.Lock()
+    
+    def _roll_over(self, today: date):
+        """Start a fresh set when the date changes (caller holds the lock)."""
+        if self._date != today:
+            self._date = today
+            self._telegram_ids = set()
+    
+    def contains(self, telegram_id: int, today: date = None) -> bool:
+        """Whether this user is known to have checked in today."""
+        today = today or get_phnom_penh_date()
+        with self._lock:
+            self._roll_over(today)
+            return telegram_id in self._telegram_ids
+    
+    def add(self, telegram_id: int, today: date = None):
+        """Remember a successful check-in."""
+        today = today or get_phnom_penh_date()
+        with self._lock:
+            self._roll_over(today)
+            self._telegram_ids.add(telegram_id)
+    
+    def warm(self, today: date = None) -> int:
+        """Load today's check-ins from the database. Returns the number cached."""
+        today = today or get_phnom_penh_date()
+        with get_db() as db:
+            records = db.query(AttendanceRecord).filter(AttendanceRecord.date == today).all()
+            checked_in = {r.user_id for r in records}
+            telegram_ids = set()
+            if checked_in:
+                for user in db.query(User).all():
+                    if user.id in checked_in:
+                        telegram_ids.add(user.telegram_id)
+        with self._lock:
+            self._date = today
+            self._telegram_ids = telegram_ids
+        return len(telegram_ids)
+    
+    def __len__(self):
+        return len(self._telegram_ids)
+
+
+# Global cache of today's check-ins
+checkin_cache = CheckinCache()
 
 
 def get_or_create_user(telegram_id: int, username: str = None, full_name: str = None) -> User:
@@ -68,13 +141,16 @@ def record_attendance(telegram_id: int, timestamp: datetime = None, username: st
             timestamp = get_phnom_penh_now()
         
         # Check if window is open
-        if not is_attendance_window_open():
-            return False, "Attendance window is closed. Please send '1' between 09:00 and 10:00 AM."
+        with span('window_check'):
+            window_open = is_attendance_window_open()
+        if not window_open:
+            return False, WINDOW_CLOSED_MESSAGE
         
         current_date = get_phnom_penh_date()
         
         # Get or create user first (outside transaction to avoid nested contexts)
-        user = get_or_create_user(telegram_id, username=username, full_name=full_name)
+        with span('user_lookup'):
+            user = get_or_create_user(telegram_id, username=username, full_name=full_name)
         
         if not user or not user.id:
             logger.error(f"User has no ID after get_or_create_user: {telegram_id}")
@@ -82,38 +158,50 @@ def record_attendance(telegram_id: int, timestamp: datetime = None, username: st
         
         with get_db() as db:
             # Check if already recorded for today
-            existing = db.query(AttendanceRecord).filter(
-                AttendanceRecord.user_id == user.id,
-                AttendanceRecord.date == current_date
-            ).first()
+            with span('duplicate_check'):
+                existing = db.query(AttendanceRecord).filter(
+                    AttendanceRecord.user_id == user.id,
+                    AttendanceRecord.date == current_date
+                ).first()
             
             if existing:
-                return False, "You have already recorded your attendance for today."
+                checkin_cache.add(telegram_id, current_date)
+                return False, ALREADY_RECORDED_MESSAGE
             
             # Check if before deadline
             is_on_time = is_before_deadline(timestamp)
             status = 'present' if is_on_time else 'late'
             
             # Create attendance record
-            record = AttendanceRecord(
-                user_id=user.id,
-                date=current_date,
-                status=status,
-                timestamp=timestamp
-            )
-            db.add(record)
-            
-            # If late, create fine
-            if not is_on_time:
-                fine_amount = get_fine_amount()
-                fine = Fine(
+            with span('record_insert', status=status):
+                record = AttendanceRecord(
                     user_id=user.id,
                     date=current_date,
-                    amount=fine_amount
+                    status=status,
+                    timestamp=timestamp
                 )
-                db.add(fine)
+                db.add(record)
+                db.commit()
             
-            db.commit()
+            # If late, create fine
+            if not is_on_time:
+                with span('fine_create'):
+                    fine_amount = get_fine_amount()
+                    fine = Fine(
+                        user_id=user.id,
+                        date=current_date,
+                        amount=fine_amount
+                    )
+                    db.add(fine)
+                    db.commit()
+            
+            with span('bitmap_update'):
+                mark_day(user.id, current_date, status)
+            
+            checkin_cache.add(telegram_id, current_date)
+            live_tally.record(telegram_id, format_user_name(user), status, current_date)
+            CHECKINS.labels(status).inc()
+            annotate(outcome=status)
             
             if is_on_time:
                 return True, "Good morning! Attendance recorded."
@@ -124,35 +212,65 @@ def record_attendance(telegram_id: int, timestamp: datetime = None, username: st
         return False, "An error occurred while recording attendance. Please try again."
 
 
-def process_daily_attendance():
+def process_daily_attendance(target_date: date = None, group_id: int = None, force: bool = False) -> Optional[dict]:
     """
     Process attendance for all members at 10:00 AM.
     Mark absent members and apply fines.
+
+    Each close is guarded by an idempotency marker keyed on the date, so
+    re-runs for an already-closed date return the stored marker without
+    touching users or records. Use force=True to recompute a date.
+    Returns the close marker ({date, group, processed_at, counts}).
     """
     import logging
     logger = logging.getLogger(__name__)
     
+    current_date = target_date or get_phnom_penh_date()
+    close_key = current_date.isoformat()
+    
+    marker = {
+        'date': datetime.combine(current_date, datetime.min.time()).replace(tzinfo=timezone.utc),
+        'group': group_id,
+        'status': 'processing',
+        'started_at': datetime.now(timezone.utc)
+    }
+    if not claim_daily_close(close_key, marker, force=force):
+        existing = get_daily_close(close_key)
+        logger.info(f"Daily close for {close_key} already {existing.get('status') if existing else 'claimed'}, skipping")
+        return existing
+    
+    counts = {'active_users': 0, 'already_recorded': 0, 'marked_absent': 0, 'skipped': 0, 'errors': 0}
+    marked_absent = []
+    
     try:
-        current_date = get_phnom_penh_date()
         fine_amount = get_fine_amount()
         
         with get_db() as db:
             # Get all active users
             users = db.query(User).filter(User.is_active == True).all()
+            counts['active_users'] = len(users)
             
             for user in users:
                 if not user or not user.id:
                     logger.warning(f"Skipping user without ID: {user.telegram_id if user else 'unknown'}")
+                    counts['skipped'] += 1
+                    continue
+                
+                # Users who joined after the date being closed are not absent
+                if user.created_at and user.created_at.astimezone(TIMEZONE).date() > current_date:
+                    counts['skipped'] += 1
                     continue
                 
                 try:
-                    # Check if user has attendance record for today
+                    # Check if user has attendance record for the date
                     record = db.query(AttendanceRecord).filter(
                         AttendanceRecord.user_id == user.id,
                         AttendanceRecord.date == current_date
                     ).first()
                     
-                    if not record:
+                    if record:
+                        counts['already_recorded'] += 1
+                    else:
                         # Mark as absent
                         record = AttendanceRecord(
                             user_id=user.id,
@@ -169,13 +287,25 @@ def process_daily_attendance():
                             amount=fine_amount
                         )
                         db.add(fine)
+                        marked_absent.append(user.id)
+                        counts['marked_absent'] += 1
                 except Exception as e:
                     logger.error(f"Error processing attendance for user {user.telegram_id if user else 'unknown'}: {e}")
+                    counts['errors'] += 1
                     continue
             
             db.commit()
+        
+        mark_days(marked_absent, current_date, 'absent')
+        
+        return complete_daily_close(close_key, counts)
     except Exception as e:
         logger.error(f"Error in process_daily_attendance: {e}", exc_info=True)
+        # Release the claim so a retry can close this date
+        try:
+            release_daily_close(close_key)
+        except Exception as release_error:
+            logger.error(f"Could not release daily close for {close_key}: {release_error}")
         raise
 
 
@@ -236,5 +366,9 @@ def force_mark_attendance(telegram_id: int, status: str, target_date: date = Non
             db.add(fine)
         
         db.commit()
+        mark_day(user.id, target_date, status)
+        
+        # The user now has a record for the date either way
+        checkin_cache.add(telegram_id, target_date)
         return True
 
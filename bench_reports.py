@@ -0,0 +1,333 @@
+"""
+Report and export benchmark suite.
+
+Times the report, export and daily-close paths against generated datasets
+of increasing size and records, per case:
+
+    wall_ms        median wall time over --repeat runs
+    db_commands    database round trips in one run, by command
+    db_bytes       BSON bytes sent and received in one run (MongoDB backend only)
+    output_bytes   size of the produced message or CSV file
+    peak_rss_mb    peak resident memory of the process running the case
+
+Each case runs in a forked child so its peak RSS is its own, and so cases
+that write (daily close, force mark) leave nothing behind in memory.
+
+    python bench_reports.py --sizes 100,1000,10000,50000 --save-baseline bench_baseline.json
+    python bench_reports.py --sizes 100,1000,10000,50000 --compare bench_baseline.json --threshold 0.2
+
+Datasets are generated with datagen.py into one database per size and
+reused by later runs with the same parameters (MongoDB backend).
+"""
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+import database
+from config import TIMEZONE
+from database import (
+    db_scope,
+    attendance_buckets_enabled,
+    USERS_COLLECTION,
+    ATTENDANCE_COLLECTION,
+    ATTENDANCE_BUCKETS_COLLECTION,
+    FINES_COLLECTION,
+    DAILY_CLOSES_COLLECTION
+)
+from datagen import DatasetGenerator, generate
+from bitmaps import clear_day
+from loadtest import setup_backend, git_revision
+
+logger = logging.getLogger(__name__)
+
+# Collection holding the parameters a benchmark database was generated with
+DATASET_COLLECTION = 'bench_dataset'
+
+# Metrics compared against the baseline
+COMPARED_METRICS = ('wall_ms', 'db_commands_total', 'db_bytes_total', 'peak_rss_mb')
+
+
+def rss_mb() -> float:
+    """Current resident set size."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (ru_maxrss is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Dataset:
+    """A generated dataset and the dates the cases run against."""
+
+    def __init__(self, users: int, days: int, seed: int):
+        self.users = users
+        self.days = days
+        self.seed = seed
+        self.end = date(2025, 6, 30)
+        self.start = self.end - timedelta(days=days - 1)
+        # Dates with no data, for cases that write
+        self.close_date = self.end + timedelta(days=1)
+        self.mark_date = self.end + timedelta(days=2)
+        # Last complete month in the range
+        month_start = self.end.replace(day=1)
+        if self.end.month == (self.end + timedelta(days=1)).month:
+            month_start = (month_start - timedelta(days=1)).replace(day=1)
+        self.month = (month_start.year, month_start.month)
+
+    @property
+    def params(self) -> Dict:
+        return {'users': self.users, 'days': self.days, 'seed': self.seed, 'end': self.end.isoformat()}
+
+    def database_name(self, prefix: str) -> str:
+        return f"{prefix}_{self.users}u_{self.days}d_s{self.seed}"
+
+    def load(self, backend: str, prefix: str, regenerate: bool = False):
+        """Connect to the dataset's database, generating it when needed."""
+        name = self.database_name(prefix)
+        setup_backend(backend, name, drop=False)
+        meta = database.get_collection(DATASET_COLLECTION)
+        if backend == 'mongo' and not regenerate and meta.find_one({'_id': 'params'}) == {'_id': 'params', **self.params}:
+            logger.info(f"Reusing dataset {name}")
+            return
+
+        database._client.drop_database(name)
+        logger.info(f"Generating {self.users} users x {self.days} days into {name}")
+        generator = DatasetGenerator(users=self.users, start=self.start, end=self.end, seed=self.seed)
+        logger.info(f"Generated: {generate(generator)}")
+        meta.replace_one({'_id': 'params'}, {'_id': 'params', **self.params}, upsert=True)
+
+    def cleanup_writes(self):
+        """Remove what the writing cases added."""
+        for day in (self.close_date, self.mark_date):
+            stored = datetime.combine(day, datetime.min.time()).replace(tzinfo=timezone.utc)
+            database.get_collection(ATTENDANCE_COLLECTION).delete_many({'date': stored})
+            if attendance_buckets_enabled():
+                database.get_collection(ATTENDANCE_BUCKETS_COLLECTION).update_many(
+                    {'month': stored.replace(day=1)},
+                    {'$unset': {f"days.{day:%d}": ''}}
+                )
+            database.get_collection(FINES_COLLECTION).delete_many({'date': stored})
+            database.get_collection(DAILY_CLOSES_COLLECTION).delete_one({'_id': day.isoformat()})
+            clear_day(day)
+
+
+def build_cases(dataset: Dataset, output_dir: str) -> List[Tuple[str, Callable]]:
+    """
+    Benchmark cases as (name, setup). setup() runs untimed and returns
+    (func, reset): func is timed and may return the size of its output in
+    bytes, reset (optional) undoes its writes before every run.
+    """
+    from reports import generate_daily_report, format_daily_report_message, export_daily_csv, export_monthly_csv
+    from attendance import process_daily_attendance, force_mark_attendance
+
+    def daily_report():
+        return lambda: len(json.dumps(generate_daily_report(dataset.end), default=str)), None
+
+    def format_message():
+        report = generate_daily_report(dataset.end)
+        return lambda: len(format_daily_report_message(report, include_running_fines=True).encode('utf-8')), None
+
+    def daily_export():
+        return lambda: os.path.getsize(export_daily_csv(dataset.end, output_dir=output_dir)), None
+
+    def monthly_export():
+        return lambda: os.path.getsize(export_monthly_csv(*dataset.month, output_dir=output_dir)), None
+
+    def daily_close():
+        def run():
+            marker = process_daily_attendance(target_date=dataset.close_date, force=True)
+            return len(json.dumps(marker, default=str))
+        return run, dataset.cleanup_writes
+
+    def force_mark():
+        user = database.get_collection(USERS_COLLECTION).find_one({'is_active': True}, sort=[('telegram_id', 1)])
+
+        def run():
+            force_mark_attendance(user['telegram_id'], 'absent', target_date=dataset.mark_date)
+        return run, dataset.cleanup_writes
+
+    return [
+        ('generate_daily_report', daily_report),
+        ('format_daily_report_message', format_message),
+        ('export_daily_csv', daily_export),
+        ('export_monthly_csv', monthly_export),
+        ('process_daily_attendance', daily_close),
+        ('force_mark_attendance', force_mark),
+    ]
+
+
+def run_case(name: str, setup: Callable, repeat: int) -> Dict:
+    """Time one case: a first run inside a db_scope, then plain runs for wall time."""
+    func, reset = setup()
+    rss_before = rss_mb()
+
+    if reset:
+        reset()
+    with db_scope(f"bench:{name}", track_bytes=True) as scope:
+        started = time.perf_counter()
+        output_bytes = func()
+        timings = [(time.perf_counter() - started) * 1000]
+    db_cost = scope.summary()
+    sent, received = db_cost['bytes_sent'], db_cost['bytes_received']
+
+    for _ in range(repeat - 1):
+        if reset:
+            reset()
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    # The memory backend has no command monitoring, so it reports no bytes
+    measured_bytes = bool(sent or received)
+    return {
+        'wall_ms': round(statistics.median(timings), 2),
+        'wall_ms_runs': [round(t, 2) for t in timings],
+        'db_commands_total': db_cost['commands'],
+        'db_commands': db_cost['by_command'],
+        'db_time_ms': db_cost['time_ms'],
+        'db_docs_returned': db_cost['docs_returned'],
+        'repeated_queries': db_cost['repeated_shapes'],
+        'db_bytes_total': sent + received if measured_bytes else None,
+        'db_bytes': {'sent': sent, 'received': received} if measured_bytes else None,
+        'output_bytes': output_bytes,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'rss_growth_mb': round(max(0.0, peak_rss_mb() - rss_before), 1),
+    }
+
+
+def _child(conn, dataset: Dataset, backend: str, prefix: str, case_index: int, repeat: int, output_dir: str):
+    """Forked child: run one case and send back its result."""
+    try:
+        if backend == 'mongo':
+            # MongoClient is not fork-safe; reconnect without touching the data
+            setup_backend(backend, dataset.database_name(prefix), drop=False)
+        name, setup = build_cases(dataset, output_dir)[case_index]
+        result = run_case(name, setup, repeat)
+        dataset.cleanup_writes()
+        conn.send(result)
+    except Exception as e:
+        logger.error(f"Benchmark case {case_index} failed: {e}", exc_info=True)
+        conn.send({'error': str(e)})
+    finally:
+        conn.close()
+
+
+def run_suite(sizes: List[int], days: int, backend: str, prefix: str, repeat: int, seed: int,
+              regenerate: bool = False, only: Optional[List[str]] = None) -> Dict:
+    """Run every case at every size."""
+    context = multiprocessing.get_context('fork')
+    output_dir = tempfile.mkdtemp(prefix='bench_reports_')
+    results = {}
+    try:
+        for size in sizes:
+            dataset = Dataset(size, days, seed)
+            dataset.load(backend, prefix, regenerate=regenerate)
+            for index, (name, _setup) in enumerate(build_cases(dataset, output_dir)):
+                if only and name not in only:
+                    continue
+                parent_conn, child_conn = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_child,
+                    args=(child_conn, dataset, backend, prefix, index, repeat, output_dir)
+                )
+                process.start()
+                child_conn.close()
+                result = parent_conn.recv()
+                process.join()
+                results[f"{name}@{size}"] = result
+                logger.info(f"{name} @ {size} users: {result.get('wall_ms', result.get('error'))} ms, "
+                            f"{result.get('db_commands_total')} commands")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Regressions where a metric grew by more than threshold (a fraction) over the baseline."""
+    regressions = []
+    for case, current in results.items():
+        previous = baseline.get('results', {}).get(case)
+        if not previous or 'error' in current or 'error' in previous:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = previous.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > (1 if metric == 'wall_ms' else 0):
+                change = f"+{(new - old) / old * 100:.0f}%" if old else "new"
+                regressions.append(f"{case} {metric}: {old} -> {new} ({change})")
+    return regressions
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark reports, exports and the daily close")
+    parser.add_argument('--sizes', default='100,1000,10000,50000', help="Comma separated user counts")
+    parser.add_argument('--days', type=int, default=90, help="Days of history per dataset")
+    parser.add_argument('--backend', choices=['mongo', 'memory'], default='mongo')
+    parser.add_argument('--database-prefix', default=f"{database.DATABASE_NAME}_bench")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per case (median is reported)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help="Rebuild datasets even if they exist")
+    parser.add_argument('--only', help="Comma separated case names to run")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--save-baseline', metavar='FILE', help="Also store the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="Baseline to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed growth before a metric is a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not sys.platform.startswith('linux'):
+        parser.error("bench_reports.py measures RSS through /proc and needs Linux")
+
+    results = {
+        'revision': git_revision(),
+        'started_at': datetime.now(TIMEZONE).isoformat(),
+        'config': {'sizes': args.sizes, 'days': args.days, 'backend': args.backend, 'repeat': args.repeat,
+                   'seed': args.seed},
+        'results': run_suite(
+            [int(size) for size in args.sizes.split(',')],
+            args.days,
+            args.backend,
+            args.database_prefix,
+            max(1, args.repeat),
+            args.seed,
+            regenerate=args.regenerate,
+            only=args.only.split(',') if args.only else None
+        ),
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results['results'], indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results['results'], baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.compare} (revision {baseline.get('revision')}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.compare} beyond {args.threshold:.0%}")
+
+
+if __name__ == '__main__':
+    main()
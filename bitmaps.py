@@ -0,0 +1,430 @@
+"""
+Per-member attendance bitmaps.
+
+One attendance_bitmaps document per member per year holds three 366-bit
+BSON binaries (present, late, absent); bit n is day n of the year. They are
+written next to the attendance records by record_attendance,
+process_daily_attendance and force_mark_attendance, so attendance rate,
+streaks and days missed are popcounts and bit scans over a few bytes
+instead of reads of the member's records.
+
+Bitmaps are an index, not the source of truth: when an update fails the
+member's bitmaps are rebuilt from the records, and if that fails too it is
+logged and the check-in goes ahead. Migration 0008 builds everyone's
+bitmaps; to repair them by hand:
+
+    python -m bitmaps --rebuild                  # every member
+    python -m bitmaps --rebuild --user 123456    # one member, by telegram_id
+"""
+import logging
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+from bson import Binary
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from database import (
+    get_db,
+    get_collection,
+    user_ref,
+    User,
+    AttendanceRecord,
+    ATTENDANCE_BITMAPS_COLLECTION
+)
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('present', 'late', 'absent')
+
+DAYS_PER_YEAR = 366
+BITMAP_BYTES = (DAYS_PER_YEAR + 7) // 8
+
+# Optimistic update attempts before giving up on a bitmap write
+MAX_ATTEMPTS = 5
+
+
+def bitmap_id(user_id: Any, year: int) -> str:
+    """_id of a member's bitmaps for a year, e.g. '65f0c3...:2024'."""
+    return f"{user_ref(user_id)}:{year}"
+
+
+def day_bit(day: date) -> int:
+    """Bit index of a day within its year's bitmap."""
+    return day.timetuple().tm_yday - 1
+
+
+def decode(doc: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """The three bitmaps of a document as ints (bit n = day n)."""
+    return {
+        status: int.from_bytes(bytes(doc[status]), 'little') if doc and doc.get(status) is not None else 0
+        for status in STATUSES
+    }
+
+
+def encode(bits: Dict[str, int]) -> Dict[str, Binary]:
+    return {status: Binary(bits[status].to_bytes(BITMAP_BYTES, 'little')) for status in STATUSES}
+
+
+def bitmap_document(user_id: Any, year: int, bits: Dict[str, int]) -> Dict[str, Any]:
+    """A new attendance_bitmaps document."""
+    return {
+        '_id': bitmap_id(user_id, year),
+        'user_id': user_ref(user_id),
+        'year': year,
+        'version': 1,
+        'updated_at': datetime.now(timezone.utc),
+        **encode(bits)
+    }
+
+
+def year_bits(records: Iterable[AttendanceRecord]) -> Dict[int, Dict[str, int]]:
+    """One member's records as bitmaps per year."""
+    years: Dict[int, Dict[str, int]] = {}
+    for record in records:
+        if record.status not in STATUSES:
+            continue
+        day = record.date.date() if isinstance(record.date, datetime) else record.date
+        bits = years.setdefault(day.year, {status: 0 for status in STATUSES})
+        bits[record.status] |= 1 << day_bit(day)
+    return years
+
+
+def _write(user_id: Any, year: int, change) -> bool:
+    """
+    Read-modify-write of one bitmap document, guarded by its version.
+    change(bits) edits the decoded bitmaps in place.
+    """
+    collection = get_collection(ATTENDANCE_BITMAPS_COLLECTION)
+    _id = bitmap_id(user_id, year)
+    for _ in range(MAX_ATTEMPTS):
+        doc = collection.find_one({'_id': _id})
+        bits = decode(doc)
+        change(bits)
+        now = datetime.now(timezone.utc)
+        if doc is None:
+            try:
+                collection.insert_one(bitmap_document(user_id, year, bits))
+                return True
+            except DuplicateKeyError:
+                continue
+        result = collection.update_one(
+            {'_id': _id, 'version': doc.get('version')},
+            {'$set': {**encode(bits), 'updated_at': now}, '$inc': {'version': 1}}
+        )
+        if result.matched_count:
+            return True
+    return False
+
+
+def mark_day(user_id: Any, day: date, status: str) -> bool:
+    """
+    Set day's bit in the status bitmap and clear it in the other two. If
+    that fails the member's bitmaps are rebuilt from the records instead.
+    Errors are logged, not raised: the records stay authoritative.
+    """
+    if status not in STATUSES:
+        logger.warning(f"Not marking bitmap for unknown status {status!r}")
+        return False
+    bit = 1 << day_bit(day)
+
+    def change(bits):
+        for name in STATUSES:
+            bits[name] = bits[name] | bit if name == status else bits[name] & ~bit
+
+    try:
+        if _write(user_id, day.year, change):
+            return True
+        logger.warning(f"Attendance bitmap for {user_id} on {day} kept changing, rebuilding it")
+    except Exception as e:
+        logger.warning(f"Could not update attendance bitmap for {user_id} on {day}: {e}, rebuilding it")
+    try:
+        rebuild_bitmaps(user_id)
+        return True
+    except Exception as e:
+        logger.error(f"Could not rebuild attendance bitmaps for {user_id}: {e}; "
+                     f"run python -m bitmaps --rebuild to repair them")
+    return False
+
+
+def mark_days(user_ids: List[Any], day: date, status: str) -> int:
+    """
+    mark_day for many members at once (the daily close's absentees): one
+    read and one bulk_write, each update guarded by the version read. The
+    members whose bitmap changed in between go through mark_day one by one.
+    Returns how many were marked.
+    """
+    if not user_ids:
+        return 0
+    collection = get_collection(ATTENDANCE_BITMAPS_COLLECTION)
+    year = day.year
+    bit = 1 << day_bit(day)
+    docs = {doc['_id']: doc for doc in collection.find({'_id': {'$in': [bitmap_id(u, year) for u in user_ids]}})}
+    now = datetime.now(timezone.utc)
+
+    operations = []
+    for user_id in user_ids:
+        doc = docs.get(bitmap_id(user_id, year))
+        bits = decode(doc)
+        for name in STATUSES:
+            bits[name] = bits[name] | bit if name == status else bits[name] & ~bit
+        # A version mismatch turns the upsert into a duplicate key error for that member
+        operations.append(UpdateOne(
+            {'_id': bitmap_id(user_id, year),
+             'version': doc.get('version') if doc else {'$exists': False}},
+            {
+                '$set': {'user_id': user_ref(user_id), 'year': year, 'updated_at': now, **encode(bits)},
+                '$inc': {'version': 1}
+            },
+            upsert=True
+        ))
+
+    retry = []
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        retry = [user_ids[error['index']] for error in e.details.get('writeErrors', [])]
+    except Exception as e:
+        logger.warning(f"Could not update attendance bitmaps for {day}: {e}")
+        retry = list(user_ids)
+    failed = sum(1 for user_id in retry if not mark_day(user_id, day, status))
+    return len(user_ids) - failed
+
+
+def clear_day(day: date) -> int:
+    """Clear a day from every member's bitmaps (e.g. after its records were removed)."""
+    collection = get_collection(ATTENDANCE_BITMAPS_COLLECTION)
+    mask = ~(1 << day_bit(day))
+    now = datetime.now(timezone.utc)
+    operations = []
+    for doc in collection.find({'year': day.year}):
+        bits = {status: value & mask for status, value in decode(doc).items()}
+        operations.append(UpdateOne(
+            {'_id': doc['_id'], 'version': doc.get('version')},
+            {'$set': {**encode(bits), 'updated_at': now}, '$inc': {'version': 1}}
+        ))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def rebuild_operations(user_id: Any) -> List[UpdateOne]:
+    """
+    Writes that replace a member's bitmaps with ones computed from the
+    records. Each is guarded by the version read first, so a bitmap changed
+    by a check-in in between is not overwritten (the write fails instead).
+    """
+    collection = get_collection(ATTENDANCE_BITMAPS_COLLECTION)
+    versions = {doc['year']: doc.get('version') for doc in collection.find({'user_id': user_ref(user_id)},
+                                                                          {'year': 1, 'version': 1})}
+    with get_db() as db:
+        records = db.query(AttendanceRecord).filter(AttendanceRecord.user_id == user_id).all()
+    years = year_bits(records)
+
+    now = datetime.now(timezone.utc)
+    return [
+        UpdateOne(
+            {'_id': bitmap_id(user_id, year),
+             'version': versions[year] if year in versions else {'$exists': False}},
+            {
+                '$set': {'user_id': user_ref(user_id), 'year': year, 'updated_at': now, **encode(bits)},
+                '$inc': {'version': 1}
+            },
+            upsert=True
+        )
+        for year, bits in sorted(years.items())
+    ]
+
+
+def rebuild_bitmaps(user_id: Any) -> int:
+    """Recompute a member's bitmaps from the records. Returns the number of years written."""
+    operations = rebuild_operations(user_id)
+    if operations:
+        get_collection(ATTENDANCE_BITMAPS_COLLECTION).bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def rebuild_all_bitmaps() -> Dict[str, int]:
+    """Rebuild every member's bitmaps. Returns {'members', 'failed'}."""
+    with get_db() as db:
+        users = db.query(User).all()
+    failed = 0
+    for user in users:
+        try:
+            rebuild_bitmaps(user.id)
+        except Exception as e:
+            failed += 1
+            logger.warning(f"Could not rebuild attendance bitmaps for {user.id}: {e}")
+    return {'members': len(users), 'failed': failed}
+
+
+def _popcount(value: int) -> int:
+    return value.bit_count()
+
+
+def _range_mask(start: int, end: int) -> int:
+    """Bits start..end inclusive."""
+    return ((1 << (end - start + 1)) - 1) << start if end >= start else 0
+
+
+def _streaks(attended: int, absent: int, limit: int) -> Dict[str, int]:
+    """
+    Current and longest run of attended days over bits below limit. Days
+    with neither bit (no record: before joining, bot down) don't break a
+    run; an absence does.
+    """
+    longest = 0
+    start = 0
+    remaining = absent & ((1 << limit) - 1)
+    while remaining:
+        position = (remaining & -remaining).bit_length() - 1  # Lowest absence
+        longest = max(longest, _popcount(attended & _range_mask(start, position - 1)))
+        start = position + 1
+        remaining &= remaining - 1
+    current = _popcount(attended & _range_mask(start, limit - 1))
+    return {'current': current, 'longest': max(longest, current)}
+
+
+def _combine(docs: List[Dict[str, Any]], first_year: int) -> Dict[str, int]:
+    """A member's yearly bitmaps laid end to end, DAYS_PER_YEAR bits per year from first_year."""
+    combined = {status: 0 for status in STATUSES}
+    for doc in docs:
+        offset = (doc['year'] - first_year) * DAYS_PER_YEAR
+        for status, bits in decode(doc).items():
+            combined[status] |= bits << offset
+    return combined
+
+
+def summarise(docs: List[Dict[str, Any]], today: date) -> Dict[str, Any]:
+    """Stats for one member from their bitmap documents, as of today."""
+    docs = [doc for doc in docs if doc['year'] <= today.year]
+    first_year = min((doc['year'] for doc in docs), default=today.year)
+    combined = _combine(docs, first_year)
+    offset = (today.year - first_year) * DAYS_PER_YEAR
+    limit = offset + day_bit(today) + 1
+    attended = combined['present'] | combined['late']
+
+    this_year = _range_mask(offset, limit - 1)
+    this_month = _range_mask(offset + day_bit(today.replace(day=1)), limit - 1)
+    present = _popcount(combined['present'] & this_year)
+    late = _popcount(combined['late'] & this_year)
+    absent = _popcount(combined['absent'] & this_year)
+    recorded = present + late + absent
+    streaks = _streaks(attended, combined['absent'], limit)
+    return {
+        'year': today.year,
+        'present': present,
+        'late': late,
+        'absent': absent,
+        'rate': (present + late) / recorded if recorded else None,
+        'on_time_rate': present / recorded if recorded else None,
+        'current_streak': streaks['current'],
+        'longest_streak': streaks['longest'],
+        'missed_this_month': _popcount(combined['absent'] & this_month),
+        'late_this_month': _popcount(combined['late'] & this_month),
+    }
+
+
+def member_stats(user_id: Any, today: date) -> Dict[str, Any]:
+    """Attendance stats for one member (one indexed read of their bitmaps)."""
+    docs = list(get_collection(ATTENDANCE_BITMAPS_COLLECTION).find({'user_id': user_ref(user_id)}))
+    return summarise(docs, today)
+
+
+def stats_for_telegram_user(telegram_id: int, today: date) -> Optional[Dict[str, Any]]:
+    """{'user', **stats} for a member by telegram_id; None if they never checked in."""
+    with get_db() as db:
+        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    if user is None:
+        return None
+    return {'user': user, **member_stats(user.id, today)}
+
+
+def leaderboard(today: date, limit: int = 10, by: str = 'rate') -> List[Dict[str, Any]]:
+    """
+    Active members ranked by this year's attendance rate (ties by current
+    streak) or, with by='streak', by current streak. Streaks look back into
+    last year.
+    """
+    docs = get_collection(ATTENDANCE_BITMAPS_COLLECTION).find({'year': {'$in': [today.year - 1, today.year]}})
+    by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in docs:
+        by_user.setdefault(str(doc['user_id']), []).append(doc)
+
+    with get_db() as db:
+        users = {user.id: user for user in db.query(User).filter(User.is_active == True).all()}
+
+    rows = []
+    for user_id, user_docs in by_user.items():
+        user = users.get(user_id)
+        if user is None:
+            continue
+        stats = summarise(user_docs, today)
+        if stats['rate'] is None:
+            continue
+        rows.append({'user': user, **stats})
+
+    if by == 'streak':
+        rows.sort(key=lambda row: (row['current_streak'], row['rate']), reverse=True)
+    else:
+        rows.sort(key=lambda row: (row['rate'], row['current_streak']), reverse=True)
+    return rows[:limit]
+
+
+def _percent(value: Optional[float]) -> str:
+    return f"{value * 100:.0f}%" if value is not None else "n/a"
+
+
+def format_member_stats(name: str, stats: Dict[str, Any]) -> str:
+    """/me reply."""
+    days = stats['present'] + stats['late'] + stats['absent']
+    if not days:
+        return f"📈 {name}: no attendance recorded in {stats['year']} yet."
+    return (
+        f"📈 {name} - {stats['year']}\n\n"
+        f"Attendance: {_percent(stats['rate'])} ({stats['present'] + stats['late']}/{days} days)\n"
+        f"On time: {_percent(stats['on_time_rate'])} ({stats['present']} on time, {stats['late']} late)\n"
+        f"🔥 Current streak: {stats['current_streak']} day(s)\n"
+        f"🏆 Longest streak: {stats['longest_streak']} day(s)\n"
+        f"This month: {stats['missed_this_month']} missed, {stats['late_this_month']} late"
+    )
+
+
+def format_leaderboard(rows: List[Dict[str, Any]], year: int, by: str = 'rate') -> str:
+    """/leaderboard reply."""
+    from utils import format_user_name
+
+    title = "current streak" if by == 'streak' else "attendance rate"
+    message = f"🏆 Leaderboard {year} - {title}\n\n"
+    if not rows:
+        return message + "No attendance recorded yet."
+    for rank, row in enumerate(rows, 1):
+        message += (f"{rank}. {format_user_name(row['user'])} - {_percent(row['rate'])}, "
+                    f"streak {row['current_streak']}\n")
+    return message.rstrip('\n')
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Attendance bitmap maintenance")
+    parser.add_argument('--rebuild', action='store_true', help="Recompute bitmaps from the attendance records")
+    parser.add_argument('--user', type=int, help="Only this member (telegram_id)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if not args.rebuild:
+        parser.error("nothing to do (use --rebuild)")
+    if args.user is None:
+        print(json.dumps(rebuild_all_bitmaps(), indent=2))
+        return
+    with get_db() as db:
+        user = db.query(User).filter(User.telegram_id == args.user).first()
+    if user is None:
+        parser.error(f"no member with telegram_id {args.user}")
+    print(json.dumps({'member': user.id, 'years': rebuild_bitmaps(user.id)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,8 +10,8 @@ from telegram.ext import (
     filters,
     ContextTypes
 )
-from telegram.error import TelegramError
 from datetime import datetime, date
+import asyncio
 import os
 from dotenv import load_dotenv
 
@@ -19,17 +19,59 @@ from dotenv import load_dotenv
 # This ensures .env file is loaded if it exists, but won't override system env vars
 load_dotenv(override=False)
 
-from config import BOT_TOKEN, ADMIN_ID
-from attendance import get_or_create_user, record_attendance, force_mark_attendance
+from config import (
+    BOT_TOKEN,
+    ADMIN_ID,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    HTTP_HOST,
+    HTTP_PORT,
+    METRICS_ENABLED,
+    LOOP_WATCH_INTERVAL_SECONDS,
+    PROFILE_MAX_SECONDS,
+    TRACE_IN_REPORT,
+    CONCURRENT_UPDATES,
+    TELEGRAM_API_BASE_URL
+)
+from attendance import (
+    get_or_create_user,
+    record_attendance,
+    force_mark_attendance,
+    process_daily_attendance,
+    checkin_cache,
+    ALREADY_RECORDED_MESSAGE,
+    WINDOW_CLOSED_MESSAGE
+)
 from reports import (
     generate_daily_report,
-    format_daily_report_message,
-    export_daily_csv,
-    export_monthly_csv
+    format_daily_report_message
 )
 from scheduler import get_attendance_window_status, set_group_chat_id
-from database import get_db, Settings
+from database import get_db, Settings, db_scoped, get_scope_totals, query_plans
 from utils import format_user_name, get_phnom_penh_date
+from outbox import get_outbox
+from digest import get_failure_digest
+from coalescer import get_reply_coalescer, ALREADY_RECORDED, WINDOW_CLOSED, ERROR
+from http_server import HTTPServer
+from webhook import setup_webhook_routes, setup_status_routes
+from concurrency import user_locks, get_lanes, CHECKIN_LANE, BACKGROUND_LANE
+from metrics import timed, HANDLER_SECONDS, HANDLER_ERRORS, CHECKINS, CACHE_REQUESTS
+from loopwatch import get_loop_watchdog
+from profiling import get_sampler, get_memory_profiler
+from tracing import (
+    get_tracer,
+    traced_update,
+    span,
+    start_span,
+    annotate,
+    finish_with_future,
+    latency_summary,
+    format_latency_summary
+)
+from bitmaps import stats_for_telegram_user, leaderboard, format_member_stats, format_leaderboard
+from jobs import get_export_pool, submit_export_job, describe_job, DAILY_EXPORT, MONTHLY_EXPORT
 from reports import get_fine_amount
 
 # Configure logging
@@ -42,20 +84,32 @@ logger = logging.getLogger(__name__)
 # Global bot instance (for scheduler)
 bot_instance = None
 
+# /metrics and /health server in polling mode (webhook mode runs its own)
+status_server = None
+
 
 def is_admin(user_id: int) -> bool:
     """Check if user is admin."""
     return user_id == ADMIN_ID
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command."""
+    if update.effective_user:
+        # The user can receive private greetings now
+        get_failure_digest().mark_reachable(update.effective_user.id)
     await update.message.reply_text(
         "Hello! I'm the attendance bot. "
-        "Send '1' in the group chat between 09:00 and 10:00 AM to record your attendance."
+        "Send '1' in the group chat between 09:00 and 10:00 AM to record your attendance. "
+        "Use /me for your attendance stats and /leaderboard to compare."
     )
 
 
+@traced_update('checkin')
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def handle_attendance_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle '1' message for attendance."""
     try:
@@ -74,13 +128,6 @@ async def handle_attendance_message(update: Update, context: ContextTypes.DEFAUL
         if not update.message.text or update.message.text.strip() != '1':
             return
         
-        # Check if window is open
-        if not get_attendance_window_status():
-            await update.message.reply_text(
-                "⏰ Attendance window is closed. Please send '1' between 09:00 and 10:00 AM."
-            )
-            return
-        
         user = update.effective_user
         if not user:
             logger.warning("No user found in update")
@@ -90,47 +137,89 @@ async def handle_attendance_message(update: Update, context: ContextTypes.DEFAUL
         username = user.username
         full_name = user.full_name or f"{user.first_name} {user.last_name or ''}".strip()
         
-        # Record attendance
-        try:
-            success, message = record_attendance(
-                telegram_id, 
-                update.message.date,
-                username=username,
-                full_name=full_name
+        # Rejections are combined into one group message per burst
+        coalescer = get_reply_coalescer()
+        
+        # Check if window is open
+        if not get_attendance_window_status():
+            CHECKINS.labels('window_closed').inc()
+            annotate(outcome='window_closed')
+            coalescer.add(
+                update.message, WINDOW_CLOSED, telegram_id, full_name,
+                "⏰ Attendance window is closed. Please send '1' between 09:00 and 10:00 AM."
             )
+            return
+        
+        # Fast path: repeated '1' after a successful check-in needs no database access
+        if checkin_cache.contains(telegram_id):
+            CACHE_REQUESTS.labels('checkin', 'hit').inc()
+            CHECKINS.labels('duplicate').inc()
+            annotate(outcome='duplicate')
+            coalescer.add(update.message, ALREADY_RECORDED, telegram_id, full_name, ALREADY_RECORDED_MESSAGE)
+            return
+        CACHE_REQUESTS.labels('checkin', 'miss').inc()
+        
+        # Record attendance (serialized per user, off the event loop)
+        try:
+            with span('record_attendance'):
+                async with user_locks.hold(telegram_id):
+                    success, message = await get_lanes().run(
+                        CHECKIN_LANE,
+                        record_attendance,
+                        telegram_id,
+                        update.message.date,
+                        username=username,
+                        full_name=full_name
+                    )
         except Exception as e:
             logger.error(f"Error recording attendance for {telegram_id}: {e}")
-            await update.message.reply_text("❌ An error occurred while recording attendance. Please try again.")
+            CHECKINS.labels('error').inc()
+            annotate(outcome='error')
+            coalescer.add(
+                update.message, ERROR, telegram_id, full_name,
+                "❌ An error occurred while recording attendance. Please try again."
+            )
             return
         
         if success:
-            # Send greeting in private chat
-            try:
-                await context.bot.send_message(
-                    chat_id=telegram_id,
-                    text=f"Good morning, {full_name}! {message}"
+            # Send greeting in private chat (queued, so the handler doesn't wait on the API).
+            # Failures are collected into one admin digest instead of a DM each.
+            digest = get_failure_digest()
+            if digest.is_unreachable(telegram_id):
+                digest.record_skipped(telegram_id, full_name)
+            else:
+                # The trace stays open until the greeting is delivered
+                dm = start_span('dm')
+                sent = get_outbox().send_message(
+                    telegram_id,
+                    f"Good morning, {full_name}! {message}",
+                    on_failure=lambda _message, error: digest.record_failure(telegram_id, full_name, error)
                 )
-            except TelegramError as e:
-                logger.warning(f"Could not send private message to {telegram_id}: {e}")
-                # Still record attendance, just notify admin
-                try:
-                    await context.bot.send_message(
-                        chat_id=ADMIN_ID,
-                        text=f"⚠️ Could not send greeting to {full_name} (ID: {telegram_id}). Attendance still recorded."
-                    )
-                except Exception as admin_error:
-                    logger.error(f"Could not notify admin: {admin_error}")
+                finish_with_future(dm, sent)
+        elif message == ALREADY_RECORDED_MESSAGE:
+            CHECKINS.labels('duplicate').inc()
+            annotate(outcome='duplicate')
+            coalescer.add(update.message, ALREADY_RECORDED, telegram_id, full_name, message)
+        elif message == WINDOW_CLOSED_MESSAGE:
+            CHECKINS.labels('window_closed').inc()
+            annotate(outcome='window_closed')
+            coalescer.add(update.message, WINDOW_CLOSED, telegram_id, full_name, message)
         else:
-            await update.message.reply_text(message)
+            CHECKINS.labels('error').inc()
+            annotate(outcome='error')
+            coalescer.add(update.message, ERROR, telegram_id, full_name, message)
     except Exception as e:
         logger.error(f"Unexpected error in handle_attendance_message: {e}", exc_info=True)
+        annotate(outcome='error')
         try:
             if update and update.message:
-                await update.message.reply_text("❌ An error occurred. Please try again later.")
+                get_outbox().reply(update.message, "❌ An error occurred. Please try again later.")
         except:
             pass
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /report command."""
     try:
@@ -148,8 +237,12 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
         
         try:
-            report = generate_daily_report(report_date)
+            report = await get_lanes().run(BACKGROUND_LANE, generate_daily_report, report_date)
             message = format_daily_report_message(report, include_running_fines=True)
+            if TRACE_IN_REPORT:
+                summary = await asyncio.to_thread(latency_summary, report_date)
+                if summary:
+                    message += "\n\n" + format_latency_summary(summary)
             await update.message.reply_text(message)
         except Exception as e:
             logger.error(f"Error generating report: {e}", exc_info=True)
@@ -162,6 +255,168 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+async def dbstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /dbstats command: DB cost per handler and job since start."""
+    try:
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        totals = get_scope_totals()
+        if not totals:
+            await update.message.reply_text("No database activity recorded yet.")
+            return
+        
+        lines = ["🗄 DB cost per operation (avg per call)", ""]
+        ranked = sorted(totals.items(), key=lambda item: item[1]['commands'], reverse=True)
+        for name, stats in ranked[:20]:
+            calls = stats['calls'] or 1
+            lines.append(
+                f"{name}: {stats['calls']} call(s), {stats['commands'] / calls:.1f} cmds, "
+                f"{stats['time_ms'] / calls:.1f} ms, {stats['docs_returned'] / calls:.0f} docs"
+            )
+        
+        flagged = {shape: plan for shape, plan in query_plans.get_plans().items() if plan['issues']}
+        if flagged:
+            lines.extend(["", "⚠️ Query plans without a usable index"])
+            for shape, plan in sorted(flagged.items()):
+                lines.append(f"{shape}: {', '.join(plan['issues'])}, {plan['docs_examined']} docs examined")
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error in dbstats_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
+async def blocking_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /blocking command: where the event loop was blocked since start."""
+    try:
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        watchdog = get_loop_watchdog()
+        stats = watchdog.stats()
+        lag = stats['lag_ms']
+        lines = [f"🐢 Event loop stalls over {stats['threshold_ms']:.0f} ms: {stats['stalls']}"]
+        if lag.get('count'):
+            lines.append(f"Lag p50 {lag['p50']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+        sites = watchdog.top(10)
+        if not sites:
+            lines.append("No blocking call sites recorded yet.")
+        for n, site in enumerate(sites, start=1):
+            lines.append("")
+            lines.append(f"{n}. {site['operation']} at {site['site']}")
+            lines.append(
+                f"   {site['stalls']} stall(s), {site['blocked_ms'] / 1000:.1f} s total, "
+                f"worst {site['worst_ms']:.0f} ms, in {site['leaf']}"
+            )
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error in blocking_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /profile [seconds] command: sample all threads and send the collapsed stacks."""
+    try:
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        seconds = 30.0
+        if context.args:
+            try:
+                seconds = float(context.args[0])
+            except ValueError:
+                await update.message.reply_text("❌ Usage: /profile [seconds]")
+                return
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+            await update.message.reply_text(f"❌ Seconds must be between 1 and {PROFILE_MAX_SECONDS:.0f}")
+            return
+        
+        sampler = get_sampler()
+        if sampler.running:
+            await update.message.reply_text("⏳ A profile is already running.")
+            return
+        
+        await update.message.reply_text(f"⏱ Profiling for {seconds:.0f}s...")
+        result = await asyncio.to_thread(sampler.run, seconds)
+        
+        lines = [f"🔥 {result['samples']} samples over {result['seconds']}s"]
+        for function, count in result['hot'][:5]:
+            lines.append(f"{count / result['samples']:.0%} {function}")
+        lines.append("Open in speedscope.app or flamegraph.pl")
+        get_outbox().send_document(update.effective_chat.id, result['path'], caption="\n".join(lines)[:1024])
+    except Exception as e:
+        logger.error(f"Error in profile_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
+async def memprofile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /memprofile [stop] command: tracemalloc top allocation sites and growth."""
+    try:
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        profiler = get_memory_profiler()
+        if context.args and context.args[0].lower() == 'stop':
+            profiler.stop()
+            await update.message.reply_text("✅ Memory tracing stopped.")
+            return
+        
+        if not profiler.tracing:
+            await asyncio.to_thread(profiler.start)
+            await update.message.reply_text(
+                "✅ Memory tracing started. Run /memprofile again later to see allocation sites "
+                "and growth, and /memprofile stop when done (tracing slows the bot down)."
+            )
+            return
+        
+        result = await asyncio.to_thread(profiler.report)
+        caption = f"🧠 Traced {result['current_mib']} MiB (peak {result['peak_mib']} MiB)"
+        if result['since']:
+            caption += f", +{result['growth_kib']} KiB since {result['since']:%H:%M:%S}"
+        else:
+            # Tracing was started outside /memprofile: this report is the first baseline
+            caption += ", baseline taken; run /memprofile again to see growth"
+        get_outbox().send_document(update.effective_chat.id, result['path'], caption=caption)
+    except Exception as e:
+        logger.error(f"Error in memprofile_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
+async def submit_export(update: Update, kind: str, params: dict):
+    """Submit an export job and tell the admin what will happen."""
+    job, state = await asyncio.to_thread(submit_export_job, kind, params, update.effective_chat.id)
+    
+    if state == 'cached':
+        # Same export finished moments ago, send that file again
+        get_outbox().send_document(update.effective_chat.id, job['filepath'], caption=describe_job(job))
+        await update.message.reply_text(f"✅ {describe_job(job)} is ready (job {job['_id']}).")
+        return
+    
+    get_export_pool().wake()
+    if state == 'running':
+        await update.message.reply_text(f"⏳ This export is already running (job {job['_id']}). The file will be sent here when it's ready.")
+    else:
+        await update.message.reply_text(f"🕒 Export queued (job {job['_id']}). The file will be sent here when it's ready.")
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def monthly_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /monthly command."""
     try:
@@ -176,20 +431,16 @@ async def monthly_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         try:
             year, month = map(int, context.args[0].split('-'))
+            if not 1 <= month <= 12:
+                raise ValueError("Month must be between 1 and 12")
         except ValueError:
             await update.message.reply_text("❌ Invalid date format. Use YYYY-MM")
             return
         
         try:
-            filepath = export_monthly_csv(year, month)
-            with open(filepath, 'rb') as f:
-                await update.message.reply_document(
-                    document=f,
-                    filename=os.path.basename(filepath),
-                    caption=f"Monthly report for {year}-{month:02d}"
-                )
+            await submit_export(update, MONTHLY_EXPORT, {'year': year, 'month': month})
         except Exception as e:
-            logger.error(f"Error generating monthly report: {e}", exc_info=True)
+            logger.error(f"Error submitting monthly export: {e}", exc_info=True)
             await update.message.reply_text(f"❌ Error generating report: {str(e)}")
     except Exception as e:
         logger.error(f"Unexpected error in monthly_command: {e}", exc_info=True)
@@ -199,6 +450,8 @@ async def monthly_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def setfine_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /setfine command."""
     try:
@@ -240,6 +493,8 @@ async def setfine_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def set_window_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /setwindow command."""
     try:
@@ -300,6 +555,8 @@ async def set_window_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             pass
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def force_mark_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /forcemark command."""
     try:
@@ -322,7 +579,8 @@ async def force_mark_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
         
         try:
-            success = force_mark_attendance(user_id, status)
+            async with user_locks.hold(user_id):
+                success = await get_lanes().run(CHECKIN_LANE, force_mark_attendance, user_id, status)
             
             if success:
                 await update.message.reply_text(f"✅ Attendance marked as {status} for user {user_id}")
@@ -339,6 +597,54 @@ async def force_mark_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             pass
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
+async def reclose_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /reclose command (force recomputation of a daily close)."""
+    try:
+        if not is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        if not context.args:
+            await update.message.reply_text("❌ Usage: /reclose <YYYY-MM-DD>")
+            return
+        
+        try:
+            close_date = datetime.strptime(context.args[0], '%Y-%m-%d').date()
+        except ValueError:
+            await update.message.reply_text("❌ Invalid date format. Use YYYY-MM-DD")
+            return
+        
+        if close_date > get_phnom_penh_date():
+            await update.message.reply_text("❌ Cannot close a date in the future.")
+            return
+        
+        try:
+            from scheduler import group_chat_id
+            marker = await get_lanes().run(
+                BACKGROUND_LANE, process_daily_attendance, close_date, group_id=group_chat_id, force=True
+            )
+            counts = (marker or {}).get('counts', {})
+            await update.message.reply_text(
+                f"✅ Attendance for {close_date} recomputed.\n"
+                f"Active users: {counts.get('active_users', 0)}\n"
+                f"Already recorded: {counts.get('already_recorded', 0)}\n"
+                f"Marked absent: {counts.get('marked_absent', 0)}"
+            )
+        except Exception as e:
+            logger.error(f"Error recomputing daily close: {e}", exc_info=True)
+            await update.message.reply_text("❌ An error occurred while recomputing attendance.")
+    except Exception as e:
+        logger.error(f"Unexpected error in reclose_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
 async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /export command."""
     try:
@@ -356,15 +662,9 @@ async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
         
         try:
-            filepath = export_daily_csv(export_date)
-            with open(filepath, 'rb') as f:
-                await update.message.reply_document(
-                    document=f,
-                    filename=os.path.basename(filepath),
-                    caption=f"Daily attendance report for {export_date}"
-                )
+            await submit_export(update, DAILY_EXPORT, {'date': export_date.strftime('%Y-%m-%d')})
         except Exception as e:
-            logger.error(f"Error exporting CSV: {e}", exc_info=True)
+            logger.error(f"Error submitting daily export: {e}", exc_info=True)
             await update.message.reply_text(f"❌ Error exporting CSV: {str(e)}")
     except Exception as e:
         logger.error(f"Unexpected error in export_command: {e}", exc_info=True)
@@ -374,6 +674,49 @@ async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
+async def me_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /me command (the sender's own attendance stats)."""
+    try:
+        if not update.effective_user:
+            return
+        stats = await get_lanes().run(
+            BACKGROUND_LANE, stats_for_telegram_user, update.effective_user.id, get_phnom_penh_date()
+        )
+        if stats is None:
+            await update.message.reply_text("You have no attendance yet. Send '1' in the group to check in.")
+            return
+        await update.message.reply_text(format_member_stats(format_user_name(stats['user']), stats))
+    except Exception as e:
+        logger.error(f"Error in me_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+@db_scoped
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /leaderboard [rate|streak] command."""
+    try:
+        by = context.args[0].lower() if context.args else 'rate'
+        if by not in ('rate', 'streak'):
+            await update.message.reply_text("❌ Usage: /leaderboard [rate|streak]")
+            return
+        
+        today = get_phnom_penh_date()
+        rows = await get_lanes().run(BACKGROUND_LANE, leaderboard, today, 10, by)
+        await update.message.reply_text(format_leaderboard(rows, today.year, by))
+    except Exception as e:
+        logger.error(f"Error in leaderboard_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+        except:
+            pass
+
+
 def setup_handlers(application: Application):
     """Setup bot handlers."""
     # Commands
@@ -384,6 +727,13 @@ def setup_handlers(application: Application):
     application.add_handler(CommandHandler("setwindow", set_window_command))
     application.add_handler(CommandHandler("forcemark", force_mark_command))
     application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("reclose", reclose_command))
+    application.add_handler(CommandHandler("dbstats", dbstats_command))
+    application.add_handler(CommandHandler("blocking", blocking_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("memprofile", memprofile_command))
+    application.add_handler(CommandHandler("me", me_command))
+    application.add_handler(CommandHandler("leaderboard", leaderboard_command))
     
     # Message handler for attendance
     application.add_handler(
@@ -393,15 +743,26 @@ def setup_handlers(application: Application):
 
 async def post_init(application: Application):
     """Post-initialization tasks."""
-    global bot_instance
+    global bot_instance, status_server
     bot_instance = application
     
     try:
+        # Watch the event loop for blocking calls
+        if LOOP_WATCH_INTERVAL_SECONDS > 0:
+            get_loop_watchdog().start()
+        
+        # Start outbound message queue and the trace exporter
+        get_outbox().start(application.bot)
+        get_tracer().start()
+        get_failure_digest().start()
+        
         # Initialize database
         from database import init_db
         try:
-            init_db()
+            # Unique indexes build now, the rest on a separate thread; unchanged specs skip index work entirely
+            init_db(background=True)
             logger.info("Database initialized successfully")
+            get_export_pool().start()
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}", exc_info=True)
             # Don't crash - bot can still run, but database operations will fail
@@ -418,6 +779,16 @@ async def post_init(application: Application):
             # Don't crash - bot can still run without scheduler
             logger.warning("Bot will continue but scheduled tasks may not work")
         
+        # Metrics and health endpoints (webhook mode serves them on the webhook server)
+        if BOT_MODE != 'webhook' and METRICS_ENABLED:
+            try:
+                status_server = HTTPServer(HTTP_HOST, HTTP_PORT)
+                setup_status_routes(status_server, application)
+                await status_server.start()
+            except Exception as e:
+                status_server = None
+                logger.error(f"Failed to start metrics server: {e}", exc_info=True)
+        
         logger.info("Bot initialized successfully")
     except Exception as e:
         logger.error(f"Error in post_init: {e}", exc_info=True)
@@ -425,6 +796,79 @@ async def post_init(application: Application):
         logger.warning("Bot initialized with errors - some features may not work")
 
 
+async def post_stop(application: Application):
+    """Drain outgoing work while the bot can still reach the Bot API."""
+    try:
+        await get_export_pool().stop()
+        get_failure_digest().stop()
+        get_reply_coalescer().flush_all()
+        await get_outbox().stop()
+        # Greeting spans are finished now, so the last traces can be exported
+        get_tracer().stop()
+    except Exception as e:
+        logger.error(f"Error stopping outbox: {e}", exc_info=True)
+
+
+async def post_shutdown(application: Application):
+    """Shutdown tasks."""
+    if status_server:
+        await status_server.stop()
+    await get_loop_watchdog().stop()
+    get_lanes().shutdown()
+
+
+async def run_webhook(application: Application):
+    """Serve updates over the built-in HTTP server until SIGINT/SIGTERM."""
+    import secrets
+    import signal
+    
+    secret_token = WEBHOOK_SECRET
+    if WEBHOOK_URL and not secret_token:
+        # A public webhook without a secret would accept forged updates (e.g. "from" the admin)
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET not set, using a random secret for this run")
+    
+    server = HTTPServer(HTTP_HOST, HTTP_PORT)
+    setup_webhook_routes(server, application, secret_token=secret_token)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Signal handlers are not available on Windows event loops
+            pass
+    
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Webhook registered with Telegram")
+        else:
+            logger.warning("WEBHOOK_URL not set, skipping setWebhook (local testing mode)")
+        
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
 def main():
     """Main entry point."""
     import sys
@@ -465,14 +909,28 @@ def main():
         sys.exit(1)
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     
     # Setup handlers
     setup_handlers(application)
     
     # Run bot
-    logger.info("Starting bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        logger.info(f"Starting bot in webhook mode on {HTTP_HOST}:{HTTP_PORT}{WEBHOOK_PATH}...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Starting bot...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+"""
+Coalesced group replies for the check-in burst.
+
+Rejections in the group ("already recorded", "window closed", errors) are
+collected for a short window and posted as one combined message per chat,
+instead of one reply per incoming '1'.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+from config import GROUP_REPLY_WINDOW_SECONDS
+from outbox import get_outbox
+from utils import join_names
+
+logger = logging.getLogger(__name__)
+
+# Rejection reasons
+ALREADY_RECORDED = 'already_recorded'
+WINDOW_CLOSED = 'window_closed'
+ERROR = 'error'
+
+HEADINGS = {
+    ALREADY_RECORDED: "✅ Already recorded today:",
+    WINDOW_CLOSED: "⏰ Attendance window is closed. Please send '1' between 09:00 and 10:00 AM.\nNot recorded:",
+    ERROR: "❌ An error occurred while recording attendance. Please try again:",
+}
+
+# Characters of names listed per reason; all three sections and their
+# headings stay under Telegram's 4096 chars
+NAMES_BUDGET = 1200
+# Longest single name listed
+MAX_NAME_CHARS = 100
+
+
+class GroupReplyCoalescer:
+    """Collects rejection replies per chat and sends them as one message."""
+
+    def __init__(self, window: float = GROUP_REPLY_WINDOW_SECONDS):
+        self.window = window
+        # chat_id -> reason -> telegram_id -> (name, message_id, original text)
+        self._pending: Dict[int, Dict[str, Dict[int, Tuple[str, int, str]]]] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self.received = 0
+        self.sent = 0
+
+    def add(self, message, reason: str, telegram_id: int, name: str, text: str):
+        """Queue a rejection reply to an incoming group message."""
+        self.received += 1
+        chat_id = message.chat_id
+        pending = self._pending.setdefault(chat_id, {})
+        pending.setdefault(reason, {})[telegram_id] = (name, message.message_id, text)
+        if chat_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[chat_id] = loop.call_later(self.window, self.flush, chat_id)
+
+    def flush(self, chat_id: int):
+        """Send the combined reply for a chat."""
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        pending = self._pending.pop(chat_id, None)
+        if not pending:
+            return
+
+        entries = [entry for by_user in pending.values() for entry in by_user.values()]
+        outbox = get_outbox()
+        self.sent += 1
+        if len(entries) == 1:
+            # A lone rejection keeps the old behaviour: a direct reply
+            _name, message_id, text = entries[0]
+            outbox.send_message(
+                chat_id,
+                text,
+                reply_to_message_id=message_id,
+                allow_sending_without_reply=True
+            )
+            return
+
+        sections = []
+        for reason, by_user in pending.items():
+            names = [name for name, _, _ in by_user.values()]
+            listed = join_names(names, NAMES_BUDGET, MAX_NAME_CHARS)
+            sections.append(f"{HEADINGS.get(reason, reason)} {listed}")
+        outbox.send_message(chat_id, '\n\n'.join(sections))
+
+    def flush_all(self):
+        """Send everything that is pending (e.g. at shutdown)."""
+        for chat_id in list(self._pending):
+            self.flush(chat_id)
+
+
+# Global coalescer instance
+_coalescer: Optional[GroupReplyCoalescer] = None
+
+
+def get_reply_coalescer() -> GroupReplyCoalescer:
+    """Get or create the global group reply coalescer."""
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = GroupReplyCoalescer()
+    return _coalescer
@@ -0,0 +1,182 @@
+"""
+Concurrency primitives for update handling.
+
+Blocking handler work (pymongo, pandas) runs on priority lanes: check-ins go
+on a high-priority lane with its own threads, while reports and exports go
+on a background lane with bounded parallelism that waits for in-flight
+check-ins to drain before starting.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Hashable, List, Optional
+from config import CHECKIN_WORKERS, EXPORT_CONCURRENCY, BACKGROUND_MAX_DEFER_SECONDS
+from metrics import LANE_QUEUED, LANE_RUNNING, LANE_WAIT_MS
+
+logger = logging.getLogger(__name__)
+
+# Lane names
+CHECKIN_LANE = 'checkin'
+BACKGROUND_LANE = 'background'
+
+
+class KeyedLock:
+    """Per-key asyncio locks, created on demand and dropped once unused."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        """Hold the lock for a key (e.g. a telegram_id)."""
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class Lane:
+    """A class of handler work with its own threads and statistics."""
+
+    def __init__(self, name: str, workers: int, limit: Optional[int] = None, yields: bool = False):
+        self.name = name
+        # Never start more calls than there are threads: extra calls wait in the
+        # scheduler, where they show up in queued and wait time, instead of
+        # sitting unseen in the executor's queue
+        self.limit = min(limit, workers) if limit is not None else workers
+        self.yields = yields
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"lane-{name}")
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+    def record_wait(self, seconds: float):
+        """Record how long a job waited to start."""
+        self.wait_total += seconds
+        self.wait_last = seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth and wait time for this lane."""
+        started = self.completed + self.running
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'wait_avg_ms': round(self.wait_total / started * 1000, 2) if started else 0.0,
+            'wait_max_ms': round(self.wait_max * 1000, 2),
+            'wait_last_ms': round(self.wait_last * 1000, 2),
+        }
+
+
+class LaneScheduler:
+    """Runs blocking callables on priority lanes."""
+
+    def __init__(self, checkin_workers: int = CHECKIN_WORKERS, background_limit: int = EXPORT_CONCURRENCY,
+                 max_defer: float = BACKGROUND_MAX_DEFER_SECONDS):
+        self.max_defer = max_defer
+        self.lanes = {
+            CHECKIN_LANE: Lane(CHECKIN_LANE, workers=checkin_workers),
+            BACKGROUND_LANE: Lane(BACKGROUND_LANE, workers=background_limit, limit=background_limit, yields=True),
+        }
+        self._changed: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def _priority_busy(self) -> bool:
+        """Whether any non-yielding lane has queued or running work."""
+        return any(lane.queued or lane.running for lane in self.lanes.values() if not lane.yields)
+
+    def _can_start(self, lane: Lane, deadline: float, now: float) -> bool:
+        if lane.running >= lane.limit:
+            return False
+        if lane.yields and self._priority_busy() and now < deadline:
+            return False
+        return True
+
+    async def run(self, lane_name: str, func: Callable, *args, **kwargs):
+        """Run func(*args, **kwargs) in a worker thread on the given lane."""
+        lane = self.lanes[lane_name]
+        loop = asyncio.get_running_loop()
+        enqueued = loop.time()
+        deadline = enqueued + self.max_defer
+        changed = self._condition()
+
+        lane.queued += 1
+        try:
+            if not self._can_start(lane, deadline, enqueued):
+                async with changed:
+                    while not self._can_start(lane, deadline, loop.time()):
+                        # Wake at the deadline too, so deferred work can't starve
+                        remaining = deadline - loop.time()
+                        timeout = remaining if lane.yields and remaining > 0 else None
+                        try:
+                            await asyncio.wait_for(changed.wait(), timeout=timeout)
+                        except asyncio.TimeoutError:
+                            pass
+        finally:
+            lane.queued -= 1
+
+        lane.record_wait(loop.time() - enqueued)
+        lane.running += 1
+        try:
+            # Carry context variables into the worker thread, like asyncio.to_thread
+            call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+            return await loop.run_in_executor(lane.executor, call)
+        finally:
+            lane.running -= 1
+            lane.completed += 1
+            async with changed:
+                changed.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-lane queue depth and wait times."""
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    def shutdown(self):
+        """Stop the lane thread pools."""
+        for lane in self.lanes.values():
+            lane.executor.shutdown(wait=False)
+
+
+# Serializes attendance writes per telegram_id so a double tap can't race
+user_locks = KeyedLock()
+
+_lanes: Optional[LaneScheduler] = None
+
+
+def get_lanes() -> LaneScheduler:
+    """Get or create the global lane scheduler."""
+    global _lanes
+    if _lanes is None:
+        _lanes = LaneScheduler()
+    return _lanes
+
+
+def _lane_stat(key: str):
+    """Gauge callback reading one stat from every lane."""
+    return lambda: {(name,): stats[key] for name, stats in get_lanes().stats().items()}
+
+
+LANE_QUEUED.set_function(_lane_stat('queued'))
+LANE_RUNNING.set_function(_lane_stat('running'))
+LANE_WAIT_MS.set_function(_lane_stat('wait_avg_ms'))
@@ -17,9 +17,74 @@ try:
 except (ValueError, TypeError):
     ADMIN_ID = 0
 
+# Bot API server (point at fake_telegram.py for offline load tests)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org').rstrip('/')
+
+# Update delivery: 'polling' or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL; setWebhook is skipped when unset
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_RECORD_FILE = os.getenv('WEBHOOK_RECORD_FILE')  # Append received updates here for replay
+HTTP_HOST = os.getenv('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = int(os.getenv('PORT', os.getenv('HTTP_PORT', '8080')))
+# Serve /metrics and /health in polling mode too (always served in webhook mode)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Event loop watchdog: timer interval, and the lag (ms) at which the blocking stack is captured (0 disables it)
+LOOP_WATCH_INTERVAL_SECONDS = float(os.getenv('LOOP_WATCH_INTERVAL_SECONDS', '0.1'))
+LOOP_STALL_THRESHOLD_MS = float(os.getenv('LOOP_STALL_THRESHOLD_MS', '200'))
+# On-demand profiling (/profile, /memprofile): output directory, sampling interval, longest run, traceback depth
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '10'))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '300'))
+MEMPROFILE_FRAMES = int(os.getenv('MEMPROFILE_FRAMES', '10'))
+# Check-in tracing: fraction of check-ins traced, export ('', 'file' or 'otlp'), and the latency section in /report
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '').lower()
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces/spans.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_IN_REPORT = os.getenv('TRACE_IN_REPORT', 'false').lower() in ('1', 'true', 'yes')
+
+# Concurrency: updates handled in parallel, and parallel admin exports/reports
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', '1'))
+
+# Priority lanes: worker threads for check-ins, and how long background work
+# may be held back while check-ins are in flight before it runs anyway
+CHECKIN_WORKERS = int(os.getenv('CHECKIN_WORKERS', '16'))
+BACKGROUND_MAX_DEFER_SECONDS = float(os.getenv('BACKGROUND_MAX_DEFER_SECONDS', '30'))
+
+# Background export jobs (a running job's lease is renewed every third of
+# EXPORT_JOB_LEASE_SECONDS; a job whose lease runs out is requeued)
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '1'))
+EXPORT_JOB_POLL_SECONDS = float(os.getenv('EXPORT_JOB_POLL_SECONDS', '30'))
+EXPORT_JOB_LEASE_SECONDS = float(os.getenv('EXPORT_JOB_LEASE_SECONDS', '120'))
+EXPORT_JOB_MAX_ATTEMPTS = int(os.getenv('EXPORT_JOB_MAX_ATTEMPTS', '2'))
+EXPORT_CACHE_SECONDS = float(os.getenv('EXPORT_CACHE_SECONDS', '300'))  # Reuse finished exports this long
+
 # Database
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 DATABASE_NAME = os.getenv('DATABASE_NAME', 'BongTech_db')
+# Attendance layout: 'records' (one document per check-in) or 'buckets' (one document per member per month)
+ATTENDANCE_STORAGE = os.getenv('ATTENDANCE_STORAGE', 'records').lower()
+# Log an operation's DB cost when it issues this many commands, or repeats one query shape this often (N+1)
+DB_SCOPE_WARN_COMMANDS = int(os.getenv('DB_SCOPE_WARN_COMMANDS', '50'))
+DB_N_PLUS_ONE_THRESHOLD = int(os.getenv('DB_N_PLUS_ONE_THRESHOLD', '10'))
+# QueryBuilder reads slower than this (ms) are logged with their filter shape (0 disables)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+# Fraction of reads run through explain() to flag collection scans and in-memory sorts
+# (slow reads are always explained); each query shape at most once per interval
+EXPLAIN_SAMPLE_RATE = float(os.getenv('EXPLAIN_SAMPLE_RATE', '0'))
+EXPLAIN_INTERVAL_SECONDS = float(os.getenv('EXPLAIN_INTERVAL_SECONDS', '3600'))
+# Drop indexes missing from migrations/indexes.py once $indexStats shows no use for this many days
+INDEX_DROP_UNUSED = os.getenv('INDEX_DROP_UNUSED', 'false').lower() in ('1', 'true', 'yes')
+INDEX_UNUSED_MIN_DAYS = float(os.getenv('INDEX_UNUSED_MIN_DAYS', '14'))
+# Document migrations (migrations/runner.py): run pending ones at boot, documents per batch,
+# and the largest fraction of wall time spent migrating (the rest is paused between batches)
+MIGRATE_ON_BOOT = os.getenv('MIGRATE_ON_BOOT', 'true').lower() in ('1', 'true', 'yes')
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '500'))
+MIGRATION_MAX_DUTY = float(os.getenv('MIGRATION_MAX_DUTY', '0.5'))
 
 # Timezone
 TIMEZONE = pytz.timezone(os.getenv('TZ', 'Asia/Phnom_Penh'))
@@ -33,6 +98,25 @@ ATTENDANCE_WINDOW_END = os.getenv('ATTENDANCE_WINDOW_END', '10:00')
 
 # Report Time
 REPORT_TIME = os.getenv('REPORT_TIME', '10:05')
+# A daily close still 'processing' after this many seconds (crash or redeploy mid-close) can be taken over
+DAILY_CLOSE_LEASE_SECONDS = float(os.getenv('DAILY_CLOSE_LEASE_SECONDS', '900'))
+
+# Outbound message queue (Telegram allows ~30 msg/s overall, ~1 msg/s per chat, ~20 msg/min per group)
+OUTBOX_MAX_SIZE = int(os.getenv('OUTBOX_MAX_SIZE', '1000'))
+OUTBOX_MAX_INFLIGHT = int(os.getenv('OUTBOX_MAX_INFLIGHT', '100'))
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '25'))
+OUTBOX_CHAT_INTERVAL = float(os.getenv('OUTBOX_CHAT_INTERVAL', '1.0'))
+OUTBOX_GROUP_INTERVAL = float(os.getenv('OUTBOX_GROUP_INTERVAL', '3.0'))
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '3'))
+
+# Live check-in status message: seconds between edits (0 disables it)
+LIVE_STATUS_INTERVAL_SECONDS = float(os.getenv('LIVE_STATUS_INTERVAL_SECONDS', '5'))
+
+# Rejection replies in the group are combined over this many seconds
+GROUP_REPLY_WINDOW_SECONDS = float(os.getenv('GROUP_REPLY_WINDOW_SECONDS', '2'))
+
+# Admin digest of failed private greetings (seconds between flushes)
+DIGEST_INTERVAL_SECONDS = float(os.getenv('DIGEST_INTERVAL_SECONDS', '300'))
 
 
 def parse_time(time_str: str) -> time:
@@ -1,15 +1,36 @@
 """
 Database models and session management for the attendance bot using MongoDB.
 """
-from datetime import date, datetime, timezone
-from pymongo import MongoClient
+from datetime import date, datetime, timedelta, timezone
+from pymongo import MongoClient, ReturnDocument, monitoring
 from pymongo.collection import Collection
 from pymongo.database import Database
 from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter
+import asyncio
+import functools
+import logging
+import operator
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
+import bson
 from bson import ObjectId
+from config import (
+    ATTENDANCE_STORAGE,
+    DAILY_CLOSE_LEASE_SECONDS,
+    DB_SCOPE_WARN_COMMANDS,
+    DB_N_PLUS_ONE_THRESHOLD,
+    SLOW_QUERY_MS,
+    EXPLAIN_SAMPLE_RATE,
+    EXPLAIN_INTERVAL_SECONDS
+)
+from metrics import DB_COMMAND_SECONDS, DB_COMMAND_ERRORS, SLOW_QUERIES, QUERY_PLAN_ISSUES
 
 
 class Column:
@@ -49,13 +70,328 @@ DATABASE_NAME = os.getenv('DATABASE_NAME', 'BongTech_db')
 _client: Optional[MongoClient] = None
 _db: Optional[Database] = None
 
+logger = logging.getLogger(__name__)
+
+# Operation currently accumulating DB cost (set per handler / job)
+_current_scope: ContextVar[Optional['DBScope']] = ContextVar('db_scope', default=None)
+
+# Connection housekeeping that bot code does not issue
+IGNORED_COMMANDS = {'ping', 'hello', 'isMaster', 'ismaster', 'endSessions', 'buildInfo', 'saslStart', 'saslContinue'}
+
+# Where each command keeps its filter
+FILTER_FIELDS = {'find': 'filter', 'findAndModify': 'query', 'count': 'query', 'distinct': 'query'}
+
+
+class DBScope:
+    """DB cost of one logical operation. Nested scopes also charge their parents."""
+
+    def __init__(self, name: str, parent: 'DBScope' = None, track_bytes: bool = False):
+        self.name = name
+        self.parent = parent
+        self.track_bytes = track_bytes or bool(parent and parent.track_bytes)
+        self.commands = Counter()
+        self.shapes = Counter()
+        self.time_ms = 0.0
+        self.docs_returned = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total(self) -> int:
+        """Number of commands issued."""
+        return sum(self.commands.values())
+
+    def record(self, shape: Tuple, duration_ms: float, docs: int, sent: int = 0, received: int = 0):
+        """Charge one command to this scope and its parents."""
+        scope = self
+        while scope is not None:
+            with scope._lock:
+                scope.commands[shape[0]] += 1
+                scope.shapes[shape] += 1
+                scope.time_ms += duration_ms
+                scope.docs_returned += docs
+                scope.bytes_sent += sent
+                scope.bytes_received += received
+            scope = scope.parent
+
+    def repeated_shapes(self, threshold: int = DB_N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, int]]:
+        """Query shapes issued at least threshold times (likely N+1 loops)."""
+        return [(format_shape(shape), count) for shape, count in self.shapes.most_common()
+                if count >= threshold]
+
+    def summary(self) -> Dict[str, Any]:
+        """Plain dict of the collected numbers."""
+        return {
+            'commands': self.total,
+            'by_command': dict(self.commands),
+            'time_ms': round(self.time_ms, 2),
+            'docs_returned': self.docs_returned,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'repeated_shapes': self.repeated_shapes(),
+        }
+
+
+def command_shape(command_name: str, command: Dict[str, Any]) -> Tuple:
+    """(command, collection, filter fields) identifying a query pattern."""
+    collection = command.get(command_name)
+    if command_name == 'update':
+        query = (command.get('updates') or [{}])[0].get('q')
+    elif command_name == 'delete':
+        query = (command.get('deletes') or [{}])[0].get('q')
+    elif command_name == 'aggregate':
+        first = (command.get('pipeline') or [{}])[0]
+        query = first.get('$match')
+    else:
+        query = command.get(FILTER_FIELDS.get(command_name, ''), None)
+    fields = tuple(sorted(query)) if isinstance(query, dict) else ()
+    return command_name, collection if isinstance(collection, str) else None, fields
+
+
+def format_shape(shape: Tuple) -> str:
+    """Readable form of a query shape, e.g. find attendance_records{date,user_id}."""
+    command_name, collection, fields = shape
+    return f"{command_name} {collection or '?'}{{{','.join(fields)}}}"
+
+
+def reply_docs(reply: Dict[str, Any]) -> int:
+    """Documents returned in a command reply."""
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if 'value' in reply:
+        return 1 if reply['value'] else 0
+    return 0
+
+
+def account_command(command_name: str, collection: Optional[str], query: Optional[Dict], duration_ms: float,
+                    docs: int = 0):
+    """Charge a command to the current scope (for clients without command monitoring)."""
+    scope = _current_scope.get()
+    if scope is not None:
+        fields = tuple(sorted(query)) if isinstance(query, dict) else ()
+        scope.record((command_name, collection, fields), duration_ms, docs)
+
+
+class CommandAccounting(monitoring.CommandListener):
+    """pymongo command listener: latency metrics, and cost charged to the current DBScope."""
+
+    def __init__(self):
+        self._pending: Dict[Tuple, Tuple] = {}
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        scope = _current_scope.get()
+        shape = command_shape(event.command_name, event.command) if scope else None
+        sent = len(bson.encode(event.command)) if scope and scope.track_bytes else 0
+        # Listener callbacks run on the calling thread, but replies arrive in a separate event
+        self._pending[(event.connection_id, event.request_id)] = (scope, shape, sent)
+
+    def succeeded(self, event):
+        entry = self._pending.pop((event.connection_id, event.request_id), None)
+        if entry is None:
+            return
+        DB_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        scope, shape, sent = entry
+        if scope is not None:
+            received = len(bson.encode(event.reply)) if scope.track_bytes else 0
+            scope.record(shape, event.duration_micros / 1000, reply_docs(event.reply), sent, received)
+
+    def failed(self, event):
+        entry = self._pending.pop((event.connection_id, event.request_id), None)
+        if entry is None:
+            return
+        DB_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        DB_COMMAND_ERRORS.labels(event.command_name).inc()
+        scope, shape, sent = entry
+        if scope is not None:
+            scope.record(shape, event.duration_micros / 1000, 0, sent)
+
+
+# Listener attached to every client created by get_client()
+command_accounting = CommandAccounting()
+
+# Totals per top-level scope name since start: {name: {'calls', 'commands', 'time_ms', 'docs_returned'}}
+_scope_totals: Dict[str, Dict[str, float]] = {}
+_scope_totals_lock = threading.Lock()
+
+
+def get_scope_totals() -> Dict[str, Dict[str, float]]:
+    """Copy of the per-operation DB totals."""
+    with _scope_totals_lock:
+        return {name: dict(totals) for name, totals in _scope_totals.items()}
+
+
+def _finish_scope(scope: DBScope):
+    """Log an operation's DB cost and add it to the totals."""
+    if scope.parent is None:
+        with _scope_totals_lock:
+            totals = _scope_totals.setdefault(scope.name, {'calls': 0, 'commands': 0, 'time_ms': 0.0, 'docs_returned': 0})
+            totals['calls'] += 1
+            totals['commands'] += scope.total
+            totals['time_ms'] += scope.time_ms
+            totals['docs_returned'] += scope.docs_returned
+
+    repeated = scope.repeated_shapes()
+    if scope.total >= DB_SCOPE_WARN_COMMANDS or repeated:
+        detail = f"; repeated queries: {', '.join(f'{shape} x{count}' for shape, count in repeated)}" if repeated else ""
+        logger.warning(
+            f"DB cost of {scope.name}: {scope.total} commands, {scope.time_ms:.1f} ms, "
+            f"{scope.docs_returned} docs returned{detail}"
+        )
+    elif scope.total:
+        logger.debug(f"DB cost of {scope.name}: {scope.total} commands, {scope.time_ms:.1f} ms")
+
+
+@contextmanager
+def db_scope(name: str, track_bytes: bool = False):
+    """Collect the DB commands issued inside the block (including worker threads started from it)."""
+    scope = DBScope(name, parent=_current_scope.get(), track_bytes=track_bytes)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        _finish_scope(scope)
+
+
+def db_scoped(func=None, *, name: str = None):
+    """Decorator running a handler or job (sync or async) inside a db_scope."""
+    def decorate(f):
+        scope_name = name or f.__name__
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def async_wrapper(*args, **kwargs):
+                with db_scope(scope_name):
+                    return await f(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with db_scope(scope_name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate(func) if func is not None else decorate
+
+
+def filter_shape(query: Optional[Dict[str, Any]]) -> Tuple[str, ...]:
+    """Filter fields with their operators, e.g. ('date:$gte,$lte', 'user_id'); values are left out."""
+    if not isinstance(query, dict):
+        return ()
+    fields = []
+    for field_name, value in query.items():
+        if isinstance(value, dict) and any(str(k).startswith('$') for k in value):
+            fields.append(f"{field_name}:{','.join(sorted(value))}")
+        else:
+            fields.append(field_name)
+    return tuple(sorted(fields))
+
+
+def plan_stages(plan: Any) -> List[Dict[str, Any]]:
+    """Every stage in an explain() plan tree (classic and slot-based engine output)."""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan)
+        for key in ('inputStage', 'queryPlan', 'innerStage', 'outerStage'):
+            stages.extend(plan_stages(plan.get(key)))
+        for child in plan.get('inputStages', []):
+            stages.extend(plan_stages(child))
+    return stages
+
+
+class QueryPlanAdvisor:
+    """
+    Logs slow QueryBuilder queries by filter shape and explains a sample of
+    queries (and every slow one) on a background thread, warning about
+    collection scans and in-memory sorts. Each shape is explained at most
+    once per interval.
+    """
+
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, sample_rate: float = EXPLAIN_SAMPLE_RATE,
+                 interval: float = EXPLAIN_INTERVAL_SECONDS):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.plans: Dict[str, Dict[str, Any]] = {}
+        self._explained_at: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def observe(self, command_name: str, collection: Collection, query: Dict[str, Any], duration_ms: float,
+                docs: int, limit: Optional[int] = None):
+        """Called after each QueryBuilder read."""
+        shape = (command_name, collection.name, filter_shape(query))
+        slow = self.slow_ms > 0 and duration_ms >= self.slow_ms
+        if slow:
+            SLOW_QUERIES.labels(collection.name).inc()
+            logger.warning(f"Slow query: {format_shape(shape)} took {duration_ms:.0f} ms, {docs} doc(s)")
+        if slow or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            now = time.monotonic()
+            with self._lock:
+                if now - self._explained_at.get(shape, -self.interval) < self.interval:
+                    return
+                self._explained_at[shape] = now
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+            self._executor.submit(self._explain, shape, collection, query, limit)
+
+    def _explain(self, shape: Tuple, collection: Collection, query: Dict[str, Any], limit: Optional[int]):
+        """Run explain() for a query and record what the winning plan does."""
+        try:
+            cursor = collection.find(query)
+            if limit:
+                cursor = cursor.limit(limit)
+            explained = cursor.explain()
+        except Exception as e:
+            logger.debug(f"Could not explain {format_shape(shape)}: {e}")
+            return
+
+        planner = explained.get('queryPlanner', {})
+        stages = plan_stages(planner.get('winningPlan', {}))
+        names = {stage['stage'] for stage in stages}
+        indexes = sorted({stage['indexName'] for stage in stages if stage.get('indexName')})
+        issues = []
+        if 'COLLSCAN' in names:
+            issues.append('COLLSCAN')
+        if 'SORT' in names:
+            issues.append('SORT')
+        stats = explained.get('executionStats', {})
+
+        key = format_shape(shape)
+        with self._lock:
+            self.plans[key] = {
+                'issues': issues,
+                'indexes': indexes,
+                'docs_examined': stats.get('totalDocsExamined'),
+                'explained_at': datetime.now(timezone.utc),
+            }
+        if issues:
+            for issue in issues:
+                QUERY_PLAN_ISSUES.labels(collection.name, issue).inc()
+            what = ' and '.join('a collection scan' if i == 'COLLSCAN' else 'an in-memory sort' for i in issues)
+            logger.warning(f"Query plan for {key} uses {what}; an index may be missing"
+                           + (f" (indexes used: {', '.join(indexes)})" if indexes else ""))
+        else:
+            logger.debug(f"Query plan for {key} uses {', '.join(indexes) or 'no index'}")
+
+    def get_plans(self) -> Dict[str, Dict[str, Any]]:
+        """Latest explain result per query shape."""
+        with self._lock:
+            return {key: dict(plan) for key, plan in self.plans.items()}
+
+
+query_plans = QueryPlanAdvisor()
+
 
 def get_client() -> MongoClient:
     """Get or create MongoDB client."""
     global _client
     if _client is None:
         try:
-            _client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
+            _client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000, event_listeners=[command_accounting])
             # Test connection
             _client.admin.command('ping')
         except Exception as e:
@@ -92,6 +428,49 @@ USERS_COLLECTION = 'users'
 ATTENDANCE_COLLECTION = 'attendance_records'
 FINES_COLLECTION = 'fines'
 SETTINGS_COLLECTION = 'settings'
+DAILY_CLOSES_COLLECTION = 'daily_closes'
+EXPORT_JOBS_COLLECTION = 'export_jobs'
+LATENCY_ROLLUPS_COLLECTION = 'latency_rollups'
+ATTENDANCE_BUCKETS_COLLECTION = 'attendance_buckets'
+ATTENDANCE_BITMAPS_COLLECTION = 'attendance_bitmaps'
+MIGRATIONS_COLLECTION = 'schema_migrations'
+
+# True once every migration in migrations/runner.py has finished: all stored
+# documents are then in canonical form and from_dict skips the legacy fallbacks
+_canonical_documents = False
+
+
+def set_canonical_documents(value: bool):
+    """Switch model hydration to the canonical-document fast path."""
+    global _canonical_documents
+    _canonical_documents = value
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    """Attach UTC to a naive datetime read back from MongoDB."""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def user_ref(value: Any) -> Any:
+    """A user_id reference in its stored form, the user's ObjectId (anything else is kept as a string)."""
+    if isinstance(value, ObjectId):
+        return value
+    value = str(value)
+    return ObjectId(value) if ObjectId.is_valid(value) else value
+
+
+def user_ref_filter(value: Any) -> Any:
+    """
+    Filter value for a user_id reference. Until the backfill in
+    migrations/runner.py has finished, older documents may still hold the
+    string form, so both are matched.
+    """
+    ref = user_ref(value)
+    if _canonical_documents or not isinstance(ref, ObjectId):
+        return ref
+    return {'$in': [ref, str(ref)]}
 
 
 class User:
@@ -134,6 +513,16 @@ class User:
     @classmethod
     def from_dict(cls, doc: Dict[str, Any]) -> 'User':
         """Create User from MongoDB document."""
+        if _canonical_documents:
+            return cls(
+                _id=doc['_id'],
+                telegram_id=doc['telegram_id'],
+                username=doc.get('username'),
+                full_name=doc.get('full_name'),
+                created_at=_aware(doc['created_at']),
+                is_active=doc['is_active']
+            )
+        
         # Handle ObjectId conversion
         _id = doc.get('_id')
         if _id and not isinstance(_id, ObjectId):
@@ -204,7 +593,7 @@ class AttendanceRecord:
             date_val = datetime.combine(date_val, datetime.min.time()).replace(tzinfo=timezone.utc)
         
         doc = {
-            'user_id': str(self.user_id),  # Ensure user_id is always a string
+            'user_id': user_ref(self.user_id),  # Stored as ObjectId, a string on the model
             'date': date_val,
             'status': self.status,
             'created_at': self.created_at
@@ -218,6 +607,16 @@ class AttendanceRecord:
     @classmethod
     def from_dict(cls, doc: Dict[str, Any]) -> 'AttendanceRecord':
         """Create AttendanceRecord from MongoDB document."""
+        if _canonical_documents:
+            return cls(
+                _id=doc['_id'],
+                user_id=str(doc['user_id']),
+                date=doc['date'].date(),
+                status=doc['status'],
+                timestamp=_aware(doc.get('timestamp')),
+                created_at=doc['created_at']
+            )
+        
         # Handle ObjectId conversion
         _id = doc.get('_id')
         if _id and not isinstance(_id, ObjectId):
@@ -265,7 +664,7 @@ class AttendanceRecord:
         
         return cls(
             _id=_id,
-            user_id=str(doc['user_id']),  # Ensure user_id is always a string
+            user_id=str(doc['user_id']),  # ObjectId or legacy string in the document
             date=date_val,
             status=doc['status'],
             timestamp=timestamp,
@@ -276,6 +675,106 @@ class AttendanceRecord:
         return f"<AttendanceRecord(user_id={self.user_id}, date={self.date}, status={self.status})>"
 
 
+# True once migration 0007 has copied every record into attendance_buckets.
+# Until then attendance is read from attendance_records and written to both.
+_buckets_ready = False
+
+
+def attendance_buckets_enabled() -> bool:
+    """Whether attendance is stored in per-member monthly buckets (ATTENDANCE_STORAGE=buckets)."""
+    return ATTENDANCE_STORAGE == 'buckets'
+
+
+def set_attendance_buckets_ready(value: bool):
+    """Switch attendance reads (and writes) over to the buckets once they hold every record."""
+    global _buckets_ready
+    _buckets_ready = value
+
+
+def attendance_buckets_active() -> bool:
+    """Whether attendance_buckets is the only attendance store (bucketed layout on and 0007 done)."""
+    return attendance_buckets_enabled() and _buckets_ready
+
+
+def _month_start(value: date) -> datetime:
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def _months(low: date, high: date) -> List[datetime]:
+    """First day of every month from low to high, inclusive."""
+    months = []
+    month, last = _month_start(low), _month_start(high)
+    while month <= last:
+        months.append(month)
+        month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return months
+
+
+def bucket_id(user_id: Any, month: date) -> str:
+    """_id of a member's bucket for a month, e.g. '65f0c3...:2024-03'."""
+    return f"{user_ref(user_id)}:{month:%Y-%m}"
+
+
+def bucket_update(record: 'AttendanceRecord') -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    (filter, update) that stores a record in its bucket: a $set of the day's
+    slot in the days map, creating the bucket on first use (upsert).
+    """
+    day = record.date.date() if isinstance(record.date, datetime) else record.date
+    entry = {'status': record.status, 'created_at': record.created_at}
+    if record.timestamp:
+        entry['timestamp'] = record.timestamp
+    return (
+        {'_id': bucket_id(record.user_id, day)},
+        {
+            '$set': {f"days.{day:%d}": entry},
+            '$setOnInsert': {'user_id': user_ref(record.user_id), 'month': _month_start(day)}
+        }
+    )
+
+
+def bucket_records(bucket: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The days of a bucket as documents in the attendance_records shape."""
+    month = _aware(bucket['month'])
+    return [
+        {
+            '_id': None,
+            'user_id': bucket['user_id'],
+            'date': month.replace(day=int(day)),
+            **entry
+        }
+        for day, entry in sorted(bucket.get('days', {}).items())
+    ]
+
+
+# Comparison operators QueryBuilder emits, for matching expanded bucket days
+_OPERATORS = {
+    '$gte': operator.ge,
+    '$lte': operator.le,
+    '$gt': operator.gt,
+    '$lt': operator.lt,
+    '$in': lambda value, options: value in options,
+}
+
+
+def _normalise(value: Any) -> Any:
+    return _aware(value) if isinstance(value, datetime) else value
+
+
+def matches_query(doc: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    """Whether a document satisfies a QueryBuilder filter (equality and the operators above)."""
+    for field_name, condition in query.items():
+        value = _normalise(doc.get(field_name))
+        if isinstance(condition, dict) and any(k.startswith('$') for k in condition.keys()):
+            for op, operand in condition.items():
+                operand = [_normalise(v) for v in operand] if op == '$in' else _normalise(operand)
+                if value is None or not _OPERATORS[op](value, operand):
+                    return False
+        elif value != _normalise(condition):
+            return False
+    return True
+
+
 class Fine:
     """Fine record for late/absent members (MongoDB document)."""
     
@@ -306,7 +805,7 @@ class Fine:
             date_val = datetime.combine(date_val, datetime.min.time()).replace(tzinfo=timezone.utc)
         
         doc = {
-            'user_id': str(self.user_id),  # Ensure user_id is always a string
+            'user_id': user_ref(self.user_id),  # Stored as ObjectId, a string on the model
             'date': date_val,
             'amount': self.amount,
             'created_at': self.created_at
@@ -318,6 +817,15 @@ class Fine:
     @classmethod
     def from_dict(cls, doc: Dict[str, Any]) -> 'Fine':
         """Create Fine from MongoDB document."""
+        if _canonical_documents:
+            return cls(
+                _id=doc['_id'],
+                user_id=str(doc['user_id']),
+                date=doc['date'].date(),
+                amount=doc['amount'],
+                created_at=doc['created_at']
+            )
+        
         # Handle ObjectId conversion
         _id = doc.get('_id')
         if _id and not isinstance(_id, ObjectId):
@@ -349,7 +857,7 @@ class Fine:
         
         return cls(
             _id=_id,
-            user_id=str(doc['user_id']),  # Ensure user_id is always a string
+            user_id=str(doc['user_id']),  # ObjectId or legacy string in the document
             date=date_val,
             amount=float(doc['amount']),
             created_at=created_at
@@ -391,6 +899,9 @@ class Settings:
     @classmethod
     def from_dict(cls, doc: Dict[str, Any]) -> 'Settings':
         """Create Settings from MongoDB document."""
+        if _canonical_documents:
+            return cls(_id=doc['_id'], key=doc['key'], value=doc['value'], updated_at=_aware(doc['updated_at']))
+        
         # Handle ObjectId conversion
         _id = doc.get('_id')
         if _id and not isinstance(_id, ObjectId):
@@ -428,30 +939,89 @@ class Settings:
         return f"<Settings(key={self.key}, value={self.value})>"
 
 
-def init_db():
-    """Initialize database indexes."""
-    db = get_database()
-    
-    # Create indexes for users collection
-    users_col = get_collection(USERS_COLLECTION)
-    users_col.create_index('telegram_id', unique=True)
-    users_col.create_index('is_active')
-    
-    # Create indexes for attendance_records collection
-    attendance_col = get_collection(ATTENDANCE_COLLECTION)
-    attendance_col.create_index([('user_id', 1), ('date', 1)], unique=True)
-    attendance_col.create_index('date')
-    attendance_col.create_index('user_id')
-    
-    # Create indexes for fines collection
-    fines_col = get_collection(FINES_COLLECTION)
-    fines_col.create_index([('user_id', 1), ('date', 1)], unique=True)
-    fines_col.create_index('date')
-    fines_col.create_index('user_id')
+def get_daily_close(close_key: str) -> Optional[Dict[str, Any]]:
+    """Get the idempotency marker for a daily close (single _id lookup)."""
+    collection = get_collection(DAILY_CLOSES_COLLECTION)
+    return collection.find_one({'_id': close_key})
+
+
+def claim_daily_close(close_key: str, marker: Dict[str, Any], force: bool = False) -> bool:
+    """
+    Atomically claim a daily close.
+    Returns False if another run already completed this close, or claimed it
+    less than DAILY_CLOSE_LEASE_SECONDS ago. An older 'processing' claim was
+    abandoned (the process died mid-close) and is taken over.
+    With force=True the existing marker is replaced and the claim always succeeds.
+    """
+    collection = get_collection(DAILY_CLOSES_COLLECTION)
+    if force:
+        collection.replace_one({'_id': close_key}, marker, upsert=True)
+        return True
+    result = collection.update_one(
+        {'_id': close_key},
+        {'$setOnInsert': marker},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        return True
     
-    # Create indexes for settings collection
-    settings_col = get_collection(SETTINGS_COLLECTION)
-    settings_col.create_index('key', unique=True)
+    expired = datetime.now(timezone.utc) - timedelta(seconds=DAILY_CLOSE_LEASE_SECONDS)
+    result = collection.update_one(
+        {'_id': close_key, 'status': 'processing', 'started_at': {'$lt': expired}},
+        {'$set': marker}
+    )
+    if result.modified_count:
+        logger.warning(f"Took over daily close {close_key}: the previous claim expired unfinished")
+        return True
+    return False
+
+
+def complete_daily_close(close_key: str, counts: Dict[str, int]) -> Dict[str, Any]:
+    """Mark a claimed daily close as done and store its counts in one update."""
+    collection = get_collection(DAILY_CLOSES_COLLECTION)
+    return collection.find_one_and_update(
+        {'_id': close_key},
+        {'$set': {
+            'status': 'done',
+            'processed_at': datetime.now(timezone.utc),
+            'counts': counts
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def release_daily_close(close_key: str):
+    """Drop an unfinished claim so the close can be retried."""
+    collection = get_collection(DAILY_CLOSES_COLLECTION)
+    collection.delete_one({'_id': close_key, 'status': 'processing'})
+
+
+def get_latency_rollup(day_key: str) -> Optional[Dict[str, Any]]:
+    """Get a saved daily check-in latency summary."""
+    collection = get_collection(LATENCY_ROLLUPS_COLLECTION)
+    doc = collection.find_one({'_id': day_key})
+    if doc:
+        doc.pop('_id', None)
+    return doc
+
+
+def save_latency_rollup(day_key: str, summary: Dict[str, Any]):
+    """Store a daily check-in latency summary (replaces an earlier one for the day)."""
+    collection = get_collection(LATENCY_ROLLUPS_COLLECTION)
+    collection.replace_one({'_id': day_key}, dict(summary), upsert=True)
+
+
+def init_db(background: bool = False, force: bool = False) -> Dict[str, Any]:
+    """
+    Initialize database indexes from the specs in migrations/indexes.py
+    (nothing to do when the specs haven't changed since the last run), then
+    run pending document migrations from migrations/runner.py.
+    """
+    from migrations.indexes import reconcile_indexes
+    from migrations.runner import start_migrations
+    result = reconcile_indexes(background=background, force=force)
+    start_migrations(background=background)
+    return result
 
 
 @contextmanager
@@ -481,15 +1051,16 @@ def get_db():
         
         def commit(self):
             """Commit pending changes."""
-            if hasattr(self, '_pending_add'):
-                for instance in self._pending_add:
-                    self._save_instance(instance)
-                delattr(self, '_pending_add')
-            
+            # Deletes first, so replacing a record (delete + add for the same day) keeps the new one
             if hasattr(self, '_pending_delete'):
                 for instance in self._pending_delete:
                     self._delete_instance(instance)
                 delattr(self, '_pending_delete')
+            
+            if hasattr(self, '_pending_add'):
+                for instance in self._pending_add:
+                    self._save_instance(instance)
+                delattr(self, '_pending_add')
         
         def refresh(self, instance):
             """Refresh instance from database."""
@@ -525,7 +1096,16 @@ def get_db():
                     result = collection.insert_one(doc)
                     instance._id = result.inserted_id
             
+            elif isinstance(instance, AttendanceRecord) and attendance_buckets_active():
+                # One $set of the day's slot; the bucket holds at most one record per day
+                query, update = bucket_update(instance)
+                get_collection(ATTENDANCE_BUCKETS_COLLECTION).update_one(query, update, upsert=True)
+            
             elif isinstance(instance, AttendanceRecord):
+                if attendance_buckets_enabled():
+                    # Still copying records into buckets: keep both current
+                    query, update = bucket_update(instance)
+                    get_collection(ATTENDANCE_BUCKETS_COLLECTION).update_one(query, update, upsert=True)
                 collection = get_collection(ATTENDANCE_COLLECTION)
                 doc = instance.to_dict()
                 # Use upsert for unique constraint on user_id + date
@@ -535,7 +1115,7 @@ def get_db():
                 else:
                     # Try to find existing record first
                     existing = collection.find_one({
-                        'user_id': doc['user_id'],
+                        'user_id': user_ref_filter(doc['user_id']),
                         'date': doc['date']
                     })
                     if existing:
@@ -556,7 +1136,7 @@ def get_db():
                 else:
                     # Try to find existing record first
                     existing = collection.find_one({
-                        'user_id': doc['user_id'],
+                        'user_id': user_ref_filter(doc['user_id']),
                         'date': doc['date']
                     })
                     if existing:
@@ -590,6 +1170,14 @@ def get_db():
         
         def _delete_instance(self, instance):
             """Delete instance from MongoDB."""
+            if isinstance(instance, AttendanceRecord) and attendance_buckets_enabled():
+                day = instance.date.date() if isinstance(instance.date, datetime) else instance.date
+                get_collection(ATTENDANCE_BUCKETS_COLLECTION).update_one(
+                    {'_id': bucket_id(instance.user_id, day)},
+                    {'$unset': {f"days.{day:%d}": ''}}
+                )
+                if attendance_buckets_active():
+                    return
             if instance._id:
                 if isinstance(instance, User):
                     collection = get_collection(USERS_COLLECTION)
@@ -620,6 +1208,10 @@ def get_db():
         raise
 
 
+# Column comparisons and the MongoDB operators they become
+RANGE_OPERATORS = {'ge': '$gte', 'le': '$lte', 'gt': '$gt', 'lt': '$lt'}
+
+
 class QueryBuilder:
     """Query builder that mimics SQLAlchemy query interface."""
     
@@ -641,7 +1233,7 @@ class QueryBuilder:
                 
                 # Convert value to appropriate type
                 if field_name == 'user_id':
-                    value = str(value)  # Ensure user_id is always a string
+                    value = user_ref_filter(value) if op == 'eq' else user_ref(value)
                 elif field_name in ['date']:
                     # Convert date to datetime for MongoDB queries
                     if isinstance(value, date) and not isinstance(value, datetime):
@@ -656,14 +1248,13 @@ class QueryBuilder:
                         self._filters[field_name] = value
                     else:
                         self._filters[field_name] = value
-                elif op == 'ge':
-                    self._filters[field_name] = {'$gte': value}
-                elif op == 'le':
-                    self._filters[field_name] = {'$lte': value}
-                elif op == 'gt':
-                    self._filters[field_name] = {'$gt': value}
-                elif op == 'lt':
-                    self._filters[field_name] = {'$lt': value}
+                elif op in RANGE_OPERATORS:
+                    # date >= start and date <= end combine into one range
+                    existing = self._filters.get(field_name)
+                    if isinstance(existing, dict) and set(existing) <= set(RANGE_OPERATORS.values()):
+                        existing[RANGE_OPERATORS[op]] = value
+                    else:
+                        self._filters[field_name] = {RANGE_OPERATORS[op]: value}
                 else:
                     self._filters[field_name] = value
             # Fallback for SQLAlchemy-style conditions (if any remain)
@@ -674,33 +1265,103 @@ class QueryBuilder:
                     field_name = left.key
                     # Convert value to appropriate type
                     if field_name == 'user_id':
-                        right = str(right)
+                        right = user_ref_filter(right)
                     self._filters[field_name] = right
         return self
     
     def first(self):
         """Get first matching document."""
+        if self.model_class == AttendanceRecord and attendance_buckets_active():
+            docs = self._bucket_docs(limit=1)
+            return self.model_class.from_dict(docs[0]) if docs else None
         collection = self._get_collection()
         query = self._build_query()
+        started = time.perf_counter()
         doc = collection.find_one(query)
+        query_plans.observe('find', collection, query, (time.perf_counter() - started) * 1000,
+                            1 if doc else 0, limit=1)
         if doc:
             return self.model_class.from_dict(doc)
         return None
     
     def all(self):
         """Get all matching documents."""
+        if self.model_class == AttendanceRecord and attendance_buckets_active():
+            return [self.model_class.from_dict(doc) for doc in self._bucket_docs(limit=self._limit_value)]
         collection = self._get_collection()
         query = self._build_query()
+        started = time.perf_counter()
         cursor = collection.find(query)
         if self._limit_value:
             cursor = cursor.limit(self._limit_value)
-        return [self.model_class.from_dict(doc) for doc in cursor]
+        docs = list(cursor)
+        query_plans.observe('find', collection, query, (time.perf_counter() - started) * 1000,
+                            len(docs), limit=self._limit_value)
+        return [self.model_class.from_dict(doc) for doc in docs]
     
     def limit(self, value):
         """Limit number of results."""
         self._limit_value = value
         return self
     
+    def _bucket_query(self) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        Translate an attendance_records filter into an attendance_buckets
+        query and projection. One member over a known day or date range is an
+        _id lookup (one document per month); a single day across members reads
+        that day's slot from every bucket of the month.
+        """
+        user = self._filters.get('user_id')
+        day = self._filters.get('date')
+        if isinstance(day, dict):
+            low, high = day.get('$gte', day.get('$gt')), day.get('$lte', day.get('$lt'))
+        else:
+            low = high = day
+        
+        # A single member, in either stored form of the reference
+        refs = user.get('$in', []) if isinstance(user, dict) else [user] if user is not None else []
+        member = str(refs[0]) if refs and len({str(ref) for ref in refs}) == 1 else None
+        
+        if member is not None and low is not None and high is not None:
+            ids = [bucket_id(member, month) for month in _months(low, high)]
+            query = {'_id': ids[0] if len(ids) == 1 else {'$in': ids}}
+        else:
+            query = {}
+            if user is not None:
+                query['user_id'] = user
+            if low is not None and low == high:
+                query['month'] = _month_start(low)
+            elif low is not None or high is not None:
+                query['month'] = {
+                    **({'$gte': _month_start(low)} if low is not None else {}),
+                    **({'$lte': _month_start(high)} if high is not None else {})
+                }
+        
+        projection = None
+        if isinstance(day, datetime):
+            # Only the one day's slot
+            query[f"days.{day:%d}"] = {'$exists': True}
+            projection = {'user_id': 1, 'month': 1, f"days.{day:%d}": 1}
+        return query, projection
+    
+    def _bucket_docs(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Matching attendance records read from attendance_buckets, as record documents."""
+        collection = get_collection(ATTENDANCE_BUCKETS_COLLECTION)
+        query, projection = self._bucket_query()
+        record_query = self._build_query()
+        started = time.perf_counter()
+        buckets = list(collection.find(query, projection))
+        query_plans.observe('find', collection, query, (time.perf_counter() - started) * 1000, len(buckets))
+        
+        docs = []
+        for bucket in buckets:
+            for doc in bucket_records(bucket):
+                if matches_query(doc, record_query):
+                    docs.append(doc)
+                    if limit and len(docs) >= limit:
+                        return docs
+        return docs
+    
     def _get_collection(self):
         """Get the appropriate collection for the model."""
         if self.model_class == User:
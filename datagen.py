@@ -0,0 +1,304 @@
+"""
+Synthetic dataset generator for report and export benchmarks.
+
+Bulk-inserts users, attendance records, fines and daily close markers
+built with the models in database.py, so the data looks exactly like what
+the bot writes (with ATTENDANCE_STORAGE=buckets, attendance goes into
+monthly attendance_buckets instead of attendance_records), along with each
+member's attendance bitmaps. Every member gets their own late and absence rates drawn
+from Beta distributions around the requested means, which gives the
+skewed "a few members are always late" shape real groups have.
+
+    python datagen.py --users 5000 --start 2023-01-01 --end 2025-12-31 --seed 1
+
+Writes to a dedicated database (DATABASE_NAME + '_perf' by default).
+"""
+import logging
+import random
+import time
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from typing import Any, Dict, Iterable, List
+from bson import ObjectId
+import database
+from config import TIMEZONE, DEFAULT_FINE_AMOUNT, parse_time, ATTENDANCE_WINDOW_START
+from database import (
+    User,
+    AttendanceRecord,
+    Fine,
+    bucket_update,
+    attendance_buckets_enabled,
+    USERS_COLLECTION,
+    ATTENDANCE_COLLECTION,
+    ATTENDANCE_BUCKETS_COLLECTION,
+    FINES_COLLECTION,
+    DAILY_CLOSES_COLLECTION,
+    ATTENDANCE_BITMAPS_COLLECTION
+)
+from bitmaps import STATUSES, bitmap_document, day_bit
+
+logger = logging.getLogger(__name__)
+
+# Check-in deadline used by is_before_deadline
+DEADLINE = dtime(10, 0)
+
+
+def beta_rate(rng: random.Random, mean: float, concentration: float) -> float:
+    """Draw a per-member rate from a Beta distribution with the given mean."""
+    if mean <= 0:
+        return 0.0
+    if mean >= 1:
+        return 1.0
+    return rng.betavariate(mean * concentration, (1 - mean) * concentration)
+
+
+def local_utc(day: date, at: dtime) -> datetime:
+    """A Phnom Penh wall-clock time on a day, as an aware UTC datetime."""
+    return TIMEZONE.localize(datetime.combine(day, at)).astimezone(timezone.utc)
+
+
+class DatasetGenerator:
+    """Builds consistent users, attendance records and fines."""
+
+    def __init__(self, users: int, start: date, end: date, late_rate: float = 0.1, absent_rate: float = 0.05,
+                 concentration: float = 8.0, joiners: float = 0.1, leavers: float = 0.05,
+                 skip_weekends: bool = False, fine_amount: float = DEFAULT_FINE_AMOUNT,
+                 first_id: int = 500000000, seed: int = 0):
+        self.users = users
+        self.start = start
+        self.end = end
+        self.late_rate = late_rate
+        self.absent_rate = absent_rate
+        self.concentration = concentration
+        self.joiners = joiners
+        self.leavers = leavers
+        self.skip_weekends = skip_weekends
+        self.fine_amount = fine_amount
+        self.first_id = first_id
+        self.rng = random.Random(seed)
+        self.window_start = parse_time(ATTENDANCE_WINDOW_START)
+
+    def days(self) -> List[date]:
+        """Dates that get attendance."""
+        days = []
+        day = self.start
+        while day <= self.end:
+            if not (self.skip_weekends and day.weekday() >= 5):
+                days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    def members(self) -> List[Dict]:
+        """Member profiles: the user document plus their active span and rates."""
+        span = (self.end - self.start).days
+        profiles = []
+        for n in range(self.users):
+            joined = self.start
+            left = None
+            if self.rng.random() < self.joiners:
+                joined = self.start + timedelta(days=self.rng.randint(0, span))
+            if self.rng.random() < self.leavers:
+                left = joined + timedelta(days=self.rng.randint(0, (self.end - joined).days))
+
+            user = User(
+                _id=ObjectId(),
+                telegram_id=self.first_id + n,
+                username=f"member{n}" if self.rng.random() < 0.8 else None,
+                full_name=f"Member {n}",
+                created_at=local_utc(joined, dtime(8, 0)),
+                is_active=left is None
+            )
+            profiles.append({
+                'user': user,
+                'joined': joined,
+                'left': left,
+                'late': beta_rate(self.rng, self.late_rate, self.concentration),
+                'absent': beta_rate(self.rng, self.absent_rate, self.concentration),
+            })
+        return profiles
+
+    def day_documents(self, day: date, profiles: List[Dict]):
+        """Attendance records and fines for one day, plus the close counts."""
+        records = []
+        fines = []
+        counts = {'active_users': 0, 'already_recorded': 0, 'marked_absent': 0, 'skipped': 0, 'errors': 0}
+        start_minutes = self.window_start.hour * 60 + self.window_start.minute
+        deadline_minutes = DEADLINE.hour * 60 + DEADLINE.minute
+        close_at = local_utc(day, DEADLINE)
+
+        for profile in profiles:
+            if profile['left'] is not None and day > profile['left']:
+                continue
+            counts['active_users'] += 1
+            if day < profile['joined']:
+                counts['skipped'] += 1
+                continue
+
+            user_id = profile['user'].id
+            roll = self.rng.random()
+            if roll < profile['absent']:
+                records.append(AttendanceRecord(user_id=user_id, date=day, status='absent', created_at=close_at).to_dict())
+                fines.append(Fine(user_id=user_id, date=day, amount=self.fine_amount, created_at=close_at).to_dict())
+                counts['marked_absent'] += 1
+                continue
+
+            if roll < profile['absent'] + profile['late']:
+                # Late check-ins trickle in over the half hour after the deadline
+                minute = deadline_minutes + self.rng.triangular(0, 30, 2)
+                status = 'late'
+            else:
+                # On-time check-ins bunch up right after the window opens
+                minute = start_minutes + self.rng.triangular(0, max(1, deadline_minutes - start_minutes), 5)
+                status = 'present'
+            checked_in = local_utc(day, dtime(int(minute) // 60, int(minute) % 60, int(minute % 1 * 60)))
+            records.append(AttendanceRecord(user_id=user_id, date=day, status=status, timestamp=checked_in,
+                                            created_at=checked_in).to_dict())
+            if status == 'late':
+                fines.append(Fine(user_id=user_id, date=day, amount=self.fine_amount, created_at=checked_in).to_dict())
+            counts['already_recorded'] += 1
+        return records, fines, counts
+
+
+def add_to_buckets(buckets: Dict[str, Dict[str, Any]], records: Iterable[Dict[str, Any]]):
+    """Fold attendance record documents into attendance_buckets documents, keyed by _id."""
+    for record in records:
+        query, update = bucket_update(AttendanceRecord.from_dict(record))
+        bucket = buckets.setdefault(query['_id'], {**query, **update['$setOnInsert'], 'days': {}})
+        for slot, entry in update['$set'].items():
+            bucket['days'][slot.split('.', 1)[1]] = entry
+
+
+def add_to_bitmaps(bitmaps: Dict[tuple, Dict[str, int]], records: Iterable[Dict[str, Any]]):
+    """Set each attendance record document's bit in its member's bitmaps, keyed by (user_id, year)."""
+    for record in records:
+        day = record['date'].date()
+        bits = bitmaps.setdefault((record['user_id'], day.year), {status: 0 for status in STATUSES})
+        bits[record['status']] |= 1 << day_bit(day)
+
+
+class BatchWriter:
+    """Buffers documents per collection and writes them with insert_many."""
+
+    def __init__(self, batch_size: int = 10000):
+        self.batch_size = batch_size
+        self.inserted: Dict[str, int] = {}
+        self._buffers: Dict[str, List[Dict]] = {}
+
+    def add(self, collection_name: str, docs: Iterable[Dict]):
+        buffer = self._buffers.setdefault(collection_name, [])
+        buffer.extend(docs)
+        if len(buffer) >= self.batch_size:
+            self._write(collection_name)
+
+    def flush(self):
+        for collection_name in list(self._buffers):
+            self._write(collection_name)
+
+    def _write(self, collection_name: str):
+        buffer = self._buffers.get(collection_name)
+        if not buffer:
+            return
+        database.get_collection(collection_name).insert_many(buffer, ordered=False)
+        self.inserted[collection_name] = self.inserted.get(collection_name, 0) + len(buffer)
+        self._buffers[collection_name] = []
+
+
+def generate(generator: DatasetGenerator, batch_size: int = 10000, close_days: bool = True) -> Dict[str, int]:
+    """Insert a generated dataset into the current database and build the indexes."""
+    started = time.perf_counter()
+    writer = BatchWriter(batch_size)
+    profiles = generator.members()
+    writer.add(USERS_COLLECTION, (profile['user'].to_dict() for profile in profiles))
+
+    days = generator.days()
+    buckets: Dict[str, Dict[str, Any]] = {}
+    bitmaps: Dict[tuple, Dict[str, int]] = {}
+    for n, day in enumerate(days, start=1):
+        records, fines, counts = generator.day_documents(day, profiles)
+        add_to_bitmaps(bitmaps, records)
+        if attendance_buckets_enabled():
+            add_to_buckets(buckets, records)
+            # A month's buckets are complete once its last day is generated
+            if n == len(days) or days[n].month != day.month:
+                writer.add(ATTENDANCE_BUCKETS_COLLECTION, buckets.values())
+                buckets = {}
+        else:
+            writer.add(ATTENDANCE_COLLECTION, records)
+        writer.add(FINES_COLLECTION, fines)
+        if close_days:
+            # Mark the day closed so the bot does not re-run the 10:00 close for it
+            close_at = local_utc(day, DEADLINE)
+            writer.add(DAILY_CLOSES_COLLECTION, [{
+                '_id': day.isoformat(),
+                'date': datetime.combine(day, datetime.min.time()).replace(tzinfo=timezone.utc),
+                'group': None,
+                'status': 'done',
+                'started_at': close_at,
+                'processed_at': close_at,
+                'counts': counts
+            }])
+        if n % 30 == 0:
+            total = sum(writer.inserted.values())
+            logger.info(f"{day}: {total} documents written ({total / (time.perf_counter() - started):.0f}/s)")
+    writer.add(ATTENDANCE_BITMAPS_COLLECTION,
+               (bitmap_document(user_id, year, bits) for (user_id, year), bits in bitmaps.items()))
+    writer.flush()
+
+    index_started = time.perf_counter()
+    database.init_db()
+    logger.info(f"Indexes built in {time.perf_counter() - index_started:.1f}s")
+
+    result = dict(writer.inserted)
+    result['days'] = len(days)
+    result['seconds'] = round(time.perf_counter() - started, 1)
+    return result
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+    import json
+    from loadtest import setup_backend
+
+    today = datetime.now(TIMEZONE).date()
+    parser = argparse.ArgumentParser(description="Generate a synthetic attendance dataset")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--start', type=date.fromisoformat, default=today - timedelta(days=365))
+    parser.add_argument('--end', type=date.fromisoformat, default=today - timedelta(days=1))
+    parser.add_argument('--late-rate', type=float, default=0.1, help="Mean fraction of days a member is late")
+    parser.add_argument('--absent-rate', type=float, default=0.05, help="Mean fraction of days a member is absent")
+    parser.add_argument('--concentration', type=float, default=8.0,
+                        help="Beta concentration; lower values spread members' rates further apart")
+    parser.add_argument('--joiners', type=float, default=0.1, help="Fraction of members who join during the range")
+    parser.add_argument('--leavers', type=float, default=0.05, help="Fraction of members who leave (become inactive)")
+    parser.add_argument('--skip-weekends', action='store_true')
+    parser.add_argument('--fine-amount', type=float, default=DEFAULT_FINE_AMOUNT)
+    parser.add_argument('--first-id', type=int, default=500000000, help="Telegram id of the first member")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--database', default=f"{database.DATABASE_NAME}_perf", help="Database to fill (dropped first)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.end < args.start:
+        parser.error("--end is before --start")
+    setup_backend('mongo', args.database)
+    generator = DatasetGenerator(
+        users=args.users,
+        start=args.start,
+        end=args.end,
+        late_rate=args.late_rate,
+        absent_rate=args.absent_rate,
+        concentration=args.concentration,
+        joiners=args.joiners,
+        leavers=args.leavers,
+        skip_weekends=args.skip_weekends,
+        fine_amount=args.fine_amount,
+        first_id=args.first_id,
+        seed=args.seed
+    )
+    print(json.dumps(generate(generator, batch_size=args.batch_size), indent=2))
+
+
+if __name__ == '__main__':
+    main()
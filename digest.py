@@ -0,0 +1,119 @@
+"""
+Coalesced admin digest of failed private greetings.
+
+Instead of one admin DM per failed greeting, failures are collected in memory
+and sent as a single message on a timer or when the attendance window closes.
+Users that cannot be messaged at all (never started the bot, blocked it) are
+remembered so no further DMs are attempted until they send /start.
+"""
+import asyncio
+import logging
+from typing import Optional, Dict, Set
+from telegram.error import Forbidden, BadRequest
+from config import ADMIN_ID, DIGEST_INTERVAL_SECONDS
+from outbox import get_outbox
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of members listed by name in one digest
+MAX_LISTED = 50
+
+
+def is_unreachable_error(error: Exception) -> bool:
+    """Whether a delivery error means the user cannot be messaged until they /start."""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+class FailureDigest:
+    """Collects failed greeting deliveries and reports them to the admin in one message."""
+
+    def __init__(self, interval: float = DIGEST_INTERVAL_SECONDS):
+        self.interval = interval
+        self._failed: Dict[int, str] = {}
+        self._skipped: Dict[int, str] = {}
+        self._unreachable: Set[int] = set()
+        self._timer: Optional[asyncio.Task] = None
+
+    def is_unreachable(self, telegram_id: int) -> bool:
+        """Whether DMs to this user are known to fail."""
+        return telegram_id in self._unreachable
+
+    def mark_reachable(self, telegram_id: int):
+        """Allow DMs to a user again (called when they /start the bot)."""
+        self._unreachable.discard(telegram_id)
+
+    def record_failure(self, telegram_id: int, full_name: str, error: Exception):
+        """Record a failed greeting."""
+        logger.warning(f"Could not send private message to {telegram_id}: {error}")
+        if is_unreachable_error(error):
+            self._unreachable.add(telegram_id)
+        self._failed[telegram_id] = full_name
+
+    def record_skipped(self, telegram_id: int, full_name: str):
+        """Record a greeting that was not attempted because the user is unreachable."""
+        self._skipped[telegram_id] = full_name
+
+    def start(self):
+        """Start the periodic flush timer."""
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        """Stop the timer and send whatever is pending."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.flush()
+
+    async def _run(self):
+        """Flush the digest every interval."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing failure digest: {e}", exc_info=True)
+
+    def flush(self):
+        """Send pending failures to the admin as one message."""
+        if not self._failed and not self._skipped:
+            return
+        failed, self._failed = self._failed, {}
+        skipped, self._skipped = self._skipped, {}
+
+        message = ""
+        if failed:
+            message += f"⚠️ Could not send greetings to {len(failed)} member(s). Attendance still recorded.\n"
+            message += _format_members(failed)
+        if skipped:
+            if message:
+                message += "\n"
+            message += f"🔕 Skipped greetings for {len(skipped)} member(s) who haven't started the bot.\n"
+            message += _format_members(skipped)
+
+        if ADMIN_ID:
+            get_outbox().send_message(ADMIN_ID, message)
+        else:
+            logger.warning(message)
+
+
+def _format_members(members: Dict[int, str]) -> str:
+    """Format a bounded list of members for a digest."""
+    lines = [f"  • {name} (ID: {telegram_id})\n" for telegram_id, name in list(members.items())[:MAX_LISTED]]
+    if len(members) > MAX_LISTED:
+        lines.append(f"  … and {len(members) - MAX_LISTED} more\n")
+    return ''.join(lines)
+
+
+# Global digest instance
+_digest: Optional[FailureDigest] = None
+
+
+def get_failure_digest() -> FailureDigest:
+    """Get or create the global failure digest."""
+    global _digest
+    if _digest is None:
+        _digest = FailureDigest()
+    return _digest
@@ -0,0 +1,405 @@
+"""
+Local stand-in for the Telegram Bot API, for offline load testing.
+
+Implements the methods the bot uses (getMe, getUpdates, sendMessage,
+sendDocument, editMessageText, setWebhook, deleteWebhook), injects
+synthetic group '1' messages from N fake members on a schedule, enforces
+Telegram-like rate limits and records how long each member waited for the
+bot to respond.
+
+Point the bot at it with TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 and run:
+
+    python fake_telegram.py --users 200 --spread 60 --admin-id <ADMIN_ID> --open-window
+"""
+import asyncio
+import email.parser
+import email.policy
+import json
+import logging
+import math
+import random
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+from config import TIMEZONE
+from http_server import HTTPServer, Request, Response
+from utils import percentiles
+
+logger = logging.getLogger(__name__)
+
+# Parameters that are sent as plain strings rather than JSON values
+STRING_PARAMS = {'text', 'caption', 'url', 'secret_token', 'filename', 'parse_mode', 'certificate'}
+
+BOT_USER = {
+    'id': 100000,
+    'is_bot': True,
+    'first_name': 'Fake Attendance Bot',
+    'username': 'fake_attendance_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': True,
+    'supports_inline_queries': False,
+}
+
+
+class RateLimiter:
+    """Sliding-window limits mirroring Telegram's flood control."""
+
+    def __init__(self, global_rate: int = 30, private_rate: int = 1, group_per_minute: int = 20):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_per_minute = group_per_minute
+        self._global = deque()
+        self._chats: Dict[int, deque] = defaultdict(deque)
+
+    def check(self, chat_id: int, now: float) -> Optional[int]:
+        """Return retry_after seconds if the call exceeds a limit, else record it."""
+        window, limit = (60.0, self.group_per_minute) if chat_id < 0 else (1.0, self.private_rate)
+        chat = self._chats[chat_id]
+        for calls, span in ((self._global, 1.0), (chat, window)):
+            while calls and calls[0] <= now - span:
+                calls.popleft()
+        if len(self._global) >= self.global_rate:
+            return max(1, math.ceil(self._global[0] + 1.0 - now))
+        if len(chat) >= limit:
+            return max(1, math.ceil(chat[0] + window - now))
+        self._global.append(now)
+        chat.append(now)
+        return None
+
+
+class FakeTelegram:
+    """In-memory Bot API state and request handlers."""
+
+    def __init__(self, chat_id: int = -1001000000000, users: int = 100, unreachable: float = 0.0,
+                 rate_limits: bool = True, seed: int = 0):
+        self.chat_id = chat_id
+        self.users = users
+        self.random = random.Random(seed)
+        self.unreachable = {1000 + i for i in range(users) if self.random.random() < unreachable}
+        self.limiter = RateLimiter() if rate_limits else None
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self._updates: List[Dict[str, Any]] = []
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Condition()
+        # message_id -> (telegram_id, injected_at) for injected check-ins
+        self._injected: Dict[int, tuple] = {}
+        # telegram_id -> injected_at of their first pending check-in
+        self._awaiting_dm: Dict[int, float] = {}
+        self.stats = {
+            'calls': defaultdict(int),
+            'rate_limited': defaultdict(int),
+            'forbidden': 0,
+            'injected': 0,
+            'dm_latency_ms': [],
+            'reply_latency_ms': [],
+            'group_messages': 0,
+        }
+
+    # Update injection
+
+    def _next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def _message(self, from_id: int, text: str, chat_id: int, first_name: str) -> Dict[str, Any]:
+        message = {
+            'message_id': self._next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private', 'title': 'Load Test'}
+            if chat_id < 0 else {'id': chat_id, 'type': 'private', 'first_name': first_name},
+            'from': {'id': from_id, 'is_bot': False, 'first_name': first_name, 'username': f"member{from_id}"},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    async def inject(self, from_id: int, text: str, chat_id: int = None, first_name: str = None):
+        """Queue an incoming message as an update."""
+        chat_id = chat_id if chat_id is not None else self.chat_id
+        message = self._message(from_id, text, chat_id, first_name or f"Member {from_id}")
+        now = time.perf_counter()
+        if text == '1' and chat_id < 0:
+            self._injected[message['message_id']] = (from_id, now)
+            self._awaiting_dm.setdefault(from_id, now)
+            self.stats['injected'] += 1
+        self._update_id += 1
+        update = {'update_id': self._update_id, 'message': message}
+        async with self._new_updates:
+            self._updates.append(update)
+            self._new_updates.notify_all()
+
+    async def run_burst(self, spread: float, start_delay: float = 0.0, duplicates: float = 0.0):
+        """Send '1' from every fake member at random times within spread seconds."""
+        await asyncio.sleep(start_delay)
+        schedule = sorted((self.random.uniform(0, spread), 1000 + i) for i in range(self.users))
+        if duplicates:
+            extra = [(at + self.random.uniform(0.5, 5), uid) for at, uid in schedule if self.random.random() < duplicates]
+            schedule = sorted(schedule + extra)
+        started = time.perf_counter()
+        for at, telegram_id in schedule:
+            delay = at - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.inject(telegram_id, '1')
+        logger.info(f"Injected {len(schedule)} check-in message(s)")
+
+    # Bot API
+
+    async def handle(self, request: Request) -> Response:
+        """Dispatch /bot<token>/<method> calls."""
+        method = request.path.rsplit('/', 1)[-1]
+        params = self._parse_params(request)
+        self.stats['calls'][method] += 1
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            logger.info(f"Unimplemented method {method}, answering True")
+            return self._ok(True)
+        return await handler(params)
+
+    @staticmethod
+    def _ok(result) -> Response:
+        return Response.json({'ok': True, 'result': result})
+
+    @staticmethod
+    def _error(code: int, description: str, parameters: Dict[str, Any] = None) -> Response:
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return Response.json(body, status=code)
+
+    @staticmethod
+    def _parse_params(request: Request) -> Dict[str, Any]:
+        """Decode query, form-encoded, JSON or multipart parameters."""
+        raw: Dict[str, Any] = dict(request.query)
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('application/json') and request.body:
+            return {**raw, **json.loads(request.body)}
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            raw.update(parse_qsl(request.body.decode('utf-8')))
+        elif content_type.startswith('multipart/form-data'):
+            parser = email.parser.BytesParser(policy=email.policy.HTTP)
+            message = parser.parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + request.body)
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True) or b''
+                if part.get_filename():
+                    raw[name] = {'filename': part.get_filename(), 'size': len(payload)}
+                else:
+                    raw[name] = payload.decode('utf-8')
+        params = {}
+        for key, value in raw.items():
+            if isinstance(value, str) and key not in STRING_PARAMS:
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _limited(self, method: str, chat_id: int) -> Optional[Response]:
+        """429 response if this call breaks a rate limit."""
+        if not self.limiter:
+            return None
+        retry_after = self.limiter.check(chat_id, time.monotonic())
+        if retry_after is None:
+            return None
+        self.stats['rate_limited'][method] += 1
+        return self._error(429, f"Too Many Requests: retry after {retry_after}", {'retry_after': retry_after})
+
+    def _sent_message(self, chat_id: int, **fields) -> Dict[str, Any]:
+        chat = {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'}
+        if chat_id < 0:
+            chat['title'] = 'Load Test'
+        return {'message_id': self._next_message_id(), 'date': int(time.time()), 'chat': chat, 'from': BOT_USER, **fields}
+
+    def _record_response(self, chat_id: int, params: Dict[str, Any]):
+        """Attribute a bot message to the check-in it answers."""
+        now = time.perf_counter()
+        if chat_id > 0:
+            injected_at = self._awaiting_dm.pop(chat_id, None)
+            if injected_at is not None:
+                self.stats['dm_latency_ms'].append((now - injected_at) * 1000)
+            return
+        self.stats['group_messages'] += 1
+        reply_to = params.get('reply_to_message_id')
+        if reply_to in self._injected:
+            _, injected_at = self._injected.pop(reply_to)
+            self.stats['reply_latency_ms'].append((now - injected_at) * 1000)
+
+    async def api_getMe(self, params):
+        return self._ok(BOT_USER)
+
+    async def api_getUpdates(self, params):
+        if self.webhook_url:
+            return self._error(409, "Conflict: can't use getUpdates method while webhook is active")
+        offset = params.get('offset') or 0
+        limit = params.get('limit') or 100
+        timeout = params.get('timeout') or 0
+        async with self._new_updates:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._ok(self._updates[:limit])
+
+    async def api_sendMessage(self, params):
+        chat_id = params['chat_id']
+        limited = self._limited('sendMessage', chat_id)
+        if limited:
+            return limited
+        if chat_id in self.unreachable:
+            self.stats['forbidden'] += 1
+            return self._error(403, "Forbidden: bot can't initiate conversation with a user")
+        self._record_response(chat_id, params)
+        return self._ok(self._sent_message(chat_id, text=params.get('text', '')))
+
+    async def api_sendDocument(self, params):
+        chat_id = params['chat_id']
+        limited = self._limited('sendDocument', chat_id)
+        if limited:
+            return limited
+        document = params.get('document') or {}
+        return self._ok(self._sent_message(chat_id, caption=params.get('caption'), document={
+            'file_id': f"fake-{self._message_id}",
+            'file_unique_id': f"fake-{self._message_id}",
+            'file_name': document.get('filename') if isinstance(document, dict) else None,
+            'file_size': document.get('size') if isinstance(document, dict) else None,
+        }))
+
+    async def api_editMessageText(self, params):
+        chat_id = params['chat_id']
+        limited = self._limited('editMessageText', chat_id)
+        if limited:
+            return limited
+        message = self._sent_message(chat_id, text=params.get('text', ''))
+        message['message_id'] = params.get('message_id')
+        return self._ok(message)
+
+    async def api_setWebhook(self, params):
+        self.webhook_url = params.get('url') or None
+        self.webhook_secret = params.get('secret_token')
+        logger.info(f"Webhook set to {self.webhook_url}")
+        return self._ok(True)
+
+    async def api_deleteWebhook(self, params):
+        self.webhook_url = None
+        return self._ok(True)
+
+    async def api_getWebhookInfo(self, params):
+        return self._ok({'url': self.webhook_url or '', 'has_custom_certificate': False,
+                         'pending_update_count': len(self._updates)})
+
+    # Webhook delivery
+
+    async def deliver_webhooks(self):
+        """POST pending updates to the registered webhook."""
+        while True:
+            async with self._new_updates:
+                while not (self.webhook_url and self._updates):
+                    await self._new_updates.wait()
+                update = self._updates.pop(0)
+            try:
+                await self._post(self.webhook_url, json.dumps(update).encode('utf-8'))
+            except Exception as e:
+                logger.warning(f"Webhook delivery failed: {e}")
+
+    async def _post(self, url: str, body: bytes):
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        headers = [
+            f"POST {parts.path or '/'} HTTP/1.1",
+            f"Host: {parts.netloc}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+        ]
+        if self.webhook_secret:
+            headers.append(f"X-Telegram-Bot-Api-Secret-Token: {self.webhook_secret}")
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+    def summary(self) -> Dict[str, Any]:
+        """Collected call counts and latency percentiles."""
+        return {
+            'users': self.users,
+            'injected': self.stats['injected'],
+            'calls': dict(self.stats['calls']),
+            'rate_limited': dict(self.stats['rate_limited']),
+            'forbidden': self.stats['forbidden'],
+            'group_messages': self.stats['group_messages'],
+            'dm_latency_ms': percentiles(self.stats['dm_latency_ms']),
+            'reply_latency_ms': percentiles(self.stats['reply_latency_ms']),
+        }
+
+
+async def run(args):
+    """Start the fake API and drive one burst."""
+    fake = FakeTelegram(chat_id=args.chat_id, users=args.users, unreachable=args.unreachable,
+                        rate_limits=not args.no_rate_limits, seed=args.seed)
+    server = HTTPServer(args.host, args.port, max_body_size=64 * 1024 * 1024)
+    server.add_prefix_route('POST', '/bot', fake.handle)
+    server.add_prefix_route('GET', '/bot', fake.handle)
+    await server.start()
+    delivery = asyncio.get_running_loop().create_task(fake.deliver_webhooks())
+
+    start_delay = args.start_delay
+    if args.open_window:
+        # Register the group with the bot, then move the window to start next minute
+        await asyncio.sleep(args.start_delay)
+        await fake.inject(args.admin_id, '1', first_name='Admin')
+        # /setwindow times are read in the bot's timezone
+        now = datetime.now(TIMEZONE)
+        opens = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        closes = opens + timedelta(minutes=args.window_minutes)
+        await fake.inject(args.admin_id, f"/setwindow {opens:%H:%M} {closes:%H:%M}", chat_id=args.admin_id, first_name='Admin')
+        start_delay = (opens - datetime.now(TIMEZONE)).total_seconds() + 1
+        logger.info(f"Window moved to {opens:%H:%M}-{closes:%H:%M}, burst starts in {start_delay:.0f}s")
+
+    await fake.run_burst(args.spread, start_delay=start_delay, duplicates=args.duplicates)
+    await asyncio.sleep(args.drain)
+
+    delivery.cancel()
+    await server.stop()
+    summary = fake.summary()
+    with open(args.stats_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(json.dumps(summary, indent=2))
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API for load testing")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=100, help="Number of fake members")
+    parser.add_argument('--chat-id', type=int, default=-1001000000000, help="Fake group chat id")
+    parser.add_argument('--spread', type=float, default=60.0, help="Seconds over which members send '1'")
+    parser.add_argument('--start-delay', type=float, default=5.0, help="Seconds to wait for the bot to connect")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="Fraction of members who send '1' twice")
+    parser.add_argument('--unreachable', type=float, default=0.0, help="Fraction of members who never started the bot")
+    parser.add_argument('--admin-id', type=int, default=1, help="Must match the bot's ADMIN_ID for --open-window")
+    parser.add_argument('--open-window', action='store_true', help="Use /setwindow to open the window next minute")
+    parser.add_argument('--window-minutes', type=int, default=5)
+    parser.add_argument('--drain', type=float, default=15.0, help="Seconds to keep serving after the burst")
+    parser.add_argument('--no-rate-limits', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stats-file', default='fake_telegram_stats.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
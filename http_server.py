@@ -0,0 +1,213 @@
+"""
+Minimal asyncio HTTP/1.1 server used for webhooks and health checks.
+"""
+import asyncio
+import json
+import logging
+from typing import Callable, Dict, Optional, Tuple, Awaitable
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted (Telegram updates are a few KB)
+MAX_BODY_SIZE = 1024 * 1024
+# Longest request or header line, and most header lines, accepted per request
+MAX_LINE_SIZE = 8 * 1024
+MAX_HEADERS = 100
+
+REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class Request:
+    """Parsed HTTP request."""
+
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Decode the body as JSON."""
+        return json.loads(self.body.decode('utf-8'))
+
+
+class Response:
+    """HTTP response."""
+
+    def __init__(self, status: int = 200, body=b'', content_type: str = 'text/plain; charset=utf-8',
+                 headers: Optional[Dict[str, str]] = None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status: int = 200) -> 'Response':
+        """Build a JSON response."""
+        return cls(status, json.dumps(data, default=str), content_type='application/json')
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class HTTPServer:
+    """Routes requests by (method, path) to async handlers."""
+
+    def __init__(self, host: str, port: int, max_body_size: int = MAX_BODY_SIZE,
+                 max_line_size: int = MAX_LINE_SIZE, max_headers: int = MAX_HEADERS):
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.max_line_size = max_line_size
+        self.max_headers = max_headers
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._prefix_routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers = set()
+
+    def add_route(self, method: str, path: str, handler: Handler):
+        """Register a handler for a method and exact path."""
+        self._routes[(method.upper(), path)] = handler
+
+    def add_prefix_route(self, method: str, prefix: str, handler: Handler):
+        """Register a handler for every path starting with prefix."""
+        self._prefix_routes[(method.upper(), prefix)] = handler
+
+    async def start(self):
+        """Start listening."""
+        # The stream limit makes readline() fail on lines longer than max_line_size
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=self.max_line_size)
+        sockets = self._server.sockets or []
+        if sockets:
+            # Report the real port when started with port 0
+            self.port = sockets[0].getsockname()[1]
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        """Stop listening and close the server."""
+        if self._server:
+            self._server.close()
+            # Close idle keep-alive connections so their handlers finish
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info("HTTP server stopped")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests on one connection (keep-alive aware)."""
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write_response(writer, request, keep_alive=False)
+                    break
+
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutting down; don't let asyncio log the cancelled handler
+            pass
+        except Exception as e:
+            logger.error(f"Error serving HTTP connection: {e}", exc_info=True)
+        finally:
+            self._writers.discard(writer)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """Read one request. Returns None on EOF or an error Response for bad input."""
+        try:
+            request_line = await reader.readline()
+        except ValueError:
+            return Response(431, 'Request line too long')
+        if not request_line:
+            return None
+        try:
+            method, target, _version = request_line.decode('latin-1').split()
+        except ValueError:
+            return Response(400, 'Malformed request line')
+
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                return Response(431, 'Header line too long')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= self.max_headers:
+                return Response(431, 'Too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            return Response(400, 'Invalid Content-Length')
+        if length > self.max_body_size:
+            return Response(413, 'Request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return Request(method.upper(), target, headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        """Call the handler for a request."""
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            handler = next(
+                (h for (method, prefix), h in self._prefix_routes.items()
+                 if method == request.method and request.path.startswith(prefix)),
+                None
+            )
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response(405, 'Method not allowed')
+            return Response(404, 'Not found')
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Error handling {request.method} {request.path}: {e}", exc_info=True)
+            return Response(500, 'Internal server error')
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+        """Serialize a response onto the connection."""
+        reason = REASONS.get(response.status, 'Unknown')
+        head = [
+            f"HTTP/1.1 {response.status} {reason}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        head.extend(f"{name}: {value}" for name, value in response.headers.items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+        await writer.drain()
@@ -0,0 +1,306 @@
+"""
+Background export jobs.
+
+/monthly and /export submit jobs to the export_jobs collection and reply
+immediately with the job id. A small worker pool claims queued jobs, builds
+the CSV on the background lane and delivers the file through the outbox.
+Requests with the same parameters share one active job, and a recently
+finished export is reused instead of being recomputed.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, Optional, Tuple
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import (
+    EXPORT_WORKERS,
+    EXPORT_JOB_POLL_SECONDS,
+    EXPORT_JOB_LEASE_SECONDS,
+    EXPORT_JOB_MAX_ATTEMPTS,
+    EXPORT_CACHE_SECONDS
+)
+from database import get_collection, db_scope, EXPORT_JOBS_COLLECTION
+from reports import export_daily_csv, export_monthly_csv
+from concurrency import get_lanes, BACKGROUND_LANE
+from outbox import get_outbox
+from metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Job kinds
+DAILY_EXPORT = 'daily'
+MONTHLY_EXPORT = 'monthly'
+
+
+def _dedupe_key(kind: str, params: Dict[str, Any]) -> str:
+    """Key identifying jobs with the same parameters."""
+    return f"{kind}:{json.dumps(params, sort_keys=True)}"
+
+
+def submit_export_job(kind: str, params: Dict[str, Any], chat_id: int) -> Tuple[Dict[str, Any], str]:
+    """
+    Submit an export job, deduplicating by parameters.
+    Returns (job, state) where state is 'cached' for a reusable finished
+    export, or the job's current status ('queued' / 'running').
+    """
+    collection = get_collection(EXPORT_JOBS_COLLECTION)
+    key = _dedupe_key(kind, params)
+    now = datetime.now(timezone.utc)
+
+    # Reuse a recent finished export with the same parameters
+    if EXPORT_CACHE_SECONDS > 0:
+        done = collection.find_one(
+            {'dedupe_key': key, 'status': 'done', 'finished_at': {'$gte': now - timedelta(seconds=EXPORT_CACHE_SECONDS)}},
+            sort=[('finished_at', -1)]
+        )
+        if done and done.get('filepath') and os.path.exists(done['filepath']):
+            CACHE_REQUESTS.labels('export', 'hit').inc()
+            return done, 'cached'
+        CACHE_REQUESTS.labels('export', 'miss').inc()
+
+    for _ in range(2):
+        try:
+            job = collection.find_one_and_update(
+                {'dedupe_key': key, 'active': True},
+                {
+                    '$setOnInsert': {
+                        'kind': kind,
+                        'params': params,
+                        'status': 'queued',
+                        'attempts': 0,
+                        'created_at': now
+                    },
+                    '$addToSet': {'chat_ids': chat_id}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return job, job['status']
+        except DuplicateKeyError:
+            # Another request created the same job concurrently; join it
+            continue
+    raise RuntimeError(f"Could not submit export job {key}")
+
+
+def claim_next_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """Atomically claim the oldest queued job."""
+    collection = get_collection(EXPORT_JOBS_COLLECTION)
+    now = datetime.now(timezone.utc)
+    return collection.find_one_and_update(
+        {'status': 'queued'},
+        {
+            '$set': {
+                'status': 'running',
+                'started_at': now,
+                'lease_until': now + timedelta(seconds=EXPORT_JOB_LEASE_SECONDS),
+                'worker': worker_id
+            },
+            '$inc': {'attempts': 1}
+        },
+        sort=[('created_at', 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def renew_lease(job_id, worker_id: str) -> bool:
+    """Extend a running job's lease. False if the job is no longer this worker's."""
+    collection = get_collection(EXPORT_JOBS_COLLECTION)
+    result = collection.update_one(
+        {'_id': job_id, 'status': 'running', 'worker': worker_id},
+        {'$set': {'lease_until': datetime.now(timezone.utc) + timedelta(seconds=EXPORT_JOB_LEASE_SECONDS)}}
+    )
+    return result.matched_count > 0
+
+
+def requeue_stale_jobs() -> int:
+    """Put jobs whose worker died (lease expired) back on the queue."""
+    collection = get_collection(EXPORT_JOBS_COLLECTION)
+    now = datetime.now(timezone.utc)
+    result = collection.update_many(
+        {'status': 'running', '$or': [
+            {'lease_until': {'$lt': now}},
+            # Claimed before leases were renewed
+            {'lease_until': {'$exists': False},
+             'started_at': {'$lt': now - timedelta(seconds=EXPORT_JOB_LEASE_SECONDS)}}
+        ]},
+        {'$set': {'status': 'queued'}, '$unset': {'worker': '', 'lease_until': ''}}
+    )
+    return result.modified_count
+
+
+def run_export(job: Dict[str, Any]) -> str:
+    """Compute the export for a job and return the file path."""
+    params = job['params']
+    if job['kind'] == DAILY_EXPORT:
+        return export_daily_csv(datetime.strptime(params['date'], '%Y-%m-%d').date())
+    if job['kind'] == MONTHLY_EXPORT:
+        return export_monthly_csv(params['year'], params['month'])
+    raise ValueError(f"Unknown export kind: {job['kind']}")
+
+
+def _owned(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Filter matching a job only while the worker that claimed it still holds it."""
+    return {'_id': job['_id'], 'status': 'running', 'worker': job.get('worker')}
+
+
+def complete_job(job: Dict[str, Any], filepath: str) -> Optional[Dict[str, Any]]:
+    """Mark a job done and release its dedupe key. None if its lease was lost."""
+    collection = get_collection(EXPORT_JOBS_COLLECTION)
+    return collection.find_one_and_update(
+        _owned(job),
+        {'$set': {
+            'status': 'done',
+            'active': False,
+            'filepath': filepath,
+            'finished_at': datetime.now(timezone.utc)
+        }, '$unset': {'lease_until': ''}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def fail_job(job: Dict[str, Any], error: Exception) -> Optional[Dict[str, Any]]:
+    """Retry a failed job, or mark it failed once attempts are used up. None if its lease was lost."""
+    collection = get_collection(EXPORT_JOBS_COLLECTION)
+    if job.get('attempts', 0) < EXPORT_JOB_MAX_ATTEMPTS:
+        update = {'$set': {'status': 'queued', 'error': str(error)}}
+    else:
+        update = {'$set': {
+            'status': 'failed',
+            'active': False,
+            'error': str(error),
+            'finished_at': datetime.now(timezone.utc)
+        }}
+    update['$unset'] = {'worker': '', 'lease_until': ''}
+    return collection.find_one_and_update(_owned(job), update, return_document=ReturnDocument.AFTER)
+
+
+def describe_job(job: Dict[str, Any]) -> str:
+    """Human readable description of a job, used as the document caption."""
+    params = job['params']
+    if job['kind'] == DAILY_EXPORT:
+        return f"Daily attendance report for {params['date']}"
+    return f"Monthly report for {params['year']}-{params['month']:02d}"
+
+
+def deliver_job(job: Dict[str, Any]):
+    """Queue the finished file for every chat that requested it."""
+    outbox = get_outbox()
+    for chat_id in job.get('chat_ids', []):
+        outbox.send_document(chat_id, job['filepath'], caption=describe_job(job))
+
+
+class ExportWorkerPool:
+    """Asyncio workers that process export jobs from MongoDB."""
+
+    def __init__(self, workers: int = EXPORT_WORKERS, poll_interval: float = EXPORT_JOB_POLL_SECONDS):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks = []
+
+    def start(self):
+        """Start the worker tasks."""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(f"{self.worker_prefix}:{n}")) for n in range(self.workers)]
+        logger.info(f"Export worker pool started with {self.workers} worker(s)")
+
+    async def stop(self):
+        """Stop the workers. Running jobs are picked up again after their lease expires."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        """Wake idle workers after a job was submitted."""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _worker(self, worker_id: str):
+        """Claim and process jobs until cancelled."""
+        while True:
+            try:
+                requeued = await asyncio.to_thread(requeue_stale_jobs)
+                if requeued:
+                    logger.warning(f"Requeued {requeued} stale export job(s)")
+                job = await asyncio.to_thread(claim_next_job, worker_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error claiming export job: {e}", exc_info=True)
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process(job)
+
+    async def _process(self, job: Dict[str, Any]):
+        """Run one claimed job and deliver or report the result."""
+        logger.info(f"Running export job {job['_id']} ({job['dedupe_key']})")
+        heartbeat = asyncio.get_running_loop().create_task(self._heartbeat(job))
+        try:
+            with db_scope(f"export_job:{job['kind']}"):
+                await self._run(job)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job: Dict[str, Any]):
+        """Keep renewing a running job's lease so long exports aren't requeued."""
+        while True:
+            await asyncio.sleep(EXPORT_JOB_LEASE_SECONDS / 3)
+            try:
+                if not await asyncio.to_thread(renew_lease, job['_id'], job['worker']):
+                    logger.warning(f"Export job {job['_id']} lease lost, another worker may run it")
+                    return
+            except Exception as e:
+                logger.warning(f"Could not renew lease of export job {job['_id']}: {e}")
+
+    async def _run(self, job: Dict[str, Any]):
+        """Compute, store and deliver one job's export."""
+        try:
+            filepath = await get_lanes().run(BACKGROUND_LANE, run_export, job)
+            done = await asyncio.to_thread(complete_job, job, filepath)
+            if done is None:
+                logger.warning(f"Export job {job['_id']} lease lost, leaving it to its new worker")
+                return
+            deliver_job(done)
+            logger.info(f"Export job {job['_id']} finished")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Export job {job['_id']} failed: {e}", exc_info=True)
+            try:
+                failed = await asyncio.to_thread(fail_job, job, e)
+                if failed is None:
+                    logger.warning(f"Export job {job['_id']} lease lost, leaving it to its new worker")
+                elif failed['status'] == 'failed':
+                    for chat_id in failed.get('chat_ids', []):
+                        get_outbox().send_message(chat_id, f"❌ Export job {job['_id']} failed: {e}")
+            except Exception as fail_error:
+                logger.error(f"Could not record export job failure: {fail_error}", exc_info=True)
+
+
+# Global worker pool
+_pool: Optional[ExportWorkerPool] = None
+
+
+def get_export_pool() -> ExportWorkerPool:
+    """Get or create the global export worker pool."""
+    global _pool
+    if _pool is None:
+        _pool = ExportWorkerPool()
+    return _pool
@@ -0,0 +1,147 @@
+"""
+Live check-in counter for the group.
+
+When the window opens a status message is posted, then edited with the
+running present/late counts and names. Check-ins only touch an in-memory
+tally; a single task edits the message at most once per interval, so the
+cost is a fixed number of API calls regardless of group size.
+"""
+import asyncio
+import logging
+import threading
+from datetime import date
+from typing import Dict, Optional
+from config import LIVE_STATUS_INTERVAL_SECONDS
+from outbox import get_outbox
+from utils import get_phnom_penh_date, join_names
+
+logger = logging.getLogger(__name__)
+
+# Characters of names shown per list; two lists plus the header stay under Telegram's 4096 chars
+NAMES_BUDGET = 1800
+# Longest single name shown
+MAX_NAME_CHARS = 100
+
+
+class LiveTally:
+    """Thread-safe running tally of today's check-ins."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.date: Optional[date] = None
+        self.present: Dict[int, str] = {}
+        self.late: Dict[int, str] = {}
+        self.version = 0
+
+    def reset(self, today: date = None):
+        """Start a new tally for a date."""
+        with self._lock:
+            self.date = today or get_phnom_penh_date()
+            self.present = {}
+            self.late = {}
+            self.version += 1
+
+    def record(self, telegram_id: int, name: str, status: str, today: date = None):
+        """Count one check-in (called by record_attendance)."""
+        today = today or get_phnom_penh_date()
+        with self._lock:
+            if self.date != today:
+                self.date = today
+                self.present = {}
+                self.late = {}
+            if status == 'late':
+                self.late[telegram_id] = name
+            else:
+                self.present[telegram_id] = name
+            self.version += 1
+
+    def render(self, closed: bool = False) -> str:
+        """Format the status message."""
+        with self._lock:
+            day = self.date or get_phnom_penh_date()
+            present = list(self.present.values())
+            late = list(self.late.values())
+
+        message = f"📋 Live attendance - {day.strftime('%Y-%m-%d')}\n\n"
+        message += f"✅ Present: {len(present)}\n"
+        message += f"⏰ Late: {len(late)}\n"
+        if present:
+            message += "\n✅ " + join_names(present, NAMES_BUDGET, MAX_NAME_CHARS) + "\n"
+        if late:
+            message += "\n⏰ " + join_names(late, NAMES_BUDGET, MAX_NAME_CHARS) + "\n"
+        if closed:
+            message += "\n🔒 Attendance window is closed."
+        else:
+            message += "\nSend '1' to record your attendance."
+        return message
+
+
+class LiveStatusBoard:
+    """Posts the status message and keeps it updated with debounced edits."""
+
+    def __init__(self, tally: LiveTally, interval: float = LIVE_STATUS_INTERVAL_SECONDS):
+        self.tally = tally
+        self.interval = interval
+        self.chat_id: Optional[int] = None
+        self.message_id: Optional[int] = None
+        self._rendered_version = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def open(self, chat_id: int):
+        """Post a fresh status message and start updating it."""
+        await self.close(final=False)
+        self.tally.reset()
+        if self.interval <= 0:
+            return
+
+        future = get_outbox().send_message(chat_id, self.tally.render())
+        if future is None:
+            return
+        try:
+            message = await asyncio.wait_for(future, timeout=60)
+        except asyncio.TimeoutError:
+            message = None
+        if message is None:
+            logger.warning("Could not post live status message")
+            return
+
+        self.chat_id = chat_id
+        self.message_id = message.message_id
+        self._rendered_version = self.tally.version
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self, final: bool = True):
+        """Stop updating, optionally with a last edit marking the window closed."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if final and self.message_id:
+            self._edit(self.tally.render(closed=True))
+        self.chat_id = None
+        self.message_id = None
+
+    async def _run(self):
+        """Edit the message at most once per interval while the tally changes."""
+        while True:
+            await asyncio.sleep(self.interval)
+            version = self.tally.version
+            if version != self._rendered_version:
+                self._rendered_version = version
+                self._edit(self.tally.render())
+
+    def _edit(self, text: str):
+        """Queue an edit of the status message."""
+        get_outbox().submit('edit_message_text', self.chat_id, message_id=self.message_id, text=text)
+
+
+# Global tally and board
+live_tally = LiveTally()
+_board: Optional[LiveStatusBoard] = None
+
+
+def get_live_board() -> LiveStatusBoard:
+    """Get or create the global live status board."""
+    global _board
+    if _board is None:
+        _board = LiveStatusBoard(live_tally)
+    return _board
@@ -0,0 +1,346 @@
+"""
+Check-in burst load test.
+
+Simulates K members sending '1' to the group shortly after the window
+opens and drives handle_attendance_message end to end: user lookup,
+record insert, fines, the check-in cache and the outbox. Bot API calls go
+to an in-process stub, so the numbers measure the bot itself.
+
+    python loadtest.py --users 500 --spread 60 --backend mongo --output loadtest.json
+    python loadtest.py --users 500 --spread 0 --backend memory
+
+Runs against a dedicated database (DATABASE_NAME + '_loadtest' by default),
+which is dropped before the run. The memory backend needs mongomock.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from pymongo import MongoClient
+from telegram import Chat, Message, Update, User as TelegramUser
+import database
+from config import TIMEZONE, CONCURRENT_UPDATES
+from database import (
+    User,
+    Settings,
+    USERS_COLLECTION,
+    ATTENDANCE_COLLECTION,
+    FINES_COLLECTION,
+    SETTINGS_COLLECTION
+)
+from database import db_scope, account_command
+from utils import percentiles
+from loopwatch import LoopWatchdog
+
+logger = logging.getLogger(__name__)
+
+# Server command names for the collection methods the bot calls (memory backend)
+COMMAND_NAMES = {
+    'find': 'find',
+    'find_one': 'find',
+    'insert_one': 'insert',
+    'insert_many': 'insert',
+    'update_one': 'update',
+    'update_many': 'update',
+    'replace_one': 'update',
+    'delete_one': 'delete',
+    'delete_many': 'delete',
+    'find_one_and_update': 'findAndModify',
+    'find_one_and_replace': 'findAndModify',
+    'find_one_and_delete': 'findAndModify',
+    'count_documents': 'aggregate',
+    'aggregate': 'aggregate',
+    'distinct': 'distinct',
+    'bulk_write': 'bulkWrite',
+    'create_index': 'createIndexes',
+}
+
+# Methods whose first argument is not a filter
+NO_FILTER = {'insert_one', 'insert_many', 'bulk_write', 'create_index', 'aggregate'}
+
+
+class CountingCollection:
+    """Collection proxy charging calls to the current db_scope, for backends without command monitoring."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in COMMAND_NAMES and callable(attr):
+            def counted(*args, **kwargs):
+                started = time.perf_counter()
+                result = attr(*args, **kwargs)
+                query = args[0] if args and name not in NO_FILTER else kwargs.get('filter')
+                docs = 1 if name.startswith('find_one') and result is not None else 0
+                account_command(COMMAND_NAMES[name], self._collection.name, query,
+                                (time.perf_counter() - started) * 1000, docs)
+                return result
+            return counted
+        return attr
+
+
+class CountingDatabase:
+    """Database proxy handing out counting collections."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name])
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def setup_backend(backend: str, database_name: str, drop: bool = True):
+    """Point database.py at a dedicated database, with DB command accounting enabled."""
+    if database_name == database.DATABASE_NAME:
+        raise SystemExit(f"Refusing to run against the bot's database '{database_name}', pick another --database")
+
+    if backend == 'memory':
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("The memory backend needs mongomock: pip install mongomock")
+        database._client = mongomock.MongoClient(tz_aware=False)
+        database._db = CountingDatabase(database._client[database_name])
+    else:
+        database._client = MongoClient(database.MONGODB_URI, serverSelectionTimeoutMS=5000,
+                                       event_listeners=[database.command_accounting])
+        database._client.admin.command('ping')
+        database._db = database._client[database_name]
+
+    if drop:
+        database._client.drop_database(database_name)
+
+
+def seed_members(count: int, first_id: int) -> List[Dict]:
+    """Insert active members and open the window for the whole day."""
+    members = [
+        User(telegram_id=first_id + n, username=f"member{n}", full_name=f"Member {n}").to_dict()
+        for n in range(count)
+    ]
+    if members:
+        database.get_collection(USERS_COLLECTION).insert_many(members)
+    settings = database.get_collection(SETTINGS_COLLECTION)
+    for key, value in (('window_start', '00:00'), ('window_end', '23:59')):
+        settings.update_one({'key': key}, {'$set': Settings(key, value).to_dict()}, upsert=True)
+    database.init_db()
+    return members
+
+
+class StubBot:
+    """Answers Bot API calls in-process after a fixed latency and records when each chat was reached."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.first_message_at: Dict[int, float] = {}
+        self._ids = itertools.count(1)
+
+    async def _answer(self, method: str, chat_id: int):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[method] += 1
+        self.first_message_at.setdefault(chat_id, time.perf_counter())
+        return SimpleNamespace(message_id=next(self._ids), chat_id=chat_id)
+
+    async def send_message(self, chat_id: int, **kwargs):
+        return await self._answer('send_message', chat_id)
+
+    async def edit_message_text(self, chat_id: int, **kwargs):
+        return await self._answer('edit_message_text', chat_id)
+
+    async def send_document(self, chat_id: int, **kwargs):
+        return await self._answer('send_document', chat_id)
+
+
+def build_update(update_id: int, chat_id: int, member: Dict, sent_at: datetime) -> Update:
+    """A group '1' message from a member."""
+    telegram_id = member['telegram_id']
+    message = Message(
+        message_id=update_id,
+        date=sent_at,
+        chat=Chat(id=chat_id, type=Chat.SUPERGROUP, title='Load test'),
+        from_user=TelegramUser(id=telegram_id, first_name=member['full_name'], is_bot=False,
+                               username=member['username']),
+        text='1'
+    )
+    return Update(update_id=update_id, message=message)
+
+
+def git_revision() -> Optional[str]:
+    """Current commit, so results can be compared across releases."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_burst(args, members: List[Dict]) -> Dict:
+    """Send the burst through the handler and collect the measurements."""
+    # Imported here so the backend is configured before the bot modules touch it
+    from bot import handle_attendance_message
+    from scheduler import set_attendance_window_status
+    from attendance import checkin_cache
+    from live_status import live_tally
+    from outbox import get_outbox
+    from coalescer import get_reply_coalescer
+    from concurrency import get_lanes
+
+    rng = random.Random(args.seed)
+    loop = asyncio.get_running_loop()
+
+    # Arrival times: uniform over the spread, some members send '1' twice
+    arrivals = [(rng.uniform(0, args.spread), member) for member in members]
+    duplicates = [(offset + rng.uniform(0.1, 5.0), member) for offset, member in arrivals
+                  if rng.random() < args.duplicates]
+    schedule = sorted(arrivals + duplicates, key=lambda item: item[0])
+
+    # Message timestamps: on time by default, after the 10:00 deadline for late members
+    today = datetime.now(TIMEZONE).replace(microsecond=0)
+    on_time = today.replace(hour=9, minute=0, second=0)
+    late = today.replace(hour=10, minute=5, second=0)
+    late_ids = {member['telegram_id'] for member in members if rng.random() < args.late}
+
+    bot = StubBot(latency=args.api_latency / 1000)
+    outbox = get_outbox()
+    outbox.start(bot)
+    set_attendance_window_status(True)
+    checkin_cache.warm()
+    live_tally.reset()
+
+    # Short interval so the lag percentiles resolve small stalls
+    monitor = LoopWatchdog(interval=0.01)
+    monitor.start()
+    slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+    latencies: List[float] = []
+    first_sent: Dict[int, float] = {}
+    errors = 0
+
+    async def deliver(update: Update):
+        nonlocal errors
+        async with slots:
+            started = time.perf_counter()
+            first_sent.setdefault(update.effective_user.id, started)
+            try:
+                await handle_attendance_message(update, None)
+            except Exception as e:
+                errors += 1
+                logger.error(f"Handler raised for {update.effective_user.id}: {e}", exc_info=True)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    # Handler tasks created inside the scope charge their DB commands to it
+    with db_scope('loadtest') as scope:
+        burst_started = time.perf_counter()
+        tasks = []
+        for update_id, (offset, member) in enumerate(schedule, start=1):
+            wait = burst_started + offset - time.perf_counter()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            sent_at = (late if member['telegram_id'] in late_ids else on_time) + timedelta(seconds=offset)
+            update = build_update(update_id, args.chat_id, member, sent_at)
+            tasks.append(loop.create_task(deliver(update)))
+        await asyncio.gather(*tasks)
+        burst_seconds = time.perf_counter() - burst_started
+    db_cost = scope.summary()
+
+    # Let queued greetings and combined group replies go out
+    get_reply_coalescer().flush_all()
+    drain_started = time.perf_counter()
+    await outbox.stop(timeout=args.drain)
+    drain_seconds = time.perf_counter() - drain_started
+    await monitor.stop()
+    get_lanes().shutdown()
+
+    records = database.get_collection(ATTENDANCE_COLLECTION).count_documents({})
+    fines = database.get_collection(FINES_COLLECTION).count_documents({})
+    greeting_latencies = [
+        (bot.first_message_at[telegram_id] - sent) * 1000
+        for telegram_id, sent in first_sent.items()
+        if telegram_id in bot.first_message_at
+    ]
+
+    return {
+        'revision': git_revision(),
+        'started_at': datetime.now(TIMEZONE).isoformat(),
+        'config': {
+            'users': len(members),
+            'spread_seconds': args.spread,
+            'duplicates': args.duplicates,
+            'late': args.late,
+            'backend': args.backend,
+            'api_latency_ms': args.api_latency,
+            'concurrent_updates': CONCURRENT_UPDATES,
+            'seed': args.seed,
+        },
+        'messages': len(schedule),
+        'handler_errors': errors,
+        'attendance_records': records,
+        'fines': fines,
+        'burst_seconds': round(burst_seconds, 3),
+        'throughput_per_second': round(len(schedule) / burst_seconds, 1) if burst_seconds else None,
+        'checkin_latency_ms': percentiles(latencies),
+        'greeting_latency_ms': percentiles(greeting_latencies),
+        'db_commands': {
+            'total': db_cost['commands'],
+            'per_message': round(db_cost['commands'] / len(schedule), 2) if schedule else None,
+            'per_checkin': round(db_cost['commands'] / records, 2) if records else None,
+            'by_command': db_cost['by_command'],
+            'time_ms': db_cost['time_ms'],
+            'docs_returned': db_cost['docs_returned'],
+        },
+        'loop_lag_ms': percentiles(list(monitor.lags)),
+        'blocking_sites': [
+            {key: site[key] for key in ('operation', 'site', 'leaf', 'stalls', 'blocked_ms', 'worst_ms')}
+            for site in monitor.top(10)
+        ],
+        'outbox': {
+            'drain_seconds': round(drain_seconds, 3),
+            'api_calls': dict(bot.calls),
+        },
+    }
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check-in burst load test")
+    parser.add_argument('--users', type=int, default=200, help="Members sending '1'")
+    parser.add_argument('--spread', type=float, default=60.0, help="Seconds over which members send '1' (0 = all at once)")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="Fraction of members who send '1' twice")
+    parser.add_argument('--late', type=float, default=0.1, help="Fraction of members checking in after the deadline")
+    parser.add_argument('--backend', choices=['mongo', 'memory'], default='mongo')
+    parser.add_argument('--database', default=f"{database.DATABASE_NAME}_loadtest", help="Database to use (dropped first)")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Simulated Bot API latency in ms")
+    parser.add_argument('--drain', type=float, default=120.0, help="Seconds to wait for queued messages after the burst")
+    parser.add_argument('--chat-id', type=int, default=-1001000000000)
+    parser.add_argument('--first-id', type=int, default=700000000, help="Telegram id of the first fake member")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest.json', help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+    setup_backend(args.backend, args.database)
+    members = seed_members(args.users, args.first_id)
+    results = asyncio.run(run_burst(args, members))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
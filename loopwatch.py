@@ -0,0 +1,273 @@
+"""
+Event loop watchdog.
+
+A timer task on the loop measures how late it wakes up (scheduling lag).
+A separate thread watches that timer: once it is overdue by half the stall
+threshold, the thread captures the loop thread's current stack together
+with the running task and the @timed handler or job it is inside. If the
+stall ends up crossing the threshold the samples are kept, so blocking call
+sites (pymongo, pandas, file I/O called straight from a coroutine) can be
+ranked by how long they held the loop.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from config import LOOP_WATCH_INTERVAL_SECONDS, LOOP_STALL_THRESHOLD_MS, TIMEZONE
+from metrics import active_operation, LOOP_LAG_SECONDS, LOOP_LAG_MAX, LOOP_STALLS
+from utils import percentiles
+
+logger = logging.getLogger(__name__)
+
+# Call sites are reported relative to the project directory
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stack frames kept per blocking site
+STACK_DEPTH = 15
+
+# Distinct (operation, site) pairs kept; the least costly are dropped first
+MAX_SITES = 200
+
+# Operation name for stalls caught while the loop was waiting in select()
+IDLE = 'idle'
+
+# Decorator frames (@timed, @db_scoped) that never block themselves
+WRAPPER_FRAMES = {'wrapper', 'async_wrapper'}
+
+
+def _is_project_frame(filename: str) -> bool:
+    """Whether a frame belongs to the bot's own code (not the stdlib or a package)."""
+    path = os.path.abspath(filename)
+    return (path.startswith(PROJECT_DIR + os.sep)
+            and 'site-packages' not in path
+            and path != os.path.abspath(__file__))
+
+
+def _describe(frame: traceback.FrameSummary) -> str:
+    """file:line in function, relative to the project for our own frames."""
+    filename = frame.filename
+    if _is_project_frame(filename):
+        filename = os.path.relpath(os.path.abspath(filename), PROJECT_DIR)
+    else:
+        filename = os.path.basename(filename)
+    return f"{filename}:{frame.lineno} in {frame.name}"
+
+
+def call_site(stack: traceback.StackSummary) -> Tuple[str, str]:
+    """
+    (site, leaf) for a captured stack: site is the innermost frame in the
+    bot's own code, i.e. the line that made the blocking call; leaf is the
+    frame that was actually running.
+    """
+    leaf = _describe(stack[-1]) if stack else 'unknown'
+    for frame in reversed(stack):
+        if _is_project_frame(frame.filename) and frame.name not in WRAPPER_FRAMES:
+            return _describe(frame), leaf
+    return leaf, leaf
+
+
+class LoopWatchdog:
+    """Measures event loop lag and records where the loop was blocked."""
+
+    def __init__(self, interval: float = LOOP_WATCH_INTERVAL_SECONDS,
+                 threshold_ms: float = LOOP_STALL_THRESHOLD_MS, history: int = 10000):
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self.lags: deque = deque(maxlen=history)  # Recent lag samples in ms
+        self.stalls = 0
+        self._sites: Dict[Tuple[str, str], Dict] = {}
+        self._pending: Optional[Dict] = None
+        self._max_lag = 0.0
+        self._beat = time.monotonic()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start the timer task and the watchdog thread (call from the event loop)."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = self._loop.create_task(self._tick(), name='loop-watchdog')
+        if self.threshold_ms > 0:
+            self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._thread.start()
+        logger.info(f"Loop watchdog started (interval {self.interval}s, stall threshold {self.threshold_ms:.0f} ms)")
+
+    async def stop(self):
+        """Stop the timer task and the watchdog thread."""
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    async def _tick(self):
+        """Sleep for interval and measure how late the loop woke us up."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            with self._lock:
+                beat = self._beat
+                self._beat = time.monotonic()
+                self._max_lag = max(self._max_lag, lag)
+            self.lags.append(lag * 1000)
+            LOOP_LAG_SECONDS.observe(lag)
+            if self.threshold_ms > 0 and lag * 1000 >= self.threshold_ms:
+                self._finish_stall(beat, lag * 1000)
+            elif self._pending is not None:
+                with self._lock:
+                    self._pending = None
+
+    def _watch(self):
+        """Watchdog thread: sample the loop thread's stack while the timer is overdue."""
+        threshold = self.threshold_ms / 1000
+        check = min(self.interval, threshold) / 2
+        while not self._stopped.wait(check):
+            beat = self._beat
+            overdue = time.monotonic() - beat - self.interval
+            if overdue >= threshold / 2:
+                try:
+                    self._sample(beat)
+                except Exception as e:
+                    logger.debug(f"Loop watchdog sample failed: {e}")
+
+    def _sample(self, beat: float):
+        """Capture what the loop thread is running right now."""
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)
+        del frame
+        task = asyncio.current_task(self._loop)
+        operation = active_operation(task) or (task.get_name() if task else 'callback')
+        site, leaf = call_site(stack)
+        if stack and os.path.basename(stack[-1].filename) == 'selectors.py':
+            # The loop itself was waiting for I/O: a worker thread held the GIL, or the collector ran
+            operation, site = IDLE, 'waiting in select (GIL held elsewhere or GC)'
+        with self._lock:
+            if self._beat != beat:
+                # The loop moved on while we were capturing
+                return
+            pending = self._pending
+            if pending is None or pending['beat'] != beat:
+                pending = self._pending = {'beat': beat, 'operation': None, 'samples': 0}
+            if pending['operation'] in (None, IDLE):
+                # Charge the stall to the first code caught blocking the loop
+                pending.update(
+                    operation=operation,
+                    site=site,
+                    leaf=leaf,
+                    stack=[_describe(f) for f in stack[-STACK_DEPTH:]]
+                )
+            pending['samples'] += 1
+
+    def _finish_stall(self, beat: float, lag_ms: float):
+        """Charge a stall over the threshold to the site captured during it."""
+        with self._lock:
+            pending = self._pending if self._pending and self._pending['beat'] == beat else None
+            self._pending = None
+            self.stalls += 1
+            if pending is None:
+                # Too short for the watchdog to catch it in the act
+                operation, site, leaf, stack = 'unknown', 'unknown', 'unknown', []
+                samples = 0
+            else:
+                operation, site, leaf, stack = pending['operation'], pending['site'], pending['leaf'], pending['stack']
+                samples = pending['samples']
+
+            entry = self._sites.get((operation, site))
+            if entry is None:
+                if len(self._sites) >= MAX_SITES:
+                    cheapest = min(self._sites, key=lambda k: self._sites[k]['blocked_ms'])
+                    del self._sites[cheapest]
+                entry = self._sites[(operation, site)] = {
+                    'operation': operation,
+                    'site': site,
+                    'stalls': 0,
+                    'samples': 0,
+                    'blocked_ms': 0.0,
+                    'worst_ms': 0.0,
+                }
+            entry['stalls'] += 1
+            entry['blocked_ms'] += lag_ms
+            entry['worst_ms'] = max(entry['worst_ms'], lag_ms)
+            entry['leaf'] = leaf
+            entry['stack'] = stack
+            entry['samples'] += samples
+            entry['last_seen'] = datetime.now(TIMEZONE)
+
+        LOOP_STALLS.labels(operation).inc()
+        logger.warning(
+            f"Event loop blocked for {lag_ms:.0f} ms in {operation} at {site} (leaf: {leaf})"
+            + (("\n  " + "\n  ".join(stack)) if stack else "")
+        )
+
+    def top(self, limit: int = 10) -> List[Dict]:
+        """Blocking call sites ranked by total time they held the loop."""
+        with self._lock:
+            entries = [dict(entry) for entry in self._sites.values()]
+        entries.sort(key=lambda entry: entry['blocked_ms'], reverse=True)
+        for entry in entries:
+            entry['blocked_ms'] = round(entry['blocked_ms'], 1)
+            entry['worst_ms'] = round(entry['worst_ms'], 1)
+        return entries[:limit]
+
+    def stats(self) -> Dict:
+        """Lag percentiles over the recent history, and the stall count."""
+        return {
+            'lag_ms': percentiles(list(self.lags)),
+            'stalls': self.stalls,
+            'threshold_ms': self.threshold_ms,
+        }
+
+    def take_max_lag(self) -> float:
+        """Largest lag in seconds since the previous call."""
+        with self._lock:
+            value, self._max_lag = self._max_lag, 0.0
+        return value
+
+    def reset(self):
+        """Forget recorded lag and blocking sites."""
+        with self._lock:
+            self.lags.clear()
+            self.stalls = 0
+            self._sites.clear()
+            self._pending = None
+            self._max_lag = 0.0
+
+
+# Global watchdog instance
+_watchdog: Optional[LoopWatchdog] = None
+
+
+def get_loop_watchdog() -> LoopWatchdog:
+    """Get or create the global loop watchdog."""
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = LoopWatchdog()
+    return _watchdog
+
+
+LOOP_LAG_MAX.set_function(lambda: get_loop_watchdog().take_max_lag())
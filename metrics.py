@@ -0,0 +1,328 @@
+"""
+In-process metrics with a Prometheus text endpoint.
+
+Counters, gauges and histograms are plain Python objects guarded by a lock,
+cheap enough to update on every check-in and DB command. GET /metrics
+renders them in the Prometheus text exposition format.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from http_server import Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Default latency buckets in seconds (5 ms .. 30 s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    """Escape a label value."""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    """Render {name="value",...}."""
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """Base class: a named metric with optional labels."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple, object] = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        """The child for one combination of label values."""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        """The unlabelled child."""
+        return self.labels()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class _Value:
+    """A single number behind a lock."""
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = float(value)
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in sorted(self._children.items())]
+
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a callback at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: 'Registry' = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function: Optional[Callable] = None
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def set_function(self, function: Callable):
+        """
+        Read the value when scraped. function() returns a number, or for
+        labelled gauges a dict of {label values tuple: number}.
+        """
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception as e:
+                logger.warning(f"Could not collect {self.name}: {e}")
+                return []
+            values = result.items() if isinstance(result, dict) else [((), result)]
+            return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(float(value))}"
+                    for key, value in sorted(values)]
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in sorted(self._children.items())]
+
+
+class _HistogramValue:
+    """Bucket counts, sum and count for one label combination."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(Metric):
+    """Distribution of observations in fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: 'Registry' = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, child in sorted(self._children.items()):
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# Name of the timed handler or job each task is running, read by the loop watchdog
+_task_operations: 'weakref.WeakKeyDictionary[asyncio.Task, str]' = weakref.WeakKeyDictionary()
+
+
+def active_operation(task: Optional[asyncio.Task]) -> Optional[str]:
+    """The @timed handler or job a task is currently inside, if any."""
+    if task is None:
+        return None
+    return _task_operations.get(task)
+
+
+def timed(histogram: Histogram, errors: Counter = None):
+    """
+    Decorator observing a function's duration in histogram (labelled with
+    the function name). Exceptions are counted in errors and re-raised.
+    """
+    def decorate(func):
+        name = func.__name__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                task = asyncio.current_task()
+                outer = _task_operations.get(task) if task else None
+                if task:
+                    _task_operations[task] = name
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.labels(name).inc()
+                    raise
+                finally:
+                    histogram.labels(name).observe(time.perf_counter() - started)
+                    if task:
+                        if outer is None:
+                            _task_operations.pop(task, None)
+                        else:
+                            _task_operations[task] = outer
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.labels(name).inc()
+                raise
+            finally:
+                histogram.labels(name).observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+async def handle_metrics(request: Request) -> Response:
+    """GET /metrics."""
+    return Response(200, REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+# Bot metrics
+HANDLER_SECONDS = Histogram('bot_handler_duration_seconds', "Time spent in update handlers", ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Exceptions raised by update handlers", ['handler'])
+CHECKINS = Counter('bot_checkins_total', "Check-in attempts by outcome", ['outcome'])
+JOB_SECONDS = Histogram('bot_scheduler_job_duration_seconds', "Scheduled job run time", ['job'],
+                        buckets=DEFAULT_BUCKETS + (60.0, 120.0, 300.0))
+JOB_ERRORS = Counter('bot_scheduler_job_errors_total', "Exceptions raised by scheduled jobs", ['job'])
+TELEGRAM_API_SECONDS = Histogram('bot_telegram_api_duration_seconds', "Bot API call latency from the outbox", ['method'])
+TELEGRAM_API_ERRORS = Counter('bot_telegram_api_errors_total', "Failed Bot API calls by error type", ['method', 'error'])
+DB_COMMAND_SECONDS = Histogram('bot_db_command_duration_seconds', "MongoDB command latency", ['command'],
+                               buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+DB_COMMAND_ERRORS = Counter('bot_db_command_errors_total', "Failed MongoDB commands", ['command'])
+SLOW_QUERIES = Counter('bot_db_slow_queries_total', "QueryBuilder reads over SLOW_QUERY_MS", ['collection'])
+QUERY_PLAN_ISSUES = Counter('bot_db_query_plan_issues_total', "Explained queries using a collection scan or in-memory sort",
+                            ['collection', 'issue'])
+CACHE_REQUESTS = Counter('bot_cache_requests_total', "Cache lookups by cache and result (hit/miss)", ['cache', 'result'])
+OUTBOX_QUEUE = Gauge('bot_outbox_queue_size', "Messages waiting in the outbox")
+LANE_QUEUED = Gauge('bot_lane_queued', "Calls waiting for a worker, per lane", ['lane'])
+LANE_RUNNING = Gauge('bot_lane_running', "Calls running, per lane", ['lane'])
+LANE_WAIT_MS = Gauge('bot_lane_wait_avg_ms', "Average wait for a worker, per lane", ['lane'])
+ATTENDANCE_WINDOW_OPEN = Gauge('bot_attendance_window_open', "1 while the attendance window is open")
+CHECKIN_LATENCY_SECONDS = Histogram('bot_checkin_end_to_end_seconds',
+                                    "From the member's message to the greeting being delivered", ['outcome'],
+                                    buckets=(0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0))
+LOOP_LAG_SECONDS = Histogram('bot_event_loop_lag_seconds', "How late the event loop ran the watchdog's timer",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+LOOP_LAG_MAX = Gauge('bot_event_loop_lag_max_seconds', "Largest loop lag since the previous scrape")
+LOOP_STALLS = Counter('bot_event_loop_stalls_total', "Loop stalls over the threshold, by handler or job", ['operation'])
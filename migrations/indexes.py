@@ -0,0 +1,300 @@
+"""
+Declared MongoDB indexes and reconciliation against the live database.
+
+INDEX_SPECS is the single list of indexes the bot relies on. At boot,
+reconcile_indexes() compares a hash of the specs with the one stored in
+settings and returns straight away when nothing changed. Otherwise it
+lists the existing indexes, creates the missing ones (unique and partial
+ones first, before the bot relies on them), and reports the
+indexes nobody declared, with their $indexStats usage. Those are dropped
+only when drop_unused is set and they have not been used for
+INDEX_UNUSED_MIN_DAYS.
+
+    python -m migrations.indexes                 # show the plan
+    python -m migrations.indexes --apply         # create missing indexes
+    python -m migrations.indexes --apply --drop-unused
+"""
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import IndexModel
+from config import INDEX_DROP_UNUSED, INDEX_UNUSED_MIN_DAYS
+from database import (
+    get_collection,
+    USERS_COLLECTION,
+    ATTENDANCE_COLLECTION,
+    FINES_COLLECTION,
+    SETTINGS_COLLECTION,
+    EXPORT_JOBS_COLLECTION,
+    ATTENDANCE_BUCKETS_COLLECTION,
+    ATTENDANCE_BITMAPS_COLLECTION
+)
+
+logger = logging.getLogger(__name__)
+
+# Settings key holding the hash of the specs last applied
+SPECS_HASH_KEY = 'index_specs_hash'
+
+
+class IndexSpec:
+    """One declared index."""
+
+    def __init__(self, collection: str, keys: List[Tuple[str, int]], unique: bool = False,
+                 partial: Optional[Dict[str, Any]] = None, reason: str = ''):
+        self.collection = collection
+        self.keys = list(keys)
+        self.unique = unique
+        self.partial = partial
+        self.reason = reason
+
+    @property
+    def name(self) -> str:
+        """MongoDB's default index name, e.g. date_1_status_1."""
+        return '_'.join(f"{field}_{direction}" for field, direction in self.keys)
+
+    def options(self) -> Dict[str, Any]:
+        options = {}
+        if self.unique:
+            options['unique'] = True
+        if self.partial:
+            options['partialFilterExpression'] = self.partial
+        return options
+
+    @property
+    def constraint(self) -> bool:
+        """Unique or partial: writes are only correct once this index exists."""
+        return self.unique or bool(self.partial)
+
+    def model(self) -> IndexModel:
+        return IndexModel(self.keys, name=self.name, **self.options())
+
+    def matches(self, info: Dict[str, Any]) -> bool:
+        """Whether an existing index (from index_information()) has the same keys and options."""
+        return (
+            [(field, int(direction)) for field, direction in info.get('key', [])] == self.keys
+            and bool(info.get('unique', False)) == self.unique
+            and info.get('partialFilterExpression') == self.partial
+        )
+
+    def describe(self) -> Dict[str, Any]:
+        return {'collection': self.collection, 'keys': self.keys, **self.options()}
+
+    def __repr__(self):
+        return f"{self.collection}.{self.name}"
+
+
+INDEX_SPECS: List[IndexSpec] = [
+    IndexSpec(USERS_COLLECTION, [('telegram_id', 1)], unique=True, reason="user lookup on every check-in"),
+    IndexSpec(USERS_COLLECTION, [('is_active', 1), ('telegram_id', 1)],
+              reason="active member lists, sorted by telegram_id"),
+
+    IndexSpec(ATTENDANCE_COLLECTION, [('user_id', 1), ('date', 1)], unique=True,
+              reason="one record per member per day; per-member history"),
+    IndexSpec(ATTENDANCE_COLLECTION, [('date', 1), ('status', 1)],
+              reason="daily reports and counts by status"),
+
+    # Bucketed layout (ATTENDANCE_STORAGE=buckets); _id is '<user_id>:<YYYY-MM>'
+    IndexSpec(ATTENDANCE_BUCKETS_COLLECTION, [('user_id', 1), ('month', 1)],
+              reason="a member's history with an open-ended date range"),
+    IndexSpec(ATTENDANCE_BUCKETS_COLLECTION, [('month', 1)], reason="everyone's record for one day"),
+
+    # Per-member yearly bitmaps; _id is '<user_id>:<year>'
+    IndexSpec(ATTENDANCE_BITMAPS_COLLECTION, [('user_id', 1), ('year', 1)], reason="/me stats across years"),
+    IndexSpec(ATTENDANCE_BITMAPS_COLLECTION, [('year', 1)], reason="leaderboards"),
+
+    IndexSpec(FINES_COLLECTION, [('user_id', 1), ('date', 1)], unique=True, reason="one fine per member per day"),
+    IndexSpec(FINES_COLLECTION, [('date', 1)], reason="daily and monthly fine totals"),
+
+    IndexSpec(SETTINGS_COLLECTION, [('key', 1)], unique=True, reason="settings by key"),
+
+    IndexSpec(EXPORT_JOBS_COLLECTION, [('dedupe_key', 1)], unique=True, partial={'active': True},
+              reason="one active job per parameter set"),
+    IndexSpec(EXPORT_JOBS_COLLECTION, [('status', 1), ('created_at', 1)], reason="worker polling"),
+    IndexSpec(EXPORT_JOBS_COLLECTION, [('dedupe_key', 1), ('finished_at', -1)], reason="export cache lookup"),
+]
+
+
+def specs_hash(specs: List[IndexSpec] = None) -> str:
+    """Stable hash of the declared specs."""
+    described = [spec.describe() for spec in (specs or INDEX_SPECS)]
+    canonical = json.dumps(described, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def index_usage(collection_name: str) -> Dict[str, Dict[str, Any]]:
+    """$indexStats per index name: {ops, since}. Empty if the server doesn't allow it."""
+    try:
+        stats = get_collection(collection_name).aggregate([{'$indexStats': {}}])
+        return {s['name']: {'ops': int(s['accesses']['ops']), 'since': s['accesses']['since']} for s in stats}
+    except Exception as e:
+        logger.debug(f"$indexStats unavailable for {collection_name}: {e}")
+        return {}
+
+
+def plan_indexes(specs: List[IndexSpec] = None) -> Dict[str, List]:
+    """
+    Diff the declared specs against the database.
+    Returns {'create': [IndexSpec], 'conflicts': [(IndexSpec, existing name)],
+    'undeclared': [{collection, name, key, ops, since}]}.
+    """
+    specs = specs or INDEX_SPECS
+    plan = {'create': [], 'conflicts': [], 'undeclared': []}
+    by_collection: Dict[str, List[IndexSpec]] = {}
+    for spec in specs:
+        by_collection.setdefault(spec.collection, []).append(spec)
+
+    for collection_name, collection_specs in by_collection.items():
+        existing = get_collection(collection_name).index_information()
+        declared = set()
+        for spec in collection_specs:
+            matching = next((name for name, info in existing.items() if spec.matches(info)), None)
+            if matching:
+                declared.add(matching)
+            elif spec.name in existing:
+                # Same keys, different options (e.g. unique added): needs a manual rebuild
+                plan['conflicts'].append((spec, spec.name))
+                declared.add(spec.name)
+            else:
+                plan['create'].append(spec)
+
+        leftovers = [name for name in existing if name != '_id_' and name not in declared]
+        if leftovers:
+            usage = index_usage(collection_name)
+            for name in leftovers:
+                stats = usage.get(name, {})
+                plan['undeclared'].append({
+                    'collection': collection_name,
+                    'name': name,
+                    'key': existing[name].get('key'),
+                    'ops': stats.get('ops'),
+                    'since': stats.get('since'),
+                })
+    return plan
+
+
+def droppable(index: Dict[str, Any], min_days: float = INDEX_UNUSED_MIN_DAYS) -> bool:
+    """An undeclared index with no recorded use over at least min_days."""
+    since = index.get('since')
+    if index.get('ops') != 0 or since is None:
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - since >= timedelta(days=min_days)
+
+
+def apply_plan(plan: Dict[str, List], drop_unused: bool = False) -> Dict[str, List[str]]:
+    """Create missing indexes and, if asked, drop unused undeclared ones."""
+    done = {'created': [], 'dropped': []}
+    by_collection: Dict[str, List[IndexSpec]] = {}
+    for spec in plan['create']:
+        by_collection.setdefault(spec.collection, []).append(spec)
+    for collection_name, specs in by_collection.items():
+        started = datetime.now(timezone.utc)
+        get_collection(collection_name).create_indexes([spec.model() for spec in specs])
+        seconds = (datetime.now(timezone.utc) - started).total_seconds()
+        logger.info(f"Built {', '.join(map(repr, specs))} in {seconds:.1f}s")
+        done['created'].extend(repr(spec) for spec in specs)
+
+    for spec, existing_name in plan['conflicts']:
+        logger.warning(f"Index {existing_name} on {spec.collection} has the keys of {spec!r} "
+                       f"but different options; drop it to rebuild")
+
+    for index in plan['undeclared']:
+        label = f"{index['collection']}.{index['name']}"
+        if drop_unused and droppable(index):
+            get_collection(index['collection']).drop_index(index['name'])
+            logger.info(f"Dropped unused index {label}")
+            done['dropped'].append(label)
+        else:
+            logger.info(f"Undeclared index {label}: {index['ops'] if index['ops'] is not None else '?'} "
+                        f"use(s) since {index['since'] or '?'}")
+    return done
+
+
+def _stored_hash() -> Optional[str]:
+    doc = get_collection(SETTINGS_COLLECTION).find_one({'key': SPECS_HASH_KEY})
+    return doc.get('value') if doc else None
+
+
+def _store_hash(value: str):
+    get_collection(SETTINGS_COLLECTION).update_one(
+        {'key': SPECS_HASH_KEY},
+        {'$set': {'value': value, 'updated_at': datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+def _finish(plan: Dict[str, List], current: str, drop_unused: bool) -> Dict[str, Any]:
+    done = apply_plan(plan, drop_unused=drop_unused)
+    if not plan['conflicts']:
+        _store_hash(current)
+    return {'skipped': False, **done, 'undeclared': plan['undeclared'], 'conflicts': len(plan['conflicts'])}
+
+
+def reconcile_indexes(background: bool = False, force: bool = False,
+                      drop_unused: bool = INDEX_DROP_UNUSED) -> Dict[str, Any]:
+    """
+    Bring the indexes in line with INDEX_SPECS. Skipped (one settings read)
+    when the specs hash matches the last successful run, unless force.
+    With background=True only unique and partial indexes are built before
+    returning (duplicate check-ins or jobs could slip in without them); the
+    rest build on a separate thread.
+    """
+    current = specs_hash()
+    if not force and _stored_hash() == current:
+        logger.info("Index specs unchanged, skipping index reconciliation")
+        return {'skipped': True}
+
+    plan = plan_indexes()
+    if not background:
+        return _finish(plan, current, drop_unused)
+
+    constraints = [spec for spec in plan['create'] if spec.constraint]
+    created = apply_plan({'create': constraints, 'conflicts': [], 'undeclared': []})['created']
+    plan['create'] = [spec for spec in plan['create'] if not spec.constraint]
+
+    def run():
+        try:
+            _finish(plan, current, drop_unused)
+        except Exception as e:
+            logger.error(f"Index reconciliation failed: {e}", exc_info=True)
+
+    threading.Thread(target=run, name='index-builder', daemon=True).start()
+    return {'skipped': False, 'background': True, 'created': created}
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare declared indexes with the database")
+    parser.add_argument('--apply', action='store_true', help="Create missing indexes")
+    parser.add_argument('--drop-unused', action='store_true',
+                        help=f"Also drop undeclared indexes unused for {INDEX_UNUSED_MIN_DAYS:g}+ days")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.apply:
+        result = reconcile_indexes(force=True, drop_unused=args.drop_unused)
+        print(json.dumps(result, indent=2, default=str))
+        return
+
+    plan = plan_indexes()
+    print("Missing (would be created):")
+    for spec in plan['create']:
+        print(f"  {spec!r}  -- {spec.reason}")
+    print("Conflicting options:")
+    for spec, existing_name in plan['conflicts']:
+        print(f"  {spec!r} vs existing {existing_name}")
+    print("Undeclared:")
+    for index in plan['undeclared']:
+        verdict = 'droppable' if droppable(index) else 'kept'
+        print(f"  {index['collection']}.{index['name']} ops={index['ops']} since={index['since']} ({verdict})")
+
+
+if __name__ == '__main__':
+    main()
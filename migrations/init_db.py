@@ -3,19 +3,22 @@ Database initialization and migration script for MongoDB.
 Run this once to set up the database indexes.
 """
 from database import init_db
+from migrations.indexes import INDEX_SPECS
 
 def main():
     """Initialize database."""
     print("Initializing MongoDB database...")
     
     try:
-        init_db()
+        result = init_db(force=True)
         print("Database initialized successfully!")
-        print("\nIndexes created for collections:")
-        print("  - users (telegram_id, is_active)")
-        print("  - attendance_records (user_id+date, date, user_id)")
-        print("  - fines (user_id+date, date, user_id)")
-        print("  - settings (key)")
+        print("\nDeclared indexes:")
+        for spec in INDEX_SPECS:
+            print(f"  - {spec!r}")
+        if result.get('created'):
+            print(f"\nCreated: {', '.join(result['created'])}")
+        if result.get('dropped'):
+            print(f"Dropped: {', '.join(result['dropped'])}")
         print("\nYou can now connect to MongoDB Compass using the connection string from your .env file.")
     except Exception as e:
         print(f"Error initializing database: {e}")
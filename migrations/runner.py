@@ -0,0 +1,454 @@
+"""
+Versioned, resumable document migrations.
+
+Each Migration rewrites one collection into canonical form: it walks the
+collection in _id order in batches, computes an update per document and
+writes the batch with one bulk_write. Progress (last _id, counts) is
+checkpointed in the schema_migrations collection after every batch, so an
+interrupted run resumes where it stopped. Between batches the runner sleeps
+long enough to stay under MIGRATION_MAX_DUTY of wall time, so it can run
+next to the live bot. A migration can also write elsewhere (target): with
+ATTENDANCE_STORAGE=buckets, 0007 copies attendance_records into
+attendance_buckets, and 0008 builds attendance_bitmaps from the records.
+Until 0007 is done, attendance is read from attendance_records and
+written to both, so the switch to the buckets loses nothing.
+
+Each update is guarded by the old values of the fields it rewrites; a
+document changed by the bot in between is left alone and picked up by the
+next run, which only rewrites what is still non-canonical.
+
+Canonical form:
+- dates and timestamps are BSON datetimes (attendance/fine dates at UTC midnight)
+- created_at/updated_at are always present
+- user_id references are the user's ObjectId, telegram_id is an int, amount is a double
+
+Once every migration is done, database.set_canonical_documents(True)
+switches model hydration to the fast path.
+
+    python -m migrations.runner --status
+    python -m migrations.runner [--batch-size 500] [--max-duty 0.5] [--dry-run]
+"""
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from config import MIGRATION_BATCH_SIZE, MIGRATION_MAX_DUTY, MIGRATE_ON_BOOT
+import database
+from database import (
+    get_collection,
+    user_ref,
+    bucket_update,
+    attendance_buckets_enabled,
+    AttendanceRecord,
+    USERS_COLLECTION,
+    ATTENDANCE_COLLECTION,
+    FINES_COLLECTION,
+    SETTINGS_COLLECTION,
+    MIGRATIONS_COLLECTION,
+    ATTENDANCE_BUCKETS_COLLECTION,
+    ATTENDANCE_BITMAPS_COLLECTION
+)
+from bitmaps import rebuild_operations
+
+logger = logging.getLogger(__name__)
+
+# A running migration's claim expires if its checkpoint isn't renewed for this long
+LEASE_SECONDS = 300
+
+
+def parse_datetime(value: Any) -> Optional[datetime]:
+    """A stored date/time value (datetime, date or string) as an aware UTC datetime."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time()).replace(tzinfo=timezone.utc)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            from dateutil import parser
+            parsed = parser.parse(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    raise ValueError(f"Not a date: {value!r}")
+
+
+def day_start(value: Any) -> datetime:
+    """A stored date as the canonical UTC midnight datetime."""
+    if isinstance(value, str) and len(value) == 10:
+        value = datetime.strptime(value, '%Y-%m-%d')
+    parsed = parse_datetime(value)
+    return datetime.combine(parsed.date(), datetime.min.time()).replace(tzinfo=timezone.utc)
+
+
+def _same_datetime(stored: Any, canonical: datetime) -> bool:
+    """Whether a stored value already is the canonical datetime (naive reads are UTC)."""
+    return isinstance(stored, datetime) and parse_datetime(stored) == canonical
+
+
+class Migration:
+    """One versioned rewrite of one collection."""
+
+    id = ''
+    description = ''
+    collection = ''
+    target = ''  # Collection written to, when not the one scanned
+    # A duplicate key error means the write's target already holds the data (an
+    # upsert whose guard didn't match), so it is skipped rather than failed
+    skip_duplicates = False
+
+    def rewrite(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Fields to $set to make doc canonical (empty when it already is)."""
+        raise NotImplementedError
+
+    def on_done(self):
+        """Called in the running process once the migration has finished."""
+
+    def operations(self, doc: Dict[str, Any]) -> List[UpdateOne]:
+        """Writes for one scanned document; by default a guarded $set of rewrite()."""
+        changes = self.rewrite(doc)
+        if not changes:
+            return []
+        # Only if the fields still hold what we read
+        guard = {'_id': doc['_id'], **{field: doc.get(field) for field in changes}}
+        return [UpdateOne(guard, {'$set': changes})]
+
+
+class CanonicalUsers(Migration):
+    id = '0001_canonical_users'
+    description = "users: int telegram_id, datetime created_at, explicit is_active"
+    collection = USERS_COLLECTION
+
+    def rewrite(self, doc):
+        changes = {}
+        if isinstance(doc.get('telegram_id'), str):
+            changes['telegram_id'] = int(doc['telegram_id'])
+        created_at = parse_datetime(doc.get('created_at')) or doc['_id'].generation_time
+        if not _same_datetime(doc.get('created_at'), created_at):
+            changes['created_at'] = created_at
+        if not isinstance(doc.get('is_active'), bool):
+            changes['is_active'] = bool(doc.get('is_active', True))
+        return changes
+
+
+class CanonicalAttendance(Migration):
+    id = '0002_canonical_attendance'
+    description = "attendance_records: midnight UTC dates, datetime timestamps"
+    collection = ATTENDANCE_COLLECTION
+
+    def rewrite(self, doc):
+        changes = {}
+        day = day_start(doc['date'])
+        if not _same_datetime(doc['date'], day):
+            changes['date'] = day
+        if doc.get('timestamp') is not None and not isinstance(doc['timestamp'], datetime):
+            changes['timestamp'] = parse_datetime(doc['timestamp'])
+        created_at = parse_datetime(doc.get('created_at')) or doc['_id'].generation_time
+        if not _same_datetime(doc.get('created_at'), created_at):
+            changes['created_at'] = created_at
+        return changes
+
+
+class CanonicalFines(Migration):
+    id = '0003_canonical_fines'
+    description = "fines: midnight UTC dates, datetime created_at, double amount"
+    collection = FINES_COLLECTION
+
+    def rewrite(self, doc):
+        changes = {}
+        day = day_start(doc['date'])
+        if not _same_datetime(doc['date'], day):
+            changes['date'] = day
+        created_at = parse_datetime(doc.get('created_at')) or doc['_id'].generation_time
+        if not _same_datetime(doc.get('created_at'), created_at):
+            changes['created_at'] = created_at
+        if not isinstance(doc.get('amount'), float):
+            changes['amount'] = float(doc['amount'])
+        return changes
+
+
+class CanonicalSettings(Migration):
+    id = '0004_canonical_settings'
+    description = "settings: datetime updated_at, explicit value"
+    collection = SETTINGS_COLLECTION
+
+    def rewrite(self, doc):
+        changes = {}
+        updated_at = parse_datetime(doc.get('updated_at')) or doc['_id'].generation_time
+        if not _same_datetime(doc.get('updated_at'), updated_at):
+            changes['updated_at'] = updated_at
+        if 'value' not in doc:
+            changes['value'] = None
+        return changes
+
+
+class ObjectIdUserRefs(Migration):
+    """user_id stored as the user's ObjectId instead of its string form."""
+
+    def __init__(self, id: str, collection: str):
+        self.id = id
+        self.collection = collection
+        self.description = f"{collection}: user_id as ObjectId"
+
+    def rewrite(self, doc):
+        ref = user_ref(doc['user_id'])
+        if isinstance(ref, ObjectId) and not isinstance(doc['user_id'], ObjectId):
+            return {'user_id': ref}
+        return {}
+
+
+class BucketAttendance(Migration):
+    """Copies attendance_records into attendance_buckets when the bucketed layout is on."""
+
+    id = '0007_attendance_buckets'
+    description = "attendance_records copied into per-member monthly attendance_buckets"
+    collection = ATTENDANCE_COLLECTION
+    target = ATTENDANCE_BUCKETS_COLLECTION
+    skip_duplicates = True
+
+    def operations(self, doc):
+        query, update = bucket_update(AttendanceRecord.from_dict(doc))
+        # Never overwrite a day the bot has already written to the bucket
+        # (writes go to both stores while this runs)
+        guard = {**query, **{slot: {'$exists': False} for slot in update['$set']}}
+        return [UpdateOne(guard, update, upsert=True)]
+
+    def on_done(self):
+        # The buckets hold everything now; later migrations (0008) read them
+        database.set_attendance_buckets_ready(True)
+
+
+class BuildBitmaps(Migration):
+    """Builds every member's attendance bitmaps from their records."""
+
+    id = '0008_attendance_bitmaps'
+    description = "attendance_bitmaps built from each member's attendance records"
+    collection = USERS_COLLECTION
+    target = ATTENDANCE_BITMAPS_COLLECTION
+
+    def operations(self, doc):
+        return rebuild_operations(str(doc['_id']))
+
+
+# In the order they run; never reorder or renumber applied migrations
+MIGRATIONS: List[Migration] = [
+    CanonicalUsers(),
+    CanonicalAttendance(),
+    CanonicalFines(),
+    CanonicalSettings(),
+    ObjectIdUserRefs('0005_attendance_user_refs', ATTENDANCE_COLLECTION),
+    ObjectIdUserRefs('0006_fine_user_refs', FINES_COLLECTION),
+]
+if attendance_buckets_enabled():
+    MIGRATIONS.append(BucketAttendance())
+# Reads records through QueryBuilder, so it follows whichever layout is active
+MIGRATIONS.append(BuildBitmaps())
+
+
+class MigrationRunner:
+    """Runs pending migrations in throttled, checkpointed batches."""
+
+    def __init__(self, migrations: List[Migration] = None, batch_size: int = MIGRATION_BATCH_SIZE,
+                 max_duty: float = MIGRATION_MAX_DUTY):
+        self.migrations = migrations if migrations is not None else MIGRATIONS
+        self.batch_size = batch_size
+        self.max_duty = max_duty
+
+    def status(self) -> List[Dict[str, Any]]:
+        """Each migration with its stored progress."""
+        stored = {doc['_id']: doc for doc in get_collection(MIGRATIONS_COLLECTION).find()}
+        return [
+            {'id': m.id, 'description': m.description, **{k: v for k, v in stored.get(m.id, {'status': 'pending'}).items()
+                                                          if k != '_id'}}
+            for m in self.migrations
+        ]
+
+    def pending(self) -> List[Migration]:
+        done = {doc['_id'] for doc in get_collection(MIGRATIONS_COLLECTION).find({'status': 'done'}, {'_id': 1})}
+        return [m for m in self.migrations if m.id not in done]
+
+    def run(self, dry_run: bool = False) -> List[Dict[str, Any]]:
+        """Run every pending migration in order. Stops at the first one it can't finish."""
+        results = []
+        for migration in self.pending():
+            result = self.run_one(migration, dry_run=dry_run)
+            results.append(result)
+            if result['status'] != 'done':
+                break
+        return results
+
+    def _claim(self, migration: Migration) -> Optional[Dict[str, Any]]:
+        """Claim a migration (or take over an expired claim). Returns its checkpoint, None if held elsewhere."""
+        collection = get_collection(MIGRATIONS_COLLECTION)
+        now = datetime.now(timezone.utc)
+        try:
+            return collection.find_one_and_update(
+                {'_id': migration.id, '$or': [{'status': {'$ne': 'running'}}, {'lease_until': {'$lt': now}}]},
+                {
+                    '$set': {'status': 'running', 'lease_until': now + timedelta(seconds=LEASE_SECONDS),
+                             'description': migration.description, 'collection': migration.collection},
+                    '$setOnInsert': {'started_at': now, 'last_id': None, 'scanned': 0, 'modified': 0},
+                },
+                upsert=True,
+                return_document=True
+            )
+        except DuplicateKeyError:
+            return None
+
+    def run_one(self, migration: Migration, dry_run: bool = False) -> Dict[str, Any]:
+        """Run (or resume) one migration."""
+        state = {'last_id': None, 'scanned': 0, 'modified': 0} if dry_run else self._claim(migration)
+        if state is None:
+            logger.info(f"Migration {migration.id} is running elsewhere, skipping")
+            return {'id': migration.id, 'status': 'busy'}
+
+        collection = get_collection(migration.collection)
+        target = get_collection(migration.target or migration.collection)
+        checkpoints = get_collection(MIGRATIONS_COLLECTION)
+        last_id, scanned, modified = state.get('last_id'), state.get('scanned', 0), state.get('modified', 0)
+        if last_id is not None:
+            logger.info(f"Resuming migration {migration.id} after {last_id} ({scanned} scanned)")
+        else:
+            logger.info(f"Starting migration {migration.id}: {migration.description}")
+
+        started = time.perf_counter()
+        failed = 0
+        while True:
+            batch_started = time.perf_counter()
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            docs = list(collection.find(query).sort('_id', 1).limit(self.batch_size))
+            if not docs:
+                break
+
+            updates = []
+            for doc in docs:
+                try:
+                    updates.extend(migration.operations(doc))
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f"{migration.id}: cannot rewrite {doc['_id']}: {e}")
+
+            if updates and not dry_run:
+                try:
+                    result = target.bulk_write(updates, ordered=False)
+                    modified += result.modified_count + result.upserted_count
+                except BulkWriteError as e:
+                    # Unordered, so the rest of the batch went through; typically a
+                    # duplicate key where both forms of a reference exist for one day
+                    modified += e.details.get('nModified', 0) + e.details.get('nUpserted', 0)
+                    errors = e.details.get('writeErrors', [])
+                    if migration.skip_duplicates:
+                        errors = [error for error in errors if error.get('code') != 11000]
+                    failed += len(errors)
+                    for error in errors:
+                        logger.warning(f"{migration.id}: cannot rewrite {error.get('op', {}).get('q', {}).get('_id')}: "
+                                       f"{error.get('errmsg')}")
+            elif dry_run:
+                modified += len(updates)
+            scanned += len(docs)
+            last_id = docs[-1]['_id']
+
+            if not dry_run:
+                checkpoints.update_one({'_id': migration.id}, {'$set': {
+                    'last_id': last_id,
+                    'scanned': scanned,
+                    'modified': modified,
+                    'updated_at': datetime.now(timezone.utc),
+                    'lease_until': datetime.now(timezone.utc) + timedelta(seconds=LEASE_SECONDS),
+                }})
+
+            # Throttle: stay busy at most max_duty of the time
+            busy = time.perf_counter() - batch_started
+            if 0 < self.max_duty < 1:
+                time.sleep(busy * (1 - self.max_duty) / self.max_duty)
+
+        status = 'done' if not failed else 'failed'
+        seconds = round(time.perf_counter() - started, 1)
+        if not dry_run:
+            checkpoints.update_one({'_id': migration.id}, {'$set': {
+                'status': status,
+                'failed': failed,
+                'finished_at': datetime.now(timezone.utc),
+                # A failed run starts over so the documents it skipped are retried
+                **({'last_id': None} if failed else {}),
+            }, '$unset': {'lease_until': ''}})
+            if status == 'done':
+                migration.on_done()
+        logger.info(f"Migration {migration.id} {status}: {scanned} scanned, {modified} rewritten, "
+                    f"{failed} failed in {seconds}s")
+        return {'id': migration.id, 'status': status, 'scanned': scanned, 'modified': modified,
+                'failed': failed, 'seconds': seconds}
+
+
+def apply_migration_state(runner: 'MigrationRunner' = None) -> bool:
+    """
+    Switch on what finished migrations allow: fast hydration once all are
+    done, bucket-only attendance once 0007 is. Returns whether all are done.
+    """
+    pending = {m.id for m in (runner or MigrationRunner()).pending()}
+    database.set_canonical_documents(not pending)
+    database.set_attendance_buckets_ready(BucketAttendance.id not in pending)
+    return not pending
+
+
+def _migrate():
+    runner = MigrationRunner()
+    if runner.pending():
+        runner.run()
+    if apply_migration_state(runner):
+        logger.info("All documents are canonical, using fast model hydration")
+
+
+def start_migrations(background: bool = False):
+    """
+    Run pending migrations (on a thread when background) and switch to fast
+    hydration once they are all done. With MIGRATE_ON_BOOT off this only
+    checks whether they have been applied.
+    """
+    # Before anything is served: a bucketed deployment whose copy finished
+    # earlier must read the buckets straight away (records stopped being written)
+    apply_migration_state()
+    if not MIGRATE_ON_BOOT:
+        return
+    if not background:
+        _migrate()
+        return
+
+    def run():
+        try:
+            _migrate()
+        except Exception as e:
+            logger.error(f"Migrations failed: {e}", exc_info=True)
+
+    threading.Thread(target=run, name='migrations', daemon=True).start()
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Run pending document migrations")
+    parser.add_argument('--status', action='store_true', help="Show migration progress and exit")
+    parser.add_argument('--dry-run', action='store_true', help="Count what would be rewritten without writing")
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument('--max-duty', type=float, default=MIGRATION_MAX_DUTY,
+                        help="Largest fraction of wall time spent working (1 = no pauses)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    runner = MigrationRunner(batch_size=args.batch_size, max_duty=args.max_duty)
+    if args.status:
+        print(json.dumps(runner.status(), indent=2, default=str))
+        return
+    print(json.dumps(runner.run(dry_run=args.dry_run), indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
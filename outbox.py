@@ -0,0 +1,293 @@
+"""
+Outbound message queue with Telegram rate limiting.
+
+Handlers and scheduled jobs enqueue bot-initiated messages here instead of
+awaiting the Bot API directly. A single dispatcher paces messages per chat,
+a token bucket keeps the global send rate under Telegram's flood limits and
+RetryAfter responses pause delivery for the time Telegram asks for.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Optional, Callable, Dict, Any
+from telegram.error import RetryAfter, BadRequest, TimedOut, NetworkError, TelegramError
+from config import (
+    OUTBOX_MAX_SIZE,
+    OUTBOX_MAX_INFLIGHT,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_CHAT_INTERVAL,
+    OUTBOX_GROUP_INTERVAL,
+    OUTBOX_MAX_RETRIES
+)
+from metrics import TELEGRAM_API_SECONDS, TELEGRAM_API_ERRORS, OUTBOX_QUEUE
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Async token bucket limiting the overall send rate."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class OutboundMessage:
+    """A queued Bot API call."""
+
+    __slots__ = ('method', 'chat_id', 'kwargs', 'attempts', 'on_failure', 'future')
+
+    def __init__(self, method: str, chat_id: int, kwargs: Dict[str, Any],
+                 on_failure: Optional[Callable] = None, future: asyncio.Future = None):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.on_failure = on_failure
+        self.future = future
+
+    def __repr__(self):
+        return f"<OutboundMessage(method={self.method}, chat_id={self.chat_id}, attempts={self.attempts})>"
+
+
+class Outbox:
+    """Bounded, rate-limited queue for bot-initiated messages."""
+
+    def __init__(self, maxsize: int = OUTBOX_MAX_SIZE, max_inflight: int = OUTBOX_MAX_INFLIGHT,
+                 rate: float = OUTBOX_GLOBAL_RATE, chat_interval: float = OUTBOX_CHAT_INTERVAL,
+                 group_interval: float = OUTBOX_GROUP_INTERVAL, max_retries: int = OUTBOX_MAX_RETRIES):
+        self.bot = None
+        self.max_retries = max_retries
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._inflight = asyncio.Semaphore(max_inflight)
+        # Messages taken off the queue and waiting for their chat's slot (bounds memory like the queue)
+        self._scheduled = asyncio.Semaphore(maxsize)
+        self._bucket = TokenBucket(rate)
+        self._next_slot: Dict[int, float] = {}
+        self._last_sent: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks = set()
+
+    @property
+    def running(self) -> bool:
+        """Whether the dispatcher task is running."""
+        return self._dispatcher is not None and not self._dispatcher.done()
+
+    def qsize(self) -> int:
+        """Number of messages not yet delivered (queued or waiting for their chat's slot)."""
+        return self._queue.qsize() + len(self._tasks)
+
+    def start(self, bot):
+        """Start dispatching queued messages through the given bot."""
+        self.bot = bot
+        if not self.running:
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+            logger.info("Outbox started")
+
+    async def stop(self, timeout: float = 5.0):
+        """Flush what can be sent within the timeout, then stop."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox stopped with {self._queue.qsize()} undelivered message(s)")
+        self._dispatcher.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        self._dispatcher = None
+        logger.info("Outbox stopped")
+
+    def submit(self, method: str, chat_id: int, on_failure: Optional[Callable] = None,
+               **kwargs) -> Optional[asyncio.Future]:
+        """
+        Queue a Bot API call without waiting for it.
+        Returns a future resolving to the API result (None on failure),
+        or None if the queue is full and the message was dropped.
+        on_failure(message, error) is called when delivery fails permanently.
+        """
+        future = asyncio.get_running_loop().create_future()
+        message = OutboundMessage(method, chat_id, kwargs, on_failure=on_failure, future=future)
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning(f"Outbox full, dropping {method} to {chat_id}")
+            return None
+        return future
+
+    def send_message(self, chat_id: int, text: str, on_failure: Optional[Callable] = None,
+                     **kwargs) -> Optional[asyncio.Future]:
+        """Queue a text message."""
+        return self.submit('send_message', chat_id, on_failure=on_failure, text=text, **kwargs)
+
+    def send_document(self, chat_id: int, path: str, on_failure: Optional[Callable] = None,
+                      **kwargs) -> Optional[asyncio.Future]:
+        """Queue a document upload. The file is opened when it is sent."""
+        kwargs.setdefault('filename', os.path.basename(path))
+        return self.submit('send_document', chat_id, on_failure=on_failure, document=path, **kwargs)
+
+    def reply(self, message, text: str, **kwargs) -> Optional[asyncio.Future]:
+        """Queue a reply to an incoming message."""
+        return self.send_message(
+            message.chat_id,
+            text,
+            reply_to_message_id=message.message_id,
+            allow_sending_without_reply=True,
+            **kwargs
+        )
+
+    def _chat_interval(self, chat_id: int) -> float:
+        """Minimum spacing between messages to one chat."""
+        return self.group_interval if chat_id < 0 else self.chat_interval
+
+    def _reserve_slot(self, chat_id: int, now: float) -> float:
+        """Reserve the next send slot for a chat and return how long to wait for it."""
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self._chat_interval(chat_id)
+        if len(self._next_slot) > 10000:
+            # Forget chats whose pacing window has already passed
+            self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+            self._last_sent = {k: v for k, v in self._last_sent.items() if k in self._next_slot}
+        return slot - now
+
+    async def _dispatch(self):
+        """Take messages off the queue and schedule their delivery."""
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await self._queue.get()
+            await self._scheduled.acquire()
+            delay = self._reserve_slot(message.chat_id, loop.time())
+            task = loop.create_task(self._deliver(message, delay))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, message: OutboundMessage, delay: float):
+        """Send one message, honouring pacing, flood control and retries."""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                pause = self._paused_until - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                # Hold an inflight slot only while sending, never while waiting out a chat's pacing
+                async with self._inflight:
+                    await self._bucket.acquire()
+                    # A flood-control pause can bunch up reserved slots, so re-check the chat's pacing
+                    wait = self._last_sent.get(message.chat_id, float('-inf')) + self._chat_interval(message.chat_id) - loop.time()
+                    if wait > 0:
+                        delay = wait
+                        continue
+                    self._last_sent[message.chat_id] = loop.time()
+
+                    message.attempts += 1
+                    try:
+                        result = await self._call(message)
+                    except RetryAfter as e:
+                        retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                        logger.warning(f"Flood control on {message.method} to {message.chat_id}, retrying in {retry_after}s")
+                        # Flood control applies to the whole bot, so hold every sender
+                        self._paused_until = max(self._paused_until, loop.time() + retry_after)
+                        if message.attempts > self.max_retries:
+                            self._fail(message, e)
+                            return
+                        delay = 0
+                        continue
+                    except BadRequest as e:
+                        # BadRequest subclasses NetworkError but is never worth retrying
+                        self._fail(message, e)
+                        return
+                    except (TimedOut, NetworkError) as e:
+                        if message.attempts > self.max_retries:
+                            self._fail(message, e)
+                            return
+                        delay = min(2 ** message.attempts, 30)
+                        logger.warning(f"Transient error on {message.method} to {message.chat_id}: {e}, retrying in {delay}s")
+                        continue
+                    except TelegramError as e:
+                        self._fail(message, e)
+                        return
+
+                    if message.future and not message.future.done():
+                        message.future.set_result(result)
+                    return
+        except asyncio.CancelledError:
+            if message.future and not message.future.done():
+                message.future.cancel()
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error delivering {message!r}: {e}", exc_info=True)
+            self._fail(message, e)
+        finally:
+            self._scheduled.release()
+            self._queue.task_done()
+
+    async def _call(self, message: OutboundMessage):
+        """Perform the Bot API call for a message."""
+        started = time.perf_counter()
+        try:
+            return await self._request(message)
+        except TelegramError as e:
+            TELEGRAM_API_ERRORS.labels(message.method, type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.labels(message.method).observe(time.perf_counter() - started)
+
+    async def _request(self, message: OutboundMessage):
+        """Call the bot method, opening queued document paths at send time."""
+        method = getattr(self.bot, message.method)
+        document = message.kwargs.get('document')
+        if isinstance(document, str):
+            kwargs = dict(message.kwargs)
+            with open(document, 'rb') as f:
+                kwargs['document'] = f
+                return await method(chat_id=message.chat_id, **kwargs)
+        return await method(chat_id=message.chat_id, **message.kwargs)
+
+    def _fail(self, message: OutboundMessage, error: Exception):
+        """Record a permanent delivery failure."""
+        logger.warning(f"Could not deliver {message.method} to {message.chat_id}: {error}")
+        if message.future and not message.future.done():
+            message.future.set_result(None)
+        if message.on_failure:
+            try:
+                message.on_failure(message, error)
+            except Exception as e:
+                logger.error(f"Error in outbox failure callback: {e}", exc_info=True)
+
+
+# Global outbox instance
+_outbox: Optional[Outbox] = None
+
+
+def get_outbox() -> Outbox:
+    """Get or create the global outbox."""
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox()
+    return _outbox
+
+
+OUTBOX_QUEUE.set_function(lambda: get_outbox().qsize())
@@ -0,0 +1,239 @@
+"""
+On-demand profiling of the running bot.
+
+StackSampler samples every thread's Python stack at a fixed interval and
+writes the result in the collapsed-stack format ("thread;outer;...;inner
+count" per line) that flamegraph.pl, inferno and speedscope.app read
+directly. MemoryProfiler wraps tracemalloc: the first snapshot starts
+tracing, later ones report the top allocation sites and the growth since
+the previous snapshot.
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from config import TIMEZONE, PROFILE_DIR, PROFILE_INTERVAL_MS, MEMPROFILE_FRAMES
+
+logger = logging.getLogger(__name__)
+
+# Call sites are reported relative to the project directory
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A thread whose innermost frame is in one of these modules is waiting, not working
+IDLE_MODULES = {'threading.py', 'queue.py', 'selectors.py'}
+
+# Allocations made by the profiler and the import system are left out of memory reports
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def _frame_label(code) -> str:
+    """function (file:first line), relative to the project for our own code."""
+    filename = code.co_filename
+    path = os.path.abspath(filename)
+    if path.startswith(PROJECT_DIR + os.sep) and 'site-packages' not in path:
+        filename = os.path.relpath(path, PROJECT_DIR)
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _thread_group(name: str) -> str:
+    """Thread name without the pool index, so workers of one pool share a root."""
+    return re.sub(r'[_-]\d+$', '', name)
+
+
+def _output_path(prefix: str, extension: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')
+    return os.path.join(PROFILE_DIR, f"{prefix}_{stamp}.{extension}")
+
+
+class StackSampler:
+    """Sampling profiler over all threads of this process."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float) -> Dict:
+        """
+        Sample for seconds (blocking, call from a worker thread) and write the
+        collapsed stacks to a file. Returns the path and a summary.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            stacks, samples, elapsed = self._sample(seconds)
+        finally:
+            self._lock.release()
+
+        path = _output_path('profile', 'collapsed')
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Profile written to {path}: {samples} samples over {elapsed:.1f}s")
+        return {
+            'path': path,
+            'samples': samples,
+            'seconds': round(elapsed, 1),
+            'hot': self.hot_functions(stacks),
+        }
+
+    def _sample(self, seconds: float) -> Tuple[Counter, int, float]:
+        """Collect collapsed stacks for seconds."""
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        samples = 0
+        names: Dict[int, str] = {}
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            tick = time.perf_counter()
+            if tick >= deadline:
+                break
+            frames = sys._current_frames()
+            if any(ident not in names for ident in frames):
+                names = {thread.ident: _thread_group(thread.name) for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks[';'.join(reversed(labels))] += 1
+            del frames
+            samples += 1
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - tick)))
+        return stacks, samples, time.perf_counter() - started
+
+    @staticmethod
+    def hot_functions(stacks: Counter, limit: int = 10) -> List[Tuple[str, int]]:
+        """Functions with the most samples on top of the stack, ignoring idle threads."""
+        own: Counter = Counter()
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            module = leaf.rsplit('(', 1)[-1].split(':', 1)[0]
+            if module not in IDLE_MODULES:
+                own[leaf] += count
+        return own.most_common(limit)
+
+
+class MemoryProfiler:
+    """tracemalloc snapshots compared against the previous one."""
+
+    def __init__(self, frames: int = MEMPROFILE_FRAMES, limit: int = 25):
+        self.frames = frames
+        self.limit = limit
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._baseline_at: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def _take(self) -> tracemalloc.Snapshot:
+        snapshot = tracemalloc.take_snapshot().filter_traces(MEMORY_FILTERS)
+        self._baseline_at = datetime.now(TIMEZONE)
+        return snapshot
+
+    def start(self):
+        """Start tracing and take the baseline snapshot."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self._baseline = self._take()
+        logger.info(f"tracemalloc started ({self.frames} frames)")
+
+    def stop(self):
+        """Stop tracing and drop the snapshots."""
+        with self._lock:
+            tracemalloc.stop()
+            self._baseline = None
+            self._baseline_at = None
+        logger.info("tracemalloc stopped")
+
+    def report(self) -> Dict:
+        """
+        Snapshot now, write the top allocation sites and the growth since the
+        previous snapshot to a file, and make this snapshot the new baseline.
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                raise RuntimeError("Memory tracing is not running")
+            previous, previous_at = self._baseline, self._baseline_at
+            snapshot = self._take()
+            self._baseline = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        top = snapshot.statistics('lineno')
+        growth = snapshot.compare_to(previous, 'lineno') if previous else []
+        growth = [stat for stat in growth if stat.size_diff > 0]
+
+        lines = [
+            f"Memory profile {self._baseline_at:%Y-%m-%d %H:%M:%S}",
+            f"Traced: {current / 1024 / 1024:.1f} MiB now, {peak / 1024 / 1024:.1f} MiB peak",
+            "",
+            f"Top {self.limit} allocation sites (live memory):",
+        ]
+        lines.extend(f"  {stat}" for stat in top[:self.limit])
+        if previous is not None:
+            lines.append("")
+            lines.append(f"Growth since {previous_at:%Y-%m-%d %H:%M:%S}:")
+            lines.extend(f"  {stat}" for stat in growth[:self.limit])
+            if growth:
+                # Where the biggest grower is allocated from
+                biggest = snapshot.compare_to(previous, 'traceback')[0]
+                lines.append("")
+                lines.append(f"Traceback of the largest growth ({biggest.size_diff / 1024:+.1f} KiB):")
+                lines.extend(f"  {line}" for line in biggest.traceback.format())
+
+        path = _output_path('memprofile', 'txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        logger.info(f"Memory profile written to {path}")
+        return {
+            'path': path,
+            'current_mib': round(current / 1024 / 1024, 1),
+            'peak_mib': round(peak / 1024 / 1024, 1),
+            'growth_kib': round(sum(stat.size_diff for stat in growth) / 1024, 1),
+            'since': previous_at,
+        }
+
+
+# Global profiler instances
+_sampler: Optional[StackSampler] = None
+_memory_profiler: Optional[MemoryProfiler] = None
+
+
+def get_sampler() -> StackSampler:
+    """Get or create the global stack sampler."""
+    global _sampler
+    if _sampler is None:
+        _sampler = StackSampler()
+    return _sampler
+
+
+def get_memory_profiler() -> MemoryProfiler:
+    """Get or create the global memory profiler."""
+    global _memory_profiler
+    if _memory_profiler is None:
+        _memory_profiler = MemoryProfiler()
+    return _memory_profiler
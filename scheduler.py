@@ -4,11 +4,19 @@ Scheduler for attendance window and daily reports.
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
+import asyncio
 import pytz
 from config import TIMEZONE, get_window_start, get_window_end, get_report_time
-from attendance import process_daily_attendance
+from attendance import process_daily_attendance, checkin_cache
 from reports import generate_daily_report, format_daily_report_message
-from database import get_db, Settings
+from database import get_db, Settings, db_scoped
+from outbox import get_outbox
+from concurrency import get_lanes, BACKGROUND_LANE
+from digest import get_failure_digest
+from live_status import get_live_board
+from metrics import timed, JOB_SECONDS, JOB_ERRORS, ATTENDANCE_WINDOW_OPEN
+from tracing import save_latency_summary
+from utils import get_phnom_penh_date
 import logging
 
 logger = logging.getLogger(__name__)
@@ -47,71 +55,101 @@ def set_attendance_window_status(status: bool):
     logger.info(f"Attendance window {'opened' if status else 'closed'}")
 
 
+ATTENDANCE_WINDOW_OPEN.set_function(lambda: 1 if attendance_window_open else 0)
+
+
+@timed(JOB_SECONDS, JOB_ERRORS)
+@db_scoped
 async def open_attendance_window():
     """Open attendance window at 09:00 AM."""
     try:
         set_attendance_window_status(True)
         logger.info("Attendance window opened at 09:00 AM")
         
-        if group_chat_id and bot_instance and bot_instance.bot:
+        # Load today's check-ins so duplicates are answered from memory
+        try:
+            cached = await asyncio.to_thread(checkin_cache.warm)
+            logger.info(f"Check-in cache warmed with {cached} user(s)")
+        except Exception as e:
+            logger.error(f"Failed to warm check-in cache: {e}", exc_info=True)
+        
+        if group_chat_id:
+            get_outbox().send_message(
+                group_chat_id,
+                "✅ Attendance window is now open! Send '1' to record your attendance."
+            )
+            # Post the live check-in counter
             try:
-                await bot_instance.bot.send_message(
-                    chat_id=group_chat_id,
-                    text="✅ Attendance window is now open! Send '1' to record your attendance."
-                )
+                await get_live_board().open(group_chat_id)
             except Exception as e:
-                logger.error(f"Failed to send window open message: {e}")
+                logger.error(f"Failed to open live status: {e}", exc_info=True)
         else:
-            logger.warning("Cannot send window open message: bot_instance or group_chat_id not set")
+            logger.warning("Cannot send window open message: group_chat_id not set")
     except Exception as e:
         logger.error(f"Error in open_attendance_window: {e}", exc_info=True)
 
 
+@timed(JOB_SECONDS, JOB_ERRORS)
+@db_scoped
 async def close_attendance_window():
     """Close attendance window at 10:00 AM and process attendance."""
     try:
         set_attendance_window_status(False)
         logger.info("Attendance window closed at 10:00 AM")
         
+        # Final edit of the live check-in counter
+        try:
+            await get_live_board().close()
+        except Exception as e:
+            logger.error(f"Failed to close live status: {e}", exc_info=True)
+        
         # Process attendance for all members
         try:
-            process_daily_attendance()
+            # One query per member: keep it off the event loop, like /reclose
+            marker = await get_lanes().run(BACKGROUND_LANE, process_daily_attendance, group_id=group_chat_id)
+            if marker and marker.get('counts'):
+                logger.info(f"Daily close counts: {marker['counts']}")
         except Exception as e:
             logger.error(f"Error processing daily attendance: {e}", exc_info=True)
         
-        if group_chat_id and bot_instance and bot_instance.bot:
-            try:
-                await bot_instance.bot.send_message(
-                    chat_id=group_chat_id,
-                    text="⏰ Attendance window is now closed. Processing attendance..."
-                )
-            except Exception as e:
-                logger.error(f"Failed to send window close message: {e}")
+        if group_chat_id:
+            get_outbox().send_message(
+                group_chat_id,
+                "⏰ Attendance window is now closed. Processing attendance..."
+            )
         else:
-            logger.warning("Cannot send window close message: bot_instance or group_chat_id not set")
+            logger.warning("Cannot send window close message: group_chat_id not set")
+        
+        # Report failed greetings from this window in one message
+        get_failure_digest().flush()
     except Exception as e:
         logger.error(f"Error in close_attendance_window: {e}", exc_info=True)
 
 
+@timed(JOB_SECONDS, JOB_ERRORS)
+@db_scoped
 async def send_daily_report():
     """Send daily report at 10:05 AM."""
     try:
         logger.info("Generating daily report")
         
-        if not group_chat_id or not bot_instance or not bot_instance.bot:
-            logger.warning("Group chat ID or bot instance not set, cannot send daily report")
+        # Check-ins are over for the day; keep the latency rollup past restarts
+        try:
+            save_latency_summary(get_phnom_penh_date())
+        except Exception as e:
+            logger.error(f"Failed to save check-in latency summary: {e}", exc_info=True)
+        
+        if not group_chat_id:
+            logger.warning("Group chat ID not set, cannot send daily report")
             return
         
         try:
             report = generate_daily_report()
             message = format_daily_report_message(report, include_running_fines=False)
             
-            await bot_instance.bot.send_message(
-                chat_id=group_chat_id,
-                text=message
-            )
+            get_outbox().send_message(group_chat_id, message)
             
-            logger.info("Daily report sent successfully")
+            logger.info("Daily report queued for delivery")
         except Exception as e:
             logger.error(f"Failed to send daily report: {e}", exc_info=True)
     except Exception as e:
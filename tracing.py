@@ -0,0 +1,441 @@
+"""
+End-to-end check-in tracing.
+
+A trace starts at the Telegram message date, so it includes delivery to the
+bot, and ends once its last span has ended, which for a check-in is when the
+private greeting is delivered. Spans are held in a context variable and
+carried into lane worker threads with the rest of the context, so code in
+attendance.py can open child spans without passing anything around.
+
+Finished traces feed an in-memory daily latency rollup and, when
+TRACE_EXPORT is set, are written by a background thread as OTLP/JSON:
+one ExportTraceServiceRequest per line in TRACE_FILE ('file'), or POSTed to
+TRACE_OTLP_ENDPOINT ('otlp').
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime
+from typing import Dict, List, Optional
+from config import (
+    TIMEZONE,
+    TRACING_ENABLED,
+    TRACE_SAMPLE_RATE,
+    TRACE_EXPORT,
+    TRACE_FILE,
+    TRACE_OTLP_ENDPOINT
+)
+from metrics import CHECKIN_LATENCY_SECONDS
+from utils import percentiles
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'shundori-bot'
+
+# Latency samples kept per span name per day, and days kept in memory
+MAX_SAMPLES_PER_DAY = 20000
+DAYS_KEPT = 3
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    """A timed operation within a trace (times are epoch seconds)."""
+
+    __slots__ = ('name', 'trace', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, name: str, trace: 'Trace', parent: Optional['Span'] = None,
+                 start: float = None, attributes: Dict = None):
+        self.name = name
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time() if start is None else start
+        self.end: Optional[float] = None
+        self.attributes = dict(attributes or {})
+        self.error: Optional[str] = None
+        trace.add(self)
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, error: str = None, end: float = None):
+        """End the span; the trace is complete once all its spans have ended."""
+        if self.end is not None:
+            return
+        self.end = time.time() if end is None else end
+        if error:
+            self.error = error
+        self.trace.span_ended()
+
+    def to_otlp(self) -> Dict:
+        """The span in OTLP/JSON form."""
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 2 if self.parent_id is None else 1,  # SERVER for the root, INTERNAL below it
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int((self.end or self.start) * 1e9)),
+            'attributes': [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class Trace:
+    """All spans of one traced operation."""
+
+    def __init__(self, tracer: 'Tracer'):
+        self.tracer = tracer
+        self.trace_id = _new_id(128)
+        self.spans: List[Span] = []
+        self.root: Optional[Span] = None
+        self._open = 0
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+            self._open += 1
+            if self.root is None:
+                self.root = span
+
+    def span_ended(self):
+        with self._lock:
+            self._open -= 1
+            done = self._open == 0
+        if done:
+            self.tracer.finish(self)
+
+    @property
+    def end(self) -> float:
+        return max(span.end or span.start for span in self.spans)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.root.start
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def annotate(**attributes):
+    """Set attributes on the root span of the current trace (no-op outside a trace)."""
+    span = _current_span.get()
+    if span is not None:
+        span.trace.root.set(**attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Child span of the current span; does nothing outside a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace, parent, attributes=attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """
+    Child span that outlives the current block, e.g. a queued Bot API call.
+    The caller must finish() it; see finish_with_future().
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace, parent, attributes=attributes)
+
+
+def finish_with_future(span: Optional[Span], future: Optional[asyncio.Future]):
+    """Finish span when an outbox future resolves (None result means the call failed)."""
+    if span is None:
+        return
+    if future is None:
+        span.finish(error='dropped')
+        return
+
+    def done(f: asyncio.Future):
+        if f.cancelled():
+            span.finish(error='cancelled')
+        elif f.exception() is not None or f.result() is None:
+            span.finish(error='failed')
+        else:
+            span.finish()
+    future.add_done_callback(done)
+
+
+def traced_update(name: str):
+    """
+    Decorator for update handlers: trace the handler from the Telegram
+    message date. Traces whose root never gets an 'outcome' attribute (the
+    handler ignored the update) are dropped.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(update, context, *args, **kwargs):
+            tracer = get_tracer()
+            message = getattr(update, 'message', None)
+            if not tracer.enabled or message is None or message.date is None or not tracer.sampled():
+                return await func(update, context, *args, **kwargs)
+
+            trace = Trace(tracer)
+            handler_started = time.time()
+            root = Span(name, trace, start=message.date.timestamp(), attributes={
+                'telegram_id': update.effective_user.id if update.effective_user else 0,
+                'chat_id': message.chat.id,
+            })
+            # Telegram's delivery to the bot (message dates have one-second resolution)
+            Span('delivery', trace, root, start=root.start).finish(end=max(root.start, handler_started))
+            token = _current_span.set(root)
+            try:
+                return await func(update, context, *args, **kwargs)
+            except BaseException as e:
+                root.error = type(e).__name__
+                raise
+            finally:
+                _current_span.reset(token)
+                root.finish()
+        return wrapper
+    return decorate
+
+
+class LatencyRollup:
+    """Per-day latency samples of finished traces."""
+
+    def __init__(self):
+        self._days: Dict[date, Dict] = {}
+        self._lock = threading.Lock()
+
+    def add(self, trace: Trace):
+        day = datetime.fromtimestamp(trace.root.start, TIMEZONE).date()
+        with self._lock:
+            entry = self._days.get(day)
+            if entry is None:
+                entry = self._days[day] = {'outcomes': Counter(), 'end_to_end': deque(maxlen=MAX_SAMPLES_PER_DAY),
+                                           'spans': {}}
+                for old in sorted(self._days)[:-DAYS_KEPT]:
+                    del self._days[old]
+            entry['outcomes'][trace.root.attributes.get('outcome')] += 1
+            entry['end_to_end'].append(trace.duration * 1000)
+            for span in trace.spans:
+                if span is trace.root or span.end is None:
+                    continue
+                samples = entry['spans'].setdefault(span.name, deque(maxlen=MAX_SAMPLES_PER_DAY))
+                samples.append(span.duration * 1000)
+
+    def summary(self, day: date) -> Optional[Dict]:
+        """Latency percentiles (ms) for a day, or None if nothing was traced."""
+        with self._lock:
+            entry = self._days.get(day)
+            if entry is None:
+                return None
+            return {
+                'date': day.isoformat(),
+                'traced': sum(entry['outcomes'].values()),
+                'outcomes': dict(entry['outcomes']),
+                'end_to_end_ms': percentiles(list(entry['end_to_end'])),
+                'spans_ms': {name: percentiles(list(samples)) for name, samples in entry['spans'].items()},
+            }
+
+
+class SpanExporter:
+    """Background thread writing finished traces as OTLP/JSON."""
+
+    def __init__(self, mode: str, path: str = TRACE_FILE, endpoint: str = TRACE_OTLP_ENDPOINT,
+                 batch_size: int = 512, flush_seconds: float = 2.0):
+        self.mode = mode
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=10000)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+            self._thread.start()
+            logger.info(f"Exporting traces ({self.mode}) to {self.path if self.mode == 'file' else self.endpoint}")
+
+    def stop(self, timeout: float = 5.0):
+        """Flush what is queued and stop the thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            if batch:
+                self._export(batch)
+
+    def _export(self, traces: List[Trace]):
+        spans = [span.to_otlp() for trace in traces for span in trace.spans]
+        payload = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [_otlp_attribute('service.name', SERVICE_NAME)]},
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+        }]})
+        try:
+            if self.mode == 'file':
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(payload + '\n')
+            else:
+                request = urllib.request.Request(self.endpoint, data=payload.encode('utf-8'), method='POST',
+                                                 headers={'Content-Type': 'application/json'})
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    response.read()
+            self.exported += len(spans)
+        except Exception as e:
+            self.failed += len(spans)
+            logger.warning(f"Could not export {len(spans)} spans: {e}")
+
+
+class Tracer:
+    """Creates traces and hands finished ones to the rollup and the exporter."""
+
+    def __init__(self, enabled: bool = TRACING_ENABLED, sample_rate: float = TRACE_SAMPLE_RATE,
+                 export: str = TRACE_EXPORT):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.rollup = LatencyRollup()
+        self.exporter = SpanExporter(export) if export in ('file', 'otlp') else None
+        if export and self.exporter is None:
+            logger.warning(f"Unknown TRACE_EXPORT '{export}', traces will not be exported")
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def start(self):
+        if self.enabled and self.exporter:
+            self.exporter.start()
+
+    def stop(self):
+        if self.exporter:
+            self.exporter.stop()
+
+    def finish(self, trace: Trace):
+        """Called when the last span of a trace ends."""
+        if 'outcome' not in trace.root.attributes:
+            return
+        try:
+            CHECKIN_LATENCY_SECONDS.labels(trace.root.attributes['outcome']).observe(trace.duration)
+            self.rollup.add(trace)
+            if self.exporter:
+                self.exporter.submit(trace)
+        except Exception as e:
+            logger.warning(f"Could not record trace {trace.trace_id}: {e}")
+
+
+# Global tracer instance
+_tracer: Optional[Tracer] = None
+
+
+def get_tracer() -> Tracer:
+    """Get or create the global tracer."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def latency_summary(day: date) -> Optional[Dict]:
+    """A day's check-in latency summary: in memory, else the one saved at the daily report."""
+    summary = get_tracer().rollup.summary(day)
+    if summary is None:
+        from database import get_latency_rollup
+        summary = get_latency_rollup(day.isoformat())
+    return summary
+
+
+def save_latency_summary(day: date):
+    """Persist a day's rollup so it survives restarts."""
+    summary = get_tracer().rollup.summary(day)
+    if summary is not None:
+        from database import save_latency_rollup
+        save_latency_rollup(day.isoformat(), summary)
+
+
+def format_latency_summary(summary: Dict) -> str:
+    """Latency section for the admin report."""
+    def duration(ms: float) -> str:
+        return f"{ms:.0f} ms" if ms < 1000 else f"{ms / 1000:.1f}s"
+
+    def line(label: str, stats: Dict) -> str:
+        if not stats or not stats.get('count'):
+            return f"  {label}: -"
+        return f"  {label}: p50 {duration(stats['p50'])}, p95 {duration(stats['p95'])}, max {duration(stats['max'])}"
+
+    spans = summary.get('spans_ms', {})
+    lines = [f"⏱ Check-in latency ({summary['traced']} traced)", line("End to end", summary['end_to_end_ms'])]
+    for name, label in (('delivery', "Telegram delivery"), ('record_attendance', "Recording"),
+                        ('user_lookup', "User lookup"), ('record_insert', "Record insert"),
+                        ('fine_create', "Fine"), ('dm', "Greeting DM")):
+        if name in spans:
+            lines.append(line(label, spans[name]))
+    return "\n".join(lines)
@@ -2,7 +2,7 @@
 Utility functions for the attendance bot.
 """
 from datetime import datetime, date, time
-from typing import Optional
+from typing import Dict, List, Optional
 import pytz
 from config import TIMEZONE, get_window_start, get_window_end
 
@@ -71,3 +71,33 @@ def format_user_name(user) -> str:
     else:
         return f"User {user.telegram_id}"
 
+
+def join_names(names: List[str], budget: int, max_name_chars: int = 100) -> str:
+    """Comma separated names, cut to a character budget with an "and N more" suffix."""
+    shown = []
+    length = 0
+    for position, name in enumerate(names):
+        name = name[:max_name_chars]
+        remaining = len(names) - position - 1
+        # Leave room for the suffix the names after this one would need
+        room = budget - (len(f" and {remaining} more") if remaining else 0)
+        added = len(name) + (2 if shown else 0)
+        if length + added > room:
+            break
+        shown.append(name)
+        length += added
+    listed = ', '.join(shown)
+    if len(shown) < len(names):
+        listed += f" and {len(names) - len(shown)} more"
+    return listed
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """count/p50/p95/p99/max of a list of milliseconds."""
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 2)
+    return {'count': len(ordered), 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 2)}
@@ -0,0 +1,159 @@
+"""
+Webhook mode: receive Telegram updates over HTTP and feed the Application.
+
+Run `python webhook.py replay <updates.jsonl>` to POST recorded updates to a
+running webhook server and measure how quickly they are accepted.
+"""
+import hmac
+import json
+import logging
+import time
+from typing import Optional
+from telegram import Update
+from telegram.ext import Application
+from config import WEBHOOK_SECRET, WEBHOOK_PATH, WEBHOOK_RECORD_FILE
+from http_server import HTTPServer, Request, Response
+from metrics import handle_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookReceiver:
+    """Validates webhook requests and puts the updates on the application's queue."""
+
+    def __init__(self, application: Application, secret_token: Optional[str] = WEBHOOK_SECRET,
+                 record_file: Optional[str] = WEBHOOK_RECORD_FILE):
+        self.application = application
+        self.secret_token = secret_token
+        self.record_file = record_file
+        self.started_at = time.time()
+        self.received = 0
+        self.rejected = 0
+
+    async def handle_update(self, request: Request) -> Response:
+        """POST <WEBHOOK_PATH>: accept one update."""
+        if self.secret_token:
+            supplied = request.headers.get('x-telegram-bot-api-secret-token', '')
+            # Bytes: compare_digest raises on non-ASCII str, and header values are latin-1 decoded
+            if not hmac.compare_digest(supplied.encode('latin-1'), self.secret_token.encode()):
+                self.rejected += 1
+                logger.warning("Rejected webhook request with invalid secret token")
+                return Response(403, 'Invalid secret token')
+
+        try:
+            data = request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, KeyError, TypeError) as e:
+            self.rejected += 1
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return Response(400, 'Malformed update')
+
+        if update is None:
+            self.rejected += 1
+            return Response(400, 'Empty update')
+
+        if self.record_file:
+            self._record(request.body)
+
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return Response(200, 'ok')
+
+    async def handle_health(self, request: Request) -> Response:
+        """GET /health: liveness and queue depths."""
+        from outbox import get_outbox
+        from scheduler import get_attendance_window_status
+        from concurrency import get_lanes
+        from loopwatch import get_loop_watchdog
+        return Response.json({
+            'status': 'ok' if self.application.running else 'starting',
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'updates_received': self.received,
+            'updates_rejected': self.rejected,
+            'update_queue': self.application.update_queue.qsize(),
+            'outbox_queue': get_outbox().qsize(),
+            'attendance_window_open': get_attendance_window_status(),
+            'lanes': get_lanes().stats(),
+            'event_loop': get_loop_watchdog().stats(),
+        })
+
+    def _record(self, body: bytes):
+        """Append the raw update to the record file for later replay."""
+        try:
+            with open(self.record_file, 'ab') as f:
+                f.write(body.strip() + b'\n')
+        except OSError as e:
+            logger.warning(f"Could not record webhook update: {e}")
+
+
+def setup_status_routes(server: HTTPServer, application: Application,
+                        secret_token: Optional[str] = WEBHOOK_SECRET) -> WebhookReceiver:
+    """Register the health and metrics routes on a server."""
+    receiver = WebhookReceiver(application, secret_token=secret_token)
+    server.add_route('GET', '/health', receiver.handle_health)
+    server.add_route('GET', '/metrics', handle_metrics)
+    return receiver
+
+
+def setup_webhook_routes(server: HTTPServer, application: Application,
+                         secret_token: Optional[str] = WEBHOOK_SECRET) -> WebhookReceiver:
+    """
+    Register the webhook, health and metrics routes on a server.
+    Without a secret_token every POST is accepted, so only do that for local testing.
+    """
+    receiver = setup_status_routes(server, application, secret_token=secret_token)
+    server.add_route('POST', WEBHOOK_PATH, receiver.handle_update)
+    return receiver
+
+
+def replay(path: str, url: str, secret: Optional[str] = None, rate: float = 0.0):
+    """POST recorded updates (one JSON object per line) and print ack latencies."""
+    from urllib.request import Request as URLRequest, urlopen
+
+    latencies = []
+    with open(path, 'rb') as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    for line in lines:
+        headers = {'Content-Type': 'application/json'}
+        if secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+        started = time.perf_counter()
+        with urlopen(URLRequest(url, data=line, headers=headers, method='POST')) as response:
+            response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if rate > 0:
+            time.sleep(1 / rate)
+
+    if not latencies:
+        print("No updates to replay")
+        return
+    latencies.sort()
+    print(json.dumps({
+        'updates': len(latencies),
+        'p50_ms': round(latencies[len(latencies) // 2], 2),
+        'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+        'max_ms': round(latencies[-1], 2),
+    }, indent=2))
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+    from config import HTTP_PORT
+
+    parser = argparse.ArgumentParser(description="Webhook utilities")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay', help="POST recorded updates to a webhook server")
+    replay_parser.add_argument('file', help="JSON lines file of updates")
+    replay_parser.add_argument('--url', default=f"http://127.0.0.1:{HTTP_PORT}{WEBHOOK_PATH}")
+    replay_parser.add_argument('--secret', default=WEBHOOK_SECRET)
+    replay_parser.add_argument('--rate', type=float, default=0.0, help="Updates per second (0 = as fast as possible)")
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        replay(args.file, args.url, secret=args.secret, rate=args.rate)
+
+
+if __name__ == '__main__':
+    main()